@@ -0,0 +1,89 @@
+import asyncio
+from functools import partial
+from typing import Dict, List
+from concurrent.futures import Executor, ProcessPoolExecutor
+
+from image_converter_v2 import ImageConverterWeb, _init_worker, _convert_bytes_in_worker
+
+
+class AsyncImageConverter:
+    """
+    رابط asyncio برای تبدیل تصاویر در حافظه (مثلاً در سرویس aiohttp)
+
+    کار پردازشی در یک executor مشترک انجام می‌شود و event loop مسدود نمی‌شود.
+    تعداد تبدیل‌های هم‌زمان با semaphore محدود می‌شود؛ درخواست‌های اضافی تا آزاد شدن جا صبر می‌کنند.
+    """
+
+    def __init__(self, config: Dict = None, executor: Executor = None, workers: int = None,
+                 max_concurrency: int = None):
+        """
+        config: تنظیمات مبدل (پیش‌فرض: get_default_config)
+        executor: executor مشترک (مثلاً ThreadPoolExecutor یا ProcessPoolExecutor موجود)؛
+                  در صورت عدم وجود یک ProcessPoolExecutor با workers پروسه ساخته می‌شود
+        max_concurrency: حداکثر تبدیل‌های هم‌زمان (پیش‌فرض: دو برابر تعداد پروسه‌ها)
+        """
+        # مسیرهای مبدا و مقصد در تبدیل حافظه‌ای استفاده نمی‌شوند
+        self.converter = ImageConverterWeb(source_dir='.', output_dir='.', config=config)
+        if workers is not None:
+            self.converter.config['workers'] = workers
+        # محافظت در برابر decompression bomb در فایل‌های ارسالی کاربران
+        self.converter.apply_pixel_limit()
+        # EXIF/XMP سفارشی یک بار ساخته و همراه مبدل به worker ها منتقل می‌شود
+        self.converter.get_custom_metadata()
+
+        self.owns_executor = executor is None
+        if self.owns_executor:
+            workers = self.converter.get_worker_count()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(self.converter,))
+        else:
+            workers = getattr(executor, '_max_workers', None) or self.converter.get_worker_count()
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(max_concurrency or workers * 2)
+
+    async def convert_bytes(self, data, formats: List[str] = None, sizes: List[int] = None,
+                            widths: List[int] = None) -> Dict[str, Dict]:
+        """
+        تبدیل تصویر در حافظه بدون مسدود کردن event loop
+
+        پارامترها و خروجی مانند ImageConverterWeb.convert_bytes.
+        لغو (cancel) درخواستی که هنوز شروع نشده، آن را از صف حذف می‌کند؛
+        تبدیلی که در حال اجراست تا پایان ادامه می‌یابد و نتیجه‌ی آن دور ریخته می‌شود.
+        جای درخواست در semaphore تا پایان واقعی کار در executor (حتی پس از لغو) نگه داشته می‌شود
+        تا تعداد تبدیل‌های در حال اجرا از max_concurrency بیشتر نشود.
+        """
+        # memoryview و bytearray به پروسه‌ی دیگر منتقل نمی‌شوند
+        data = bytes(data)
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        if self.owns_executor:
+            task = partial(_convert_bytes_in_worker, data, formats, sizes, widths)
+        else:
+            task = partial(self.converter.convert_bytes, data, formats, sizes, widths)
+        try:
+            future = self.executor.submit(task)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(partial(self._release_slot, loop))
+        # لغو انتظار، کار شروع‌نشده را هم لغو می‌کند؛ کار در حال اجرا با پایان خود جا را آزاد می‌کند
+        return await asyncio.wrap_future(future, loop=loop)
+
+    def _release_slot(self, loop: asyncio.AbstractEventLoop, future):
+        """آزاد کردن جای semaphore پس از پایان کار در executor (از هر thread)"""
+        try:
+            loop.call_soon_threadsafe(self.semaphore.release)
+        except RuntimeError:
+            # event loop بسته شده است
+            pass
+
+    async def close(self):
+        """بستن executor ساخته شده (executor مشترک بیرونی بسته نمی‌شود)"""
+        if self.owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
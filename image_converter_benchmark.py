@@ -0,0 +1,320 @@
+import os
+import sys
+import time
+import json
+import shutil
+import random
+import tempfile
+import platform
+import argparse
+from pathlib import Path
+from typing import Dict, List
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from image_converter_v2 import ImageConverterWeb
+
+try:
+    import resource
+except ImportError:
+    # ویندوز: اندازه‌گیری حافظه در دسترس نیست
+    resource = None
+
+
+# اندازه‌های پیکره‌ی آزمایشی (از آیکون تا عکس 50 مگاپیکسلی)
+CORPUS_SIZES = {
+    'icon': (64, 64),
+    'small': (640, 480),
+    'hd': (1920, 1080),
+    '12mp': (4000, 3000),
+    '50mp': (8660, 5774),
+}
+
+# ترکیب‌های فرمت مبدا و mode (فقط ترکیب‌هایی که هر فرمت پشتیبانی می‌کند)
+CORPUS_SOURCES = [
+    ('JPEG', 'RGB'),
+    ('PNG', 'RGB'),
+    ('PNG', 'RGBA'),
+    ('PNG', 'P'),
+    ('TIFF', 'RGB'),
+    ('TIFF', 'RGBA'),
+    ('GIF', 'P'),
+]
+
+SOURCE_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'TIFF': '.tiff', 'GIF': '.gif'}
+
+# EXIF نمونه برای مرحله add_custom_exif
+BENCH_EXIF = {
+    'Artist': 'Benchmark',
+    'Copyright': '© Benchmark',
+    'Software': 'Image Converter Web',
+    'Make': '',
+    'Model': '',
+    'ImageDescription': 'تصویر آزمایشی',
+    'XPComment': 'کامنت',
+    'XPKeywords': 'تست، بنچمارک',
+    'XPSubject': 'بنچمارک',
+    'Website': 'https://example.com',
+}
+
+
+def make_synthetic_image(size: tuple, mode: str, seed: int) -> Image.Image:
+    """ساخت تصویر مصنوعی شبیه عکس (گرادیان + نویز + اشکال) بدون نیاز به شبکه"""
+    rng = random.Random(seed)
+    width, height = size
+    gradient = Image.linear_gradient('L').resize(size)
+    noise = Image.effect_noise(size, 48)
+    shapes = Image.new('L', size, 0)
+    # چند مستطیل با رنگ ثابت برای نواحی صاف
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = min(width, x0 + rng.randrange(1, width // 2 + 2)), min(height, y0 + rng.randrange(1, height // 2 + 2))
+        shapes.paste(rng.randrange(256), (x0, y0, x1, y1))
+    image = Image.merge('RGB', (gradient, noise, shapes))
+
+    if mode == 'RGBA':
+        alpha = Image.linear_gradient('L').rotate(90).resize(size)
+        image.putalpha(alpha)
+    elif mode == 'P':
+        image = image.convert('P', palette=Image.Palette.ADAPTIVE, colors=64)
+    return image
+
+
+def generate_corpus(corpus_dir: Path, size_names: List[str]) -> List[Dict]:
+    """ساخت (یا استفاده‌ی مجدد از) پیکره‌ی تصاویر آزمایشی"""
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    corpus = []
+    for size_name in size_names:
+        size = CORPUS_SIZES[size_name]
+        for index, (format_name, mode) in enumerate(CORPUS_SOURCES):
+            path = corpus_dir / f"{size_name}_{mode.lower()}{SOURCE_EXTENSIONS[format_name]}"
+            if not path.exists():
+                image = make_synthetic_image(size, mode, seed=index)
+                image.save(path, format_name)
+            corpus.append({
+                'name': path.name,
+                'path': str(path),
+                'format': format_name,
+                'mode': mode,
+                'width': size[0],
+                'height': size[1],
+                'bytes': path.stat().st_size,
+            })
+    return corpus
+
+
+def get_peak_rss_mb() -> float:
+    """حداکثر حافظه‌ی مقیم پروسه (MB)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # لینوکس: کیلوبایت، macOS: بایت
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def make_converter(output_dir: Path, format_name: str) -> ImageConverterWeb:
+    """مبدل با تنظیمات پیش‌فرض و فرمت خروجی مشخص"""
+    converter = ImageConverterWeb(source_dir=str(output_dir), output_dir=str(output_dir))
+    converter.output_format = format_name
+    converter.config['custom_exif'] = dict(BENCH_EXIF)
+    return converter
+
+
+def run_stage(stage: str, format_name: str, corpus: List[Dict], repeat: int, work_dir: str) -> Dict:
+    """
+    اجرای یک مرحله روی کل پیکره (در پروسه‌ی جداگانه برای اندازه‌گیری مستقل حافظه)
+
+    فقط زمان خود مرحله اندازه‌گیری می‌شود؛ آماده‌سازی ورودی (مثلاً رمزگشایی برای resize) خارج از زمان‌سنجی است.
+    """
+    work_dir = Path(work_dir)
+    # خروجی‌های چاپی مبدل در بنچمارک لازم نیست
+    sys.stdout = open(os.devnull, 'w')
+    converter = make_converter(work_dir, format_name or 'JPEG')
+
+    elapsed = 0.0
+    processed = 0
+    source_bytes = 0
+    output_bytes = 0
+    errors = 0
+    # تصاویری که این مرحله روی آن‌ها کاری انجام نمی‌دهد (مثلاً بدون نیاز به تغییر اندازه)
+    skipped = 0
+
+    for _ in range(repeat):
+        for item in corpus:
+            path = Path(item['path'])
+            try:
+                if stage == 'decode':
+                    start = time.perf_counter()
+                    with Image.open(path) as img:
+                        img.load()
+                    elapsed += time.perf_counter() - start
+
+                elif stage in ('resize_image', 'optimize_image', 'add_custom_exif'):
+                    with Image.open(path) as img:
+                        if stage == 'resize_image' and converter.get_target_size(*img.size) is None:
+                            # فقط تغییر اندازه‌های واقعی زمان‌سنجی می‌شوند
+                            skipped += 1
+                            continue
+                        img.load()
+                        if stage == 'add_custom_exif':
+                            img = converter.resize_image(img)
+                        start = time.perf_counter()
+                        getattr(converter, stage)(img)
+                        elapsed += time.perf_counter() - start
+
+                elif stage == 'convert_image':
+                    output_path = work_dir / f"{path.stem}{converter.get_output_extension(format_name)}"
+                    start = time.perf_counter()
+                    ok = converter.convert_image(path, output_path, format_name)
+                    duration = time.perf_counter() - start
+                    # زمان تبدیل‌های ناموفق در سرعت مرحله حساب نمی‌شود
+                    if not ok:
+                        errors += 1
+                        continue
+                    elapsed += duration
+                    output_bytes += output_path.stat().st_size
+
+                elif stage == 'create_thumbnail':
+                    start = time.perf_counter()
+                    converter.create_thumbnail(path, work_dir, 300, format_name)
+                    duration = time.perf_counter() - start
+                    thumb_path = converter.get_thumbnail_path(path.stem, work_dir, 300, format_name)
+                    if not thumb_path.exists():
+                        errors += 1
+                        continue
+                    elapsed += duration
+                    output_bytes += thumb_path.stat().st_size
+                    thumb_path.unlink()
+
+                processed += 1
+                source_bytes += item['bytes']
+            except Exception:
+                errors += 1
+
+    megabytes = source_bytes / (1024 * 1024)
+    return {
+        'stage': stage,
+        'format': format_name,
+        'images': processed,
+        'skipped': skipped,
+        'errors': errors,
+        'seconds': round(elapsed, 4),
+        'images_per_sec': round(processed / elapsed, 2) if elapsed else None,
+        'mb_per_sec': round(megabytes / elapsed, 2) if elapsed else None,
+        'output_bytes': output_bytes,
+        'peak_rss_mb': get_peak_rss_mb(),
+    }
+
+
+def run_benchmark(corpus: List[Dict], formats: List[str], repeat: int, work_dir: Path) -> List[Dict]:
+    """اجرای همه‌ی مراحل، هر مرحله در یک پروسه‌ی تازه"""
+    stages = [('decode', None), ('resize_image', None), ('optimize_image', None), ('add_custom_exif', None)]
+    for format_name in formats:
+        stages.append(('convert_image', format_name))
+        stages.append(('create_thumbnail', format_name))
+
+    results = []
+    for stage, format_name in stages:
+        label = f"{stage}[{format_name}]" if format_name else stage
+        print(f"  ... {label}", flush=True)
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(run_stage, stage, format_name, corpus, repeat, str(work_dir)).result()
+        result['name'] = label
+        results.append(result)
+    return results
+
+
+def get_corpus_id(size_names: List[str], repeat: int) -> Dict:
+    """شناسه‌ی پیکره برای مقایسه‌ی معتبر دو اجرا (اندازه‌ها، ترکیب‌های مبدا و تعداد تکرار)"""
+    return {
+        'sizes': {name: list(CORPUS_SIZES[name]) for name in size_names},
+        'sources': [list(source) for source in CORPUS_SOURCES],
+        'repeat': repeat,
+    }
+
+
+def print_results(results: List[Dict], baseline: Dict = None):
+    """نمایش جدول نتایج (و نسبت به اجرای قبلی در صورت وجود)"""
+    previous = {item['name']: item for item in (baseline or {}).get('stages', [])}
+    print("\n" + "=" * 88)
+    header = f"{'مرحله':<28}{'تصویر/ثانیه':>14}{'MB/ثانیه':>12}{'زمان (s)':>12}{'RSS (MB)':>10}{'خطا':>6}"
+    if previous:
+        header += f"{'نسبت':>8}"
+    print(header)
+    print("-" * 88)
+    for item in results:
+        line = (f"{item['name']:<28}{item['images_per_sec'] or 0:>14.2f}{item['mb_per_sec'] or 0:>12.2f}"
+                f"{item['seconds']:>12.3f}{item['peak_rss_mb'] or 0:>10.1f}{item['errors']:>6}")
+        old = previous.get(item['name'])
+        if old and old.get('images_per_sec') and item['images_per_sec']:
+            line += f"{item['images_per_sec'] / old['images_per_sec']:>7.2f}x"
+        print(line)
+    print("=" * 88)
+    for item in results:
+        if item.get('skipped'):
+            print(f"{item['name']}: {item['skipped']} تصویر بدون نیاز به این مرحله اندازه‌گیری نشد")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='بنچمارک مراحل اصلی مبدل تصاویر وب')
+    parser.add_argument('--corpus-dir', help='مسیر نگهداری پیکره‌ی آزمایشی (پیش‌فرض: دایرکتوری موقت)')
+    parser.add_argument('--sizes', nargs='+', choices=list(CORPUS_SIZES), default=list(CORPUS_SIZES),
+                        help='اندازه‌های پیکره')
+    parser.add_argument('--formats', nargs='+', choices=['AVIF', 'WebP', 'JPEG'], default=['AVIF', 'WebP', 'JPEG'],
+                        help='فرمت‌های خروجی')
+    parser.add_argument('--repeat', type=int, default=1, help='تعداد تکرار هر مرحله')
+    parser.add_argument('--output', help='ذخیره نتایج در فایل JSON')
+    parser.add_argument('--compare', help='مقایسه با نتایج JSON قبلی')
+    args = parser.parse_args()
+
+    temp_root = tempfile.mkdtemp(prefix='image_converter_bench_')
+    try:
+        corpus_dir = Path(args.corpus_dir) if args.corpus_dir else Path(temp_root) / 'corpus'
+        work_dir = Path(temp_root) / 'work'
+        work_dir.mkdir()
+
+        print(f"ساخت پیکره‌ی آزمایشی در {corpus_dir} ...")
+        corpus = generate_corpus(corpus_dir, args.sizes)
+        print(f"تعداد تصاویر: {len(corpus)} ({sum(item['bytes'] for item in corpus) / (1024 * 1024):.1f} MB)")
+
+        print("اجرای مراحل:")
+        results = run_benchmark(corpus, args.formats, args.repeat, work_dir)
+    finally:
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+    corpus_id = get_corpus_id(args.sizes, args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        # نسبت سرعت روی پیکره‌ی متفاوت معنایی ندارد
+        if baseline.get('meta', {}).get('corpus_id') != corpus_id:
+            print(f"⚠ پیکره‌ی {args.compare} با این اجرا یکسان نیست (اندازه‌ها، مبداها یا تکرار)؛ مقایسه انجام نشد")
+            baseline = None
+    print_results(results, baseline)
+
+    if args.output:
+        import PIL
+        report = {
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'pillow': PIL.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'repeat': args.repeat,
+                'corpus_id': corpus_id,
+            },
+            'corpus': [{key: value for key, value in item.items() if key != 'path'} for item in corpus],
+            'stages': results,
+        }
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"نتایج در {args.output} ذخیره شد")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import io
+import json
+import argparse
+import threading
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, UnidentifiedImageError
+
+from image_converter_v2 import (ImageConverterWeb, RenderCache, RENDER_CACHE_DIR, parse_size,
+                                _init_worker, _encode_converted_in_worker)
+
+
+# فرمت‌های خروجی به ترتیب اولویت (از بهترین فشرده‌سازی)
+SERVE_FORMATS = ['AVIF', 'WebP', 'JPEG']
+
+# مقدار fmt در query -> فرمت خروجی
+FORMAT_NAMES = {'avif': 'AVIF', 'webp': 'WebP', 'jpeg': 'JPEG', 'jpg': 'JPEG'}
+
+MIME_TYPES = {'AVIF': 'image/avif', 'WebP': 'image/webp', 'JPEG': 'image/jpeg'}
+
+# مسیر پیش‌فرض کش خروجی‌های سرور
+SERVE_CACHE_DIR = RENDER_CACHE_DIR.parent / 'serve'
+
+# هر چند خروجی جدید یک بار حد حجم کش اعمال می‌شود
+PRUNE_INTERVAL = 100
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    سرور HTTP تبدیل تصاویر در لحظه‌ی درخواست (به جای ساخت همه‌ی پله‌ها از پیش)
+
+    آدرس‌هایی مانند /img/<مسیر>?w=640&fmt=webp نسبت به source_dir خوانده و با همان منطق
+    encode_converted در pool پروسه‌ها تبدیل می‌شوند. درخواست‌های یکسان هم‌زمان یک انکود مشترک دارند و
+    خروجی‌ها در کش دیسک ذخیره می‌شوند؛ کلید کش از stat فایل مبدا ساخته می‌شود، پس درخواست تکراری فقط
+    یک stat و یک خواندن فایل است و با If-None-Match فقط یک stat.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], converter: ImageConverterWeb, executor: ProcessPoolExecutor,
+                 cache: RenderCache, max_age: int = 3600, widths: List[int] = None):
+        """
+        converter: مبدل با تنظیمات نهایی (همان نسخه‌ای که به worker ها داده شده)
+        executor: pool پروسه‌ها که با _init_worker و همین converter ساخته شده است
+        cache: کش دیسک خروجی‌ها
+        max_age: مدت اعتبار پاسخ در کش مرورگر و CDN (ثانیه)
+        widths: عرض‌های مجاز w (خالی = هر عرضی تا max_width)
+        """
+        super().__init__(address, ConversionRequestHandler)
+        self.converter = converter
+        self.executor = executor
+        self.cache = cache
+        self.max_age = max_age
+        self.widths = set(widths or [])
+        self.source_root = converter.source_dir.resolve()
+
+        # فرمت‌هایی که encoder آن‌ها موجود است
+        self.formats = SERVE_FORMATS[SERVE_FORMATS.index(converter.output_format):]
+        # تنظیمات مؤثر بر خروجی هر فرمت (یک بار محاسبه می‌شود)
+        fingerprint = converter.get_config_fingerprint()
+        self.settings = {
+            format_name: {
+                'pillow': Image.__version__,
+                'format': format_name,
+                'config': fingerprint,
+                'save_params': converter.get_save_params(format_name),
+            }
+            for format_name in self.formats
+        }
+
+        # کلید کش -> Future انکود در حال اجرا
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'not_modified': 0, 'errors': 0}
+        self.new_entries = 0
+
+    def count(self, name: str):
+        """افزایش یک شمارنده‌ی آمار (از thread های مختلف)"""
+        with self.lock:
+            self.stats[name] += 1
+
+    def resolve_source(self, relative: str) -> Path:
+        """مسیر فایل مبدا داخل source_dir (None برای مسیر خارج از آن، پسوند نامعتبر یا فایل ناموجود)"""
+        try:
+            path = (self.source_root / relative).resolve()
+        except (OSError, ValueError):
+            return None
+        if not path.is_relative_to(self.source_root):
+            return None
+        if path.suffix.lower() not in self.converter.supported_formats or not path.is_file():
+            return None
+        return path
+
+    def choose_format(self, requested: str, accept: str) -> Tuple[str, bool]:
+        """
+        فرمت خروجی از fmt یا در صورت نبود آن از هدر Accept
+
+        خروجی: (فرمت، آیا از Accept انتخاب شده) — ValueError برای فرمت ناشناخته یا بدون encoder
+        """
+        if requested:
+            format_name = FORMAT_NAMES.get(requested.lower())
+            if format_name not in self.formats:
+                raise ValueError(f"فرمت پشتیبانی نمی‌شود: {requested}")
+            return format_name, False
+        accept = accept.lower()
+        for format_name in self.formats:
+            if format_name == 'JPEG' or MIME_TYPES[format_name] in accept:
+                return format_name, True
+        return 'JPEG', True
+
+    def parse_width(self, value: str) -> int:
+        """عرض درخواستی (None = اندازه‌ی کامل) — ValueError برای مقدار نامعتبر یا غیرمجاز"""
+        if value is None:
+            return None
+        try:
+            width = int(value)
+        except ValueError:
+            raise ValueError(f"عرض نامعتبر است: {value}")
+        if width <= 0 or (self.widths and width not in self.widths):
+            raise ValueError(f"عرض مجاز نیست: {value}")
+        # عرض‌های بزرگ‌تر از max_width همان خروجی کامل هستند؛ یک کلید کش مشترک دارند
+        config = self.converter.config
+        if config['optimize_for_web'] and width >= config['max_width']:
+            return None
+        return width
+
+    def get_key(self, path: Path, format_name: str, width: int) -> str:
+        """کلید کش از مسیر، اندازه و زمان تغییر مبدا (بدون خواندن محتوای آن) و تنظیمات خروجی"""
+        stat = path.stat()
+        source = f"{path.relative_to(self.source_root).as_posix()}:{stat.st_size}:{stat.st_mtime_ns}"
+        return self.cache.make_key(source, {**self.settings[format_name], 'width': width})
+
+    def get_or_encode(self, key: str, path: Path, format_name: str, width: int) -> io.BytesIO:
+        """خروجی از کش؛ در غیر این صورت انکود در pool (درخواست‌های هم‌زمان با همین کلید منتظر همان انکود می‌مانند)"""
+        buffer = self.cache.get(key)
+        if buffer is not None:
+            self.count('hits')
+            return buffer
+
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            # انکود دیگری ممکن است بین بررسی کش و گرفتن قفل تمام شده باشد
+            if owner and self.cache.get_path(key).exists():
+                future = None
+            elif owner:
+                future = self.executor.submit(_encode_converted_in_worker, str(path), format_name, width)
+                self.in_flight[key] = future
+        if future is None:
+            return self.get_or_encode(key, path, format_name, width)
+        if not owner:
+            self.count('coalesced')
+            return io.BytesIO(future.result())
+
+        try:
+            buffer = io.BytesIO(future.result())
+            self.cache.put(key, buffer)
+        finally:
+            with self.lock:
+                # کش پیش از حذف از in_flight نوشته می‌شود تا درخواست بعدی دوباره انکود نکند
+                del self.in_flight[key]
+
+        with self.lock:
+            self.stats['misses'] += 1
+            self.new_entries += 1
+            prune = self.new_entries % PRUNE_INTERVAL == 0
+        if prune:
+            self.cache.prune()
+        return buffer
+
+
+class ConversionRequestHandler(BaseHTTPRequestHandler):
+    """پاسخ به GET/HEAD برای /img/<مسیر> و /stats"""
+
+    server_version = 'ImageConverterWeb'
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def handle_request(self, send_body: bool):
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            with self.server.lock:
+                body = json.dumps({**self.server.stats, 'in_flight': len(self.server.in_flight)}).encode('utf-8')
+            self.send_body(200, body, {'Content-Type': 'application/json', 'Cache-Control': 'no-store'}, send_body)
+            return
+        if not url.path.startswith('/img/'):
+            self.send_error(404)
+            return
+
+        query = parse_qs(url.query)
+        try:
+            format_name, negotiated = self.server.choose_format(query.get('fmt', [None])[0],
+                                                                self.headers.get('Accept', ''))
+            width = self.server.parse_width(query.get('w', [None])[0])
+        except ValueError as e:
+            self.send_error(400, explain=str(e))
+            return
+
+        path = self.server.resolve_source(unquote(url.path[len('/img/'):]))
+        try:
+            key = self.server.get_key(path, format_name, width) if path is not None else None
+        except OSError:
+            key = None
+        if key is None:
+            self.send_error(404)
+            return
+
+        etag = f'"{key[:32]}"'
+        headers = {'ETag': etag, 'Cache-Control': f'public, max-age={self.server.max_age}'}
+        if negotiated:
+            headers['Vary'] = 'Accept'
+        if self.matches_etag(etag):
+            self.server.count('not_modified')
+            self.send_body(304, b'', headers, False)
+            return
+
+        try:
+            buffer = self.server.get_or_encode(key, path, format_name, width)
+        except Image.DecompressionBombError as e:
+            self.server.count('errors')
+            self.send_error(413, explain=self.server.converter.describe_bomb_error(e))
+            return
+        except UnidentifiedImageError as e:
+            self.server.count('errors')
+            self.send_error(415, explain=str(e))
+            return
+        except Exception as e:
+            self.server.count('errors')
+            self.log_error("خطا در تبدیل %s: %s", path, e)
+            self.send_error(500, explain=str(e))
+            return
+
+        headers['Content-Type'] = MIME_TYPES[format_name]
+        self.send_body(200, buffer.getvalue(), headers, send_body)
+
+    def matches_etag(self, etag: str) -> bool:
+        """بررسی If-None-Match (ETag ضعیف هم برای GET پذیرفته می‌شود)"""
+        header = self.headers.get('If-None-Match')
+        if not header:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+    def send_body(self, status: int, body: bytes, headers: Dict[str, str], send_body: bool):
+        """ارسال پاسخ با هدرها و Content-Length (بدنه فقط برای GET)"""
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body and body:
+            self.wfile.write(body)
+
+
+def serve_main(argv: List[str]):
+    """زیرفرمان serve: سرور HTTP تبدیل تصاویر در لحظه‌ی درخواست"""
+    parser = argparse.ArgumentParser(prog='image_converter_v2.py serve',
+                                     description='سرور HTTP تبدیل تصاویر در لحظه‌ی درخواست')
+    parser.add_argument('source', help='مسیر فولدر مبدا')
+    parser.add_argument('--host', default='127.0.0.1', help='آدرس گوش دادن (پیش‌فرض: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='پورت (پیش‌فرض: 8080)')
+    parser.add_argument('--workers', type=int, default=None, help='تعداد پروسه‌های تبدیل (پیش‌فرض: تعداد هسته‌های CPU)')
+    parser.add_argument('--config', help='مسیر فایل تنظیمات JSON')
+    parser.add_argument('--widths', nargs='+', type=int, help='عرض‌های مجاز w (پیش‌فرض: srcset_widths تنظیمات؛ خالی = هر عرضی)')
+    parser.add_argument('--cache-dir', default=str(SERVE_CACHE_DIR), help='مسیر کش خروجی‌ها')
+    parser.add_argument('--cache-size', default='1G', help='حداکثر حجم کش (مثلاً 500M یا 10G)')
+    parser.add_argument('--max-age', type=int, default=3600, help='مدت اعتبار پاسخ در کش مرورگر و CDN (ثانیه)')
+    args = parser.parse_args(argv)
+
+    try:
+        cache_size = parse_size(args.cache_size)
+    except ValueError:
+        print("خطا: حد حجم نامعتبر است (مثال: 500M یا 10G)")
+        return
+    if not Path(args.source).is_dir():
+        print(f"دایرکتوری مبدا یافت نشد: {args.source}")
+        return
+
+    # خروجی‌ها روی دیسک نوشته نمی‌شوند؛ output_dir استفاده نمی‌شود
+    converter = ImageConverterWeb(source_dir=args.source, output_dir=args.source)
+    if args.config:
+        converter.load_config(args.config)
+    if args.workers is not None:
+        converter.config['workers'] = args.workers
+    # کش سرور با stat مبدا کار می‌کند؛ کش رندر (با hash محتوا) در worker ها لازم نیست
+    converter.config['render_cache'] = None
+    converter.render_cache = None
+    converter.apply_pixel_limit()
+    # EXIF/XMP سفارشی یک بار ساخته و همراه مبدل به worker ها منتقل می‌شود
+    converter.get_custom_metadata()
+
+    cache = RenderCache(args.cache_dir, cache_size)
+    removed, freed = cache.prune()
+    if removed:
+        print(f"کش: {removed} فایل قدیمی ({freed / (1024 * 1024):.1f} MB) حذف شد")
+
+    workers = converter.get_worker_count()
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(converter,))
+    try:
+        # worker ها پیش از thread های سرور ساخته می‌شوند (fork در حضور thread امن نیست)
+        executor.submit(int).result()
+        server = ConversionServer((args.host, args.port), converter, executor, cache, args.max_age,
+                                  args.widths or converter.config['srcset_widths'])
+        print(f"سرور تبدیل تصاویر با {workers} پروسه: http://{args.host}:{args.port}/img/<مسیر>?w=640&fmt=webp")
+        print(f"مبدا: {server.source_root} | کش: {cache.cache_dir} | فرمت‌ها: {', '.join(server.formats)}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("\nتوقف سرور")
+        finally:
+            server.server_close()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
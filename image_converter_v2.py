@@ -1,12 +1,546 @@
 import os
+import io
+import re
+import sys
 import shutil
+import hashlib
+import heapq
+import bisect
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageChops, ImageFilter, ImageMath
 from PIL.ExifTags import TAGS
 import argparse
-from typing import Dict, List, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
 import json
+import time
+import queue
+import signal
+import socket
+import threading
+from collections import deque
 from datetime import datetime
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    # ویندوز: کپی copy-on-write (reflink) در دسترس نیست
+    fcntl = None
+
+@contextmanager
+def measure(timings: Dict[str, float], stage: str):
+    """جمع زدن زمان اجرای یک مرحله در timings (در صورت None کاری نمی‌کند)"""
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+class ConversionMetrics:
+    """
+    جمع‌آوری زمان مراحل تبدیل به‌صورت هیستوگرام و کندترین فایل‌ها
+    """
+    
+    # مرزهای هیستوگرام (ثانیه)، مشابه bucket های Prometheus
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+    
+    def __init__(self, slowest_count: int = 10):
+        self.slowest_count = slowest_count
+        self.file_count = 0
+        # stage -> {'count', 'sum', 'max', 'buckets'}؛ آخرین bucket برای مقادیر بزرگ‌تر از همه‌ی مرزهاست
+        self.stages = {}
+        # (زمان کل، مسیر، زمان مراحل) به‌صورت min-heap
+        self.slowest = []
+    
+    def observe(self, stage: str, seconds: float):
+        """ثبت زمان یک مرحله برای یک فایل"""
+        data = self.stages.get(stage)
+        if data is None:
+            data = self.stages[stage] = {'count': 0, 'sum': 0.0, 'max': 0.0,
+                                         'buckets': [0] * (len(self.BUCKETS) + 1)}
+        data['count'] += 1
+        data['sum'] += seconds
+        data['max'] = max(data['max'], seconds)
+        data['buckets'][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+    
+    def add_file(self, relative_path: str, timings: Dict[str, float]):
+        """ثبت زمان‌های یک فایل"""
+        if not timings:
+            return
+        self.file_count += 1
+        for stage, seconds in timings.items():
+            self.observe(stage, seconds)
+        
+        entry = (timings.get('total', 0.0), relative_path, dict(timings))
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, entry)
+        elif entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+    
+    def get_slowest(self) -> List[Tuple[float, str, Dict[str, float]]]:
+        """کندترین فایل‌ها از کندترین به سریع‌ترین"""
+        return sorted(self.slowest, key=lambda item: item[0], reverse=True)
+    
+    def print_summary(self):
+        """نمایش زمان مراحل، توزیع زمان هر فایل و کندترین فایل‌ها"""
+        print("\nزمان مراحل (برای هر فایل):")
+        print(f"  {'مرحله':<20}{'تعداد':>8}{'کل (s)':>10}{'میانگین (ms)':>14}{'بیشینه (ms)':>13}")
+        for stage, data in sorted(self.stages.items(), key=lambda item: -item[1]['sum']):
+            mean = data['sum'] / data['count'] * 1000
+            print(f"  {stage:<20}{data['count']:>8}{data['sum']:>10.2f}{mean:>14.1f}{data['max'] * 1000:>13.1f}")
+        
+        total = self.stages.get('total')
+        if total:
+            print("\nتوزیع زمان کل هر فایل:")
+            peak = max(total['buckets'])
+            lower = 0.0
+            for bound, count in zip(self.BUCKETS + (float('inf'),), total['buckets']):
+                if count:
+                    bar = '█' * max(1, round(count / peak * 30))
+                    print(f"  {lower:>6g}s - {bound:<6g}s {count:>7} {bar}")
+                lower = bound
+        
+        if self.slowest:
+            print("\nکندترین فایل‌ها:")
+            for seconds, relative_path, timings in self.get_slowest():
+                stages = {stage: value for stage, value in timings.items() if stage != 'total'}
+                slowest_stage = max(stages, key=stages.get) if stages else '-'
+                print(f"  {seconds:8.2f}s  {relative_path}  (بیشترین: {slowest_stage})")
+    
+    def to_dict(self) -> Dict:
+        """گزارش قابل ذخیره به‌صورت JSON"""
+        return {
+            'files': self.file_count,
+            'buckets': list(self.BUCKETS),
+            'stages': self.stages,
+            'slowest': [
+                {'path': relative_path, 'seconds': seconds, 'timings': timings}
+                for seconds, relative_path, timings in self.get_slowest()
+            ],
+        }
+    
+    def to_prometheus(self, stats: Dict) -> str:
+        """خروجی متنی Prometheus برای textfile collector"""
+        lines = [
+            '# HELP image_converter_stage_seconds Time spent per file in each conversion stage.',
+            '# TYPE image_converter_stage_seconds histogram',
+        ]
+        for stage, data in sorted(self.stages.items()):
+            # مراحل انکود با برچسب format جدا می‌شوند
+            name, _, format_name = stage.partition(':')
+            labels = f'stage="{name}"' + (f',format="{format_name}"' if format_name else '')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, data['buckets']):
+                cumulative += count
+                lines.append(f'image_converter_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'image_converter_stage_seconds_bucket{{{labels},le="+Inf"}} {data["count"]}')
+            lines.append(f'image_converter_stage_seconds_sum{{{labels}}} {data["sum"]:.6f}')
+            lines.append(f'image_converter_stage_seconds_count{{{labels}}} {data["count"]}')
+        
+        lines += [
+            '# HELP image_converter_files Files handled in the last run.',
+            '# TYPE image_converter_files gauge',
+            f'image_converter_files{{result="discovered"}} {stats["total_files"]}',
+            f'image_converter_files{{result="converted"}} {stats["converted_files"]}',
+            f'image_converter_files{{result="failed"}} {stats["failed_files"]}',
+            f'image_converter_files{{result="skipped"}} {stats["skipped_files"]}',
+            '# HELP image_converter_bytes Total bytes before and after conversion in the last run.',
+            '# TYPE image_converter_bytes gauge',
+            f'image_converter_bytes{{kind="source"}} {stats["total_size_before"]}',
+            f'image_converter_bytes{{kind="output"}} {stats["total_size_after"]}',
+            f'image_converter_bytes{{kind="webp"}} {stats["webp_size_after"]}',
+            '# HELP image_converter_last_run_timestamp_seconds Unix time of the last finished run.',
+            '# TYPE image_converter_last_run_timestamp_seconds gauge',
+            f'image_converter_last_run_timestamp_seconds {time.time():.0f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+class RenderCache:
+    """
+    کش دائمی خروجی‌های انکود شده روی دیسک، مشترک بین اجراها و درخت‌های خروجی
+    
+    کلید هر خروجی hash محتوای مبدا به همراه تنظیمات مؤثر بر خروجی است.
+    زمان تغییر هر فایل در هر بار استفاده به‌روز می‌شود و حذف بر اساس آن (LRU) انجام می‌شود.
+    """
+    
+    def __init__(self, cache_dir: Path, max_size: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+    
+    def make_key(self, content_hash: str, settings: Dict) -> str:
+        """کلید کش از hash مبدا و تنظیمات نرمال‌شده"""
+        data = json.dumps({'source': content_hash, **settings}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+    
+    def get_path(self, key: str) -> Path:
+        """مسیر فایل یک کلید (با زیردایرکتوری برای جلوگیری از دایرکتوری‌های خیلی بزرگ)"""
+        return self.cache_dir / key[:2] / key
+    
+    def get(self, key: str) -> io.BytesIO:
+        """خواندن خروجی از کش (None در صورت نبود)"""
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as f:
+                buffer = io.BytesIO(f.read())
+            # زمان آخرین استفاده برای LRU
+            os.utime(path)
+        except OSError:
+            return None
+        return buffer
+    
+    def put(self, key: str, buffer: io.BytesIO):
+        """ذخیره خروجی در کش (خطای کش باعث خطای تبدیل نمی‌شود)"""
+        path = self.get_path(key)
+        # نام موقت یکتا برای هر پروسه؛ os.replace در برابر نوشتن هم‌زمان worker ها امن است
+        tmp_path = path.with_name(f"{key}.{os.getpid()}.tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(buffer.getbuffer())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"خطا در ذخیره کش رندر: {str(e)}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    
+    def iter_entries(self) -> Iterator[os.DirEntry]:
+        """همه‌ی فایل‌های کش (بدون فایل‌های موقت)"""
+        if not self.cache_dir.is_dir():
+            return
+        with os.scandir(self.cache_dir) as shards:
+            for shard in shards:
+                if not shard.is_dir():
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for entry in entries:
+                        if entry.is_file() and not entry.name.endswith('.tmp'):
+                            yield entry
+    
+    def get_stats(self) -> Dict:
+        """تعداد و حجم فایل‌های کش"""
+        entries = 0
+        total_size = 0
+        oldest = newest = None
+        for entry in self.iter_entries():
+            stat = entry.stat()
+            entries += 1
+            total_size += stat.st_size
+            oldest = stat.st_mtime if oldest is None else min(oldest, stat.st_mtime)
+            newest = stat.st_mtime if newest is None else max(newest, stat.st_mtime)
+        return {
+            'path': str(self.cache_dir),
+            'entries': entries,
+            'bytes': total_size,
+            'max_bytes': self.max_size,
+            'oldest': datetime.fromtimestamp(oldest).isoformat(timespec='seconds') if oldest else None,
+            'newest': datetime.fromtimestamp(newest).isoformat(timespec='seconds') if newest else None,
+        }
+    
+    def prune(self, max_size: int = None) -> Tuple[int, int]:
+        """
+        حذف قدیمی‌ترین فایل‌ها (کمترین استفاده‌ی اخیر) تا حجم کش از حد کمتر شود
+        
+        خروجی: (تعداد فایل‌های حذف شده، حجم آزاد شده)
+        """
+        max_size = self.max_size if max_size is None else max_size
+        entries = []
+        total_size = 0
+        for entry in self.iter_entries():
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total_size += stat.st_size
+        
+        removed = 0
+        freed = 0
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+class WorkQueue:
+    """
+    صف کار مبتنی بر lease در یک دایرکتوری مشترک (مثلاً NFS) برای اجرای توزیع‌شده روی چند نود
+    
+    هر فایل با ساخت اتمیک یک فایل lease (O_EXCL) گرفته می‌شود و پس از پایان، نشانه‌ی done ثبت می‌شود.
+    lease ها در طول پردازش تمدید می‌شوند؛ lease نودی که از کار افتاده پس از lease_ttl ثانیه
+    منقضی می‌شود و نود دیگری آن فایل را می‌گیرد.
+    """
+    
+    def __init__(self, queue_dir: Path, lease_ttl: float = 300, node_id: str = None):
+        self.queue_dir = Path(queue_dir)
+        self.lease_ttl = lease_ttl
+        self.node_id = node_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.leases_dir = self.queue_dir / 'leases'
+        self.done_dir = self.queue_dir / 'done'
+        # lease های در اختیار این نود
+        self.held = set()
+        self.lock = threading.Lock()
+        self.heartbeat_stop = threading.Event()
+    
+    def open(self, fingerprint: str):
+        """ساخت ساختار صف یا بررسی این‌که صف موجود مربوط به همین تنظیمات است"""
+        self.leases_dir.mkdir(parents=True, exist_ok=True)
+        self.done_dir.mkdir(parents=True, exist_ok=True)
+        job_path = self.queue_dir / 'job.json'
+        try:
+            fd = os.open(job_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'config': fingerprint, 'created_by': self.node_id}, f)
+        except FileExistsError:
+            with open(job_path, 'r', encoding='utf-8') as f:
+                job = json.load(f)
+            if job['config'] != fingerprint:
+                raise ValueError(f"صف {self.queue_dir} برای تنظیمات دیگری ساخته شده است؛ برای کار جدید از دایرکتوری صف جدید استفاده کنید")
+    
+    def get_key(self, relative_path: str) -> str:
+        """نام فایل‌های صف برای یک مسیر نسبی"""
+        return hashlib.sha256(relative_path.encode('utf-8')).hexdigest()
+    
+    def is_done(self, key: str) -> bool:
+        """آیا فایل توسط یکی از نودها تمام شده است"""
+        return (self.done_dir / key).exists()
+    
+    def is_expired(self, path: Path) -> bool:
+        """آیا lease (یا قفل) از lease_ttl ثانیه پیش تمدید نشده است"""
+        try:
+            return time.time() - path.stat().st_mtime > self.lease_ttl
+        except FileNotFoundError:
+            return True
+    
+    def create_exclusive(self, path: Path, data: Dict) -> bool:
+        """ساخت اتمیک فایل فقط در صورت عدم وجود"""
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        return True
+    
+    def try_claim(self, key: str, relative_path: str) -> bool:
+        """گرفتن lease یک فایل؛ False اگر فایل تمام شده یا در اختیار نود زنده‌ی دیگری است"""
+        if self.is_done(key):
+            return False
+        lease_path = self.leases_dir / key
+        lease = {'node': self.node_id, 'source': relative_path}
+        if not self.create_exclusive(lease_path, lease):
+            if not self.is_expired(lease_path):
+                return False
+            # گرفتن lease منقضی زیر قفل جداگانه تا دو نود هم‌زمان آن را نگیرند
+            steal_path = self.leases_dir / f"{key}.steal"
+            if not self.create_exclusive(steal_path, lease):
+                if self.is_expired(steal_path):
+                    # قفل نودی که حین گرفتن lease از کار افتاده
+                    steal_path.unlink(missing_ok=True)
+                return False
+            try:
+                if not self.is_expired(lease_path):
+                    return False
+                tmp_path = self.leases_dir / f"{key}.{os.getpid()}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(lease, f, ensure_ascii=False)
+                os.replace(tmp_path, lease_path)
+            finally:
+                steal_path.unlink(missing_ok=True)
+        
+        # ممکن است نود قبلی بین بررسی و گرفتن lease کار را تمام کرده باشد
+        if self.is_done(key):
+            lease_path.unlink(missing_ok=True)
+            return False
+        with self.lock:
+            self.held.add(key)
+        return True
+    
+    def complete(self, key: str, failed: bool = False):
+        """ثبت پایان یک فایل و آزاد کردن lease آن"""
+        self.create_exclusive(self.done_dir / key, {'node': self.node_id, 'failed': failed})
+        with self.lock:
+            self.held.discard(key)
+        (self.leases_dir / key).unlink(missing_ok=True)
+    
+    def release_all(self):
+        """آزاد کردن lease های تمام‌نشده (مثلاً پس از توقف) تا نودهای دیگر بلافاصله آن‌ها را بگیرند"""
+        with self.lock:
+            keys, self.held = self.held, set()
+        for key in keys:
+            (self.leases_dir / key).unlink(missing_ok=True)
+    
+    def start_heartbeat(self):
+        """تمدید دوره‌ای lease های در اختیار این نود در یک thread پس‌زمینه"""
+        def heartbeat():
+            while not self.heartbeat_stop.wait(self.lease_ttl / 3):
+                with self.lock:
+                    keys = list(self.held)
+                for key in keys:
+                    try:
+                        os.utime(self.leases_dir / key)
+                    except FileNotFoundError:
+                        pass
+        
+        self.heartbeat_stop.clear()
+        threading.Thread(target=heartbeat, name='lease-heartbeat', daemon=True).start()
+    
+    def stop_heartbeat(self):
+        """توقف تمدید lease ها"""
+        self.heartbeat_stop.set()
+
+
+class AnimationFrames(Image.Image):
+    """
+    فریم‌های تبدیل‌شده‌ی یک تصویر متحرک به شکل تصویر چندفریمی برای save_all در WebP و AVIF
+    
+    encoder ها با seek فریم به فریم جلو می‌روند و هر فریم همان لحظه از مبدا خوانده و تبدیل می‌شود؛
+    حافظه مستقل از تعداد فریم‌ها فقط یک فریم مبدا و یک فریم مقصد است.
+    """
+    
+    def __init__(self, source: Image.Image, frames: List[int], convert_frame):
+        """
+        source: تصویر متحرک باز شده
+        frames: شماره‌ی فریم‌های مبدا که انکود می‌شوند
+        convert_frame: تبدیل هر فریم مبدا (تغییر اندازه و حذف شفافیت)
+        """
+        super().__init__()
+        self.source = source
+        self.frames = frames
+        self.convert_frame = convert_frame
+        self.n_frames = len(frames)
+        self.is_animated = self.n_frames > 1
+        self.position = None
+        self.seek(0)
+    
+    def seek(self, frame: int):
+        if not 0 <= frame < self.n_frames:
+            raise EOFError("no more frames")
+        if frame == self.position:
+            return
+        self.source.seek(self.frames[frame])
+        image = self.convert_frame(self.source)
+        self.im = image.im
+        self._mode = image.mode
+        self._size = image.size
+        self.position = frame
+    
+    def tell(self) -> int:
+        return self.position
+
+
+class OutputPlanner:
+    """
+    برنامه‌ریزی نام خروجی‌ها پیش از تبدیل
+    
+    نام خروجی همه‌ی فایل‌های یک دایرکتوری مبدا با هم محاسبه می‌شود تا دو مبدا (مثلاً «Photo 1.JPG» و
+    «photo-1.png») هرگز خروجی یکدیگر را بازنویسی نکنند. برخورد با همه‌ی فایل‌های هر مبدا (خروجی اصلی، thumbnail ها،
+    پله‌های srcset و JSON آن‌ها) بررسی و به ترتیب نام مبدا با پسوند عددی (-2، -3، ...) حل می‌شود، پس نتیجه مستقل از
+    ترتیب پیمایش و تعداد پروسه‌هاست. مقایسه بدون حساسیت به بزرگی و کوچکی حروف انجام می‌شود (فایل‌سیستم‌های macOS و Windows).
+    نام‌های ثبت‌شده در manifest اجرای قبل حفظ می‌شوند تا فایل جدید نام خروجی موجود را نگیرد.
+    
+    برنامه‌ی هر فایل هنگام ارسال آن برای تبدیل و برنامه‌ی هر دایرکتوری پس از آخرین فایل آن حذف می‌شود؛
+    حافظه فقط به دایرکتوری‌های در جریان بستگی دارد.
+    """
+    
+    def __init__(self, sanitize, get_filenames):
+        """
+        sanitize: تبدیل نام مبدا (بدون پسوند) به نام خروجی
+        get_filenames: نام همه‌ی فایل‌های خروجی یک مبدا از روی (نام خروجی، نام پایه‌ی thumbnail ها)
+        """
+        self.sanitize = sanitize
+        self.get_filenames = get_filenames
+        # دایرکتوری نسبی مبدا -> {نام فایل مبدا: (نام فایل خروجی، نام پایه‌ی thumbnail ها)}
+        self.plans = {}
+        # دایرکتوری‌های خروجی ساخته شده در این پروسه
+        self.created_dirs = set()
+    
+    def is_variant(self, name: str, base: str) -> bool:
+        """آیا name همان base یا base با پسوند عددی برخورد است"""
+        suffix = name[len(base) + 1:]
+        return name == base or (name.startswith(base + '-') and suffix.isdigit())
+    
+    def plan_directory(self, relative_dir: Path, filenames: List[str],
+                       previous: Dict[str, Tuple[str, str]] = None) -> List[Tuple[str, str]]:
+        """
+        محاسبه‌ی نام خروجی فایل‌های یک دایرکتوری مبدا
+        
+        previous: نام‌های اجرای قبل (از manifest) که در صورت سازگاری با تنظیمات فعلی حفظ می‌شوند
+        خروجی: فهرست (نام مبدا، نام خروجی جدید) برای فایل‌هایی که به دلیل برخورد تغییر نام یافتند
+        """
+        previous = previous or {}
+        entries = []
+        for filename in filenames:
+            stem = os.path.splitext(filename)[0]
+            natural = (self.sanitize(stem), stem)
+            names = previous.get(filename)
+            if names is None or not (self.is_variant(names[0], natural[0]) and self.is_variant(names[1], stem)):
+                names = None
+            entries.append((filename, natural, names))
+        # نام‌های اجرای قبل اول، سپس بقیه به ترتیب نام مبدا
+        entries.sort(key=lambda entry: (entry[2] is None, entry[0]))
+        
+        taken = set()
+        plan = {}
+        
+        def claim(filename: str, names: Tuple[str, str]) -> bool:
+            files = {name.casefold() for name in self.get_filenames(names)}
+            if not taken.isdisjoint(files):
+                return False
+            taken.update(files)
+            plan[filename] = names
+            return True
+        
+        # ابتدا نام اصلی همه‌ی فایل‌ها تا پسوند یک فایل نام اصلی فایل دیگری را نگیرد
+        deferred = [(filename, natural) for filename, natural, names in entries
+                    if not claim(filename, tuple(names or natural))]
+        
+        renamed = []
+        for filename, (name, stem) in deferred:
+            number = 2
+            # نام پایه‌ی thumbnail ها فقط در صورت برخورد آن‌ها تغییر می‌کند
+            while not (claim(filename, (f"{name}-{number}", stem)) or
+                       claim(filename, (f"{name}-{number}", f"{stem}-{number}"))):
+                number += 1
+            renamed.append((filename, plan[filename][0]))
+        if plan:
+            self.plans[relative_dir.as_posix()] = plan
+        return renamed
+    
+    def get(self, relative_path: Path) -> Tuple[str, str]:
+        """نام‌های برنامه‌ریزی شده‌ی یک فایل (None اگر دایرکتوری آن برنامه‌ریزی نشده باشد)"""
+        return self.plans.get(relative_path.parent.as_posix(), {}).get(relative_path.name)
+    
+    def pop(self, relative_path: Path) -> Tuple[str, str]:
+        """برداشتن نام‌های یک فایل هنگام ارسال آن (برنامه‌ی دایرکتوری پس از آخرین فایل حذف می‌شود)"""
+        directory = relative_path.parent.as_posix()
+        plan = self.plans.get(directory)
+        if plan is None:
+            return None
+        names = plan.pop(relative_path.name, None)
+        if not plan:
+            del self.plans[directory]
+        return names
+    
+    def make_dirs(self, directories: Iterator[Path]):
+        """ساخت دایرکتوری‌های خروجی، هر کدام فقط یک بار"""
+        for directory in directories:
+            if directory not in self.created_dirs:
+                directory.mkdir(parents=True, exist_ok=True)
+                self.created_dirs.add(directory)
+
 
 class ImageConverterWeb:
     """
@@ -26,9 +560,51 @@ class ImageConverterWeb:
             'total_size_before': 0,
             'total_size_after': 0,
             'webp_size_after': 0,
+            'skipped_files': 0,
+            'processed_files': 0,
+            'deduplicated_files': 0,
+            'encodes_saved': 0,
+            'render_cache_hits': 0,
+            'render_cache_misses': 0,
+            'passthrough_outputs': 0,
+            'renamed_outputs': 0,
+            'resumed_files': 0,
+            'other_node_files': 0,
+            # تعداد فایل‌ها در هر نوع محتوا (با --content-aware)
+            'content_classes': {},
             'failed_list': []
         }
         
+        # وضعیت حذف تکراری‌ها (فقط در پروسه‌ی اصلی استفاده می‌شود)
+        # اندازه -> اولین فایل با این اندازه که هنوز hash نشده (None پس از hash)
+        self.dedup_sizes = {}
+        # hash محتوا -> اولین فایل با این محتوا
+        self.dedup_hashes = {}
+        # فایل‌های اصلی که تبدیل آن‌ها ناموفق بوده
+        self.dedup_failed = set()
+        # مسیر نسبی -> نام‌های خروجی فایل‌های ارسال شده (برای ساخت خروجی تکراری‌های بعدی)
+        self.dedup_names = {}
+        self.scan_complete = True
+        
+        # درخواست توقف با SIGINT/SIGTERM: فایل جدیدی شروع نمی‌شود و تبدیل‌های در حال اجرا تمام می‌شوند
+        self.stop_requested = False
+        
+        # زمان‌سنجی مراحل تبدیل
+        self.metrics = ConversionMetrics()
+        
+        # manifest تبدیل‌های قبلی (مسیر نسبی مبدا -> رکورد) برای ساخت افزایشی
+        self.manifest = {}
+        
+        # کش دائمی خروجی‌ها (در صورت فعال بودن)
+        self.render_cache = self.get_render_cache()
+        self.config_fingerprint = None
+        
+        # EXIF/XMP سفارشی سریالایز شده (یک بار در هر اجرا)
+        self.custom_metadata = None
+        
+        # نام خروجی فایل‌ها (بدون برخورد) و دایرکتوری‌های خروجی ساخته شده
+        self.output_planner = OutputPlanner(self.sanitize_filename, self.get_output_filenames)
+        
         # فرمت‌های پشتیبانی شده
         self.supported_formats = {'.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.webp', '.gif'}
         
@@ -37,44 +613,16 @@ class ImageConverterWeb:
         
     def detect_best_format(self) -> str:
         """تشخیص بهترین فرمت خروجی بر اساس کتابخانه‌های موجود"""
+        capabilities = detect_codec_capabilities()
         
-        # تست AVIF
-        try:
-            # تست با pillow-heif
-            import pillow_heif
-            pillow_heif.register_heif_opener()
-            # تست ساخت تصویر AVIF
-            test_img = Image.new('RGB', (10, 10), color='red')
-            test_img.save('test_avif.avif', 'AVIF')
-            os.remove('test_avif.avif')
-            print("✓ AVIF پشتیبانی می‌شود")
-            return 'AVIF'
-        except:
-            pass
-            
-        try:
-            # تست مستقیم AVIF
-            test_img = Image.new('RGB', (10, 10), color='red')
-            test_img.save('test_avif.avif', 'AVIF')
-            os.remove('test_avif.avif')
+        if capabilities['format'] == 'AVIF':
             print("✓ AVIF پشتیبانی می‌شود")
-            return 'AVIF'
-        except:
-            pass
-        
-        # تست WebP
-        try:
-            test_img = Image.new('RGB', (10, 10), color='red')
-            test_img.save('test_webp.webp', 'WebP')
-            os.remove('test_webp.webp')
+        elif capabilities['format'] == 'WebP':
             print("✓ WebP استفاده می‌شود (فرمت دوم بهینه)")
-            return 'WebP'
-        except:
-            pass
-        
-        # در نهایت از JPEG استفاده کن
-        print("! از JPEG استفاده می‌شود (فرمت پایه)")
-        return 'JPEG'
+        else:
+            # در نهایت از JPEG استفاده کن
+            print("! از JPEG استفاده می‌شود (فرمت پایه)")
+        return capabilities['format']
     
     def get_default_config(self) -> Dict:
         """تنظیمات پیش‌فرض بهینه برای وب"""
@@ -95,7 +643,37 @@ class ImageConverterWeb:
             'create_webp': True,  # ایجاد نسخه WebP
             'webp_lossless': False,  # WebP بدون افت کیفیت
             'webp_method': 6,  # روش فشرده‌سازی WebP
+            'workers': None,  # تعداد پروسه‌های موازی (None = تعداد هسته‌های CPU)
+            'incremental': False,  # رد کردن فایل‌های بدون تغییر با manifest
+            'fast_decode': True,  # رمزگشایی با مقیاس کاهش‌یافته پیش از تغییر اندازه
+            'scan_queue_size': 1000,  # ظرفیت صف بین جستجوی فایل‌ها و تبدیل
+            'metrics_json': None,  # مسیر گزارش JSON زمان‌سنجی مراحل
+            'metrics_prometheus': None,  # مسیر فایل متنی Prometheus (textfile collector)
+            'target_ssim': None,  # هدف SSIM برای انتخاب کیفیت هر تصویر (مثلاً 0.95)
+            'time_budget': None,  # بودجه زمان انکود هر تصویر برای انتخاب speed/method (ثانیه)
+            'min_quality': 30,  # کمترین کیفیت مجاز در جستجوی کیفیت
+            'content_aware': False,  # انتخاب حالت انکود بر اساس نوع محتوا (گرافیک یا عکس)
+            'animation': True,  # تبدیل GIF/WebP متحرک به WebP/AVIF متحرک (False = فقط فریم اول)
+            'animated_thumbnails': True,  # thumbnail متحرک برای تصاویر متحرک (False = فریم اول)
+            'max_memory': None,  # بودجه حافظه برای کارهای هم‌زمان (بایت، None = بدون محدودیت)
+            'max_image_pixels': None,  # حد پیکسل‌های Pillow (None = پیش‌فرض Pillow، 0 = بدون محدودیت)
+            'render_cache': None,  # مسیر کش دائمی خروجی‌ها (None = غیرفعال)
+            'render_cache_size': 1024 ** 3,  # حداکثر حجم کش (بایت)
+            'srcset_widths': [],  # عرض پله‌های srcset (مثلاً [320, 640, 960, 1280, 1920])؛ خالی = غیرفعال
+            'deduplicate': False,  # یک بار انکود برای فایل‌های با محتوای یکسان
+            'dedup_link': 'hardlink',  # ساخت خروجی تکراری‌ها: hardlink یا copy
+            'size_guard': False,  # نگه داشتن مبدا به جای خروجی بزرگ‌تر و کپی مبدای بهینه بدون انکود
+            'passthrough_link': 'copy',  # ساخت خروجی‌های نگه داشته شده از مبدا: copy یا hardlink
+            'adaptive_proxy_size': 256,  # اندازه proxy برای آزمایش انکود
+            'prune_deleted': False,  # حذف خروجی‌های فایل‌های مبدا حذف‌شده
+            'fsync': 'none',  # سیاست fsync خروجی‌ها: none، file (هر فایل) یا batch (همه در پایان اجرا)
+            'resume': False,  # ادامه‌ی اجرای قطع‌شده‌ی قبلی از روی checkpoint
+            'shard': None,  # [شماره، تعداد] برای پردازش فقط یک بخش قطعی از فایل‌ها (شماره از 0)
+            'queue_dir': None,  # دایرکتوری مشترک صف کار با lease بین چند نود
+            'lease_ttl': 300,  # مدت اعتبار lease بدون تمدید (ثانیه)
+            'node_id': None,  # شناسه‌ی ثابت این نود در صف کار (None = نام میزبان و PID)
             # تنظیمات EXIF سفارشی
+            'write_xmp': False,  # نوشتن همان اطلاعات سفارشی به صورت XMP در کنار EXIF
             'custom_exif': {
                 'Artist': '',  # صاحب عکس
                 'Copyright': '',  # کپی‌رایت
@@ -115,30 +693,11 @@ class ImageConverterWeb:
         if not self.config['seo_friendly_names']:
             return filename
             
-        # حذف کاراکترهای غیرمجاز و تبدیل به lowercase
-        name = filename.lower()
-        
-        # تبدیل کاراکترهای فارسی و عربی
-        persian_map = {
-            'ا': 'a', 'ب': 'b', 'پ': 'p', 'ت': 't', 'ث': 's', 'ج': 'j',
-            'چ': 'ch', 'ح': 'h', 'خ': 'kh', 'د': 'd', 'ذ': 'z', 'ر': 'r',
-            'ز': 'z', 'ژ': 'zh', 'س': 's', 'ش': 'sh', 'ص': 's', 'ض': 'z',
-            'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'gh', 'ف': 'f', 'ق': 'gh',
-            'ک': 'k', 'گ': 'g', 'ل': 'l', 'م': 'm', 'ن': 'n', 'و': 'v',
-            'ه': 'h', 'ی': 'i', 'ئ': 'i', 'ء': 'a', 'آ': 'a', 'ة': 'h',
-            'ى': 'i', 'ي': 'i', 'ك': 'k', 'ؤ': 'o', 'إ': 'a', 'أ': 'a',
-            '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5',
-            '٦': '6', '٧': '7', '٨': '8', '٩': '9'
-        }
-        
-        for persian, english in persian_map.items():
-            name = name.replace(persian, english)
+        # تبدیل به lowercase و تبدیل کاراکترهای فارسی و عربی با جدول از پیش ساخته (یک گذر روی نام)
+        name = filename.lower().translate(PERSIAN_TRANSLATION)
         
-        # جایگزینی فاصله و کاراکترهای خاص با خط تیره
-        import re
-        name = re.sub(r'[^\w\-_\.]', '-', name)
-        # حذف خط تیره‌های متوالی
-        name = re.sub(r'-+', '-', name)
+        # جایگزینی فاصله و کاراکترهای خاص با خط تیره (خط تیره‌های متوالی یکی می‌شوند)
+        name = UNSAFE_NAME_CHARS.sub('-', name)
         # حذف خط تیره از ابتدا و انتها
         name = name.strip('-')
         
@@ -148,88 +707,254 @@ class ImageConverterWeb:
             
         return name
     
-    def resize_image(self, image: Image.Image) -> Image.Image:
-        """تغییر اندازه تصویر در صورت نیاز"""
+    def get_target_size(self, width: int, height: int) -> Tuple[int, int]:
+        """محاسبه اندازه نهایی تصویر با حفظ نسبت (None یعنی بدون تغییر اندازه)"""
         if not self.config['optimize_for_web']:
-            return image
+            return None
             
-        width, height = image.size
         max_width = self.config['max_width']
         max_height = self.config['max_height']
         
         if width <= max_width and height <= max_height:
-            return image
+            return None
         
         # محاسبه نسبت تصویر
         ratio = min(max_width / width, max_height / height)
-        new_width = int(width * ratio)
-        new_height = int(height * ratio)
+        return int(width * ratio), int(height * ratio)
+    
+    def can_reduce(self, size: Tuple[int, int], target_size: Tuple[int, int]) -> bool:
+        """آیا رمزگشایی با مقیاس کاهش‌یافته مجاز است (مقصد حداقل دو برابر کوچک‌تر)"""
+        return (self.config['fast_decode'] and
+                size[0] >= 2 * target_size[0] and size[1] >= 2 * target_size[1])
+    
+    def decode_image(self, image: Image.Image, target_size: Tuple[int, int] = None) -> Tuple[int, int]:
+        """
+        رمزگشایی تصویر تازه باز شده و برگرداندن اندازه‌ی مقصد (محاسبه شده از اندازه‌ی اصلی)
+        
+        DCT scaling در JPEG فقط پیش از load اثر دارد و به همین دلیل اینجا (نه در resize_image) انجام می‌شود.
+        target_size: اندازه‌ی مقصد کوچک‌تر از اندازه‌ی بهینه (مانند پله‌های srcset)
+        """
+        if target_size is None:
+            target_size = self.get_target_size(*image.size)
+        if target_size is not None and image.format == 'JPEG' and self.can_reduce(image.size, target_size):
+            image.draft(image.mode, target_size)
+        image.load()
+        return target_size
+    
+    def resize_image(self, image: Image.Image, target_size: Tuple[int, int] = None) -> Image.Image:
+        """تغییر اندازه تصویر در صورت نیاز"""
+        if target_size is None:
+            target_size = self.get_target_size(*image.size)
+        if target_size is None or image.size == target_size:
+            return image
+        
+        # کاهش با ضریب صحیح و سپس LANCZOS وقتی مقصد حداقل دو برابر کوچک‌تر است
+        # (draft در JPEG پیش از load در decode_image انجام می‌شود)
+        if self.can_reduce(image.size, target_size):
+            return image.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=3.0)
         
         # استفاده از LANCZOS برای کیفیت بالاتر
-        return image.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        return image.resize(target_size, Image.Resampling.LANCZOS)
     
-    def optimize_image(self, image: Image.Image, for_webp: bool = False) -> Image.Image:
-        """بهینه‌سازی تصویر برای وب"""
+    def drop_opaque_alpha(self, image: Image.Image) -> Image.Image:
+        """
+        حذف کانال آلفای کاملاً مات (RGBA به RGB و LA به L)
+        
+        فقط کانال آلفا یک بار پیمایش می‌شود (getextrema در خود Pillow، بدون کپی کل تصویر).
+        خروجی بدون آلفا هم انکود سبک‌تری دارد و هم دیگر نیازی به حذف شفافیت برای هر فرمت نیست.
+        """
+        if image.mode not in ('RGBA', 'LA'):
+            return image
+        if image.getchannel('A').getextrema() != (255, 255):
+            return image
+        return image.convert('RGB' if image.mode == 'RGBA' else 'L')
+    
+    def flatten_transparency(self, image: Image.Image, for_webp: bool = False) -> Image.Image:
+        """حذف شفافیت با پس‌زمینه‌ی سفید برای فرمت‌هایی که شفافیت ندارند"""
         # تبدیل به RGB اگر RGBA است (برای فرمت‌هایی که شفافیت ندارند)
         if image.mode in ('RGBA', 'LA'):
             if (self.output_format == 'JPEG' and not for_webp) or (not self.config['preserve_transparency'] and not for_webp):
-                # ایجاد پس‌زمینه سفید
+                # ترکیب درجا روی خود تصویر خروجی (پس‌زمینه سفید) با کانال آلفا به عنوان ماسک؛ فقط همین دو
+                # تخصیص لازم است. paste سفید روی image.convert('RGB') به ماسک معکوس آلفا (یک باند بیشتر) نیاز دارد
                 background = Image.new('RGB', image.size, (255, 255, 255))
-                background.paste(image, mask=image.split()[-1] if image.mode == 'RGBA' else None)
+                background.paste(image, mask=image.getchannel('A'))
                 image = background
+        return image
+    
+    def optimize_image(self, image: Image.Image, for_webp: bool = False) -> Image.Image:
+        """بهینه‌سازی تصویر برای وب"""
+        image = self.drop_opaque_alpha(image)
+        image = self.flatten_transparency(image, for_webp)
         
         # تغییر اندازه
         image = self.resize_image(image)
         
         return image
     
-    def add_custom_exif(self, image: Image.Image) -> Image.Image:
-        """اضافه کردن EXIF سفارشی"""
-        if not any(self.config['custom_exif'].values()):
+    def get_fit_size(self, image_size: Tuple[int, int], size: int) -> Tuple[int, int]:
+        """ابعاد تصویر پس از کوچک شدن تا اندازه‌ی مربعی size با حفظ نسبت"""
+        width, height = image_size
+        if width <= size and height <= size:
+            return image_size
+        
+        ratio = min(size / width, size / height)
+        return (max(1, round(width * ratio)), max(1, round(height * ratio)))
+    
+    def fit_within(self, image: Image.Image, size: int) -> Image.Image:
+        """کوچک کردن تصویر تا اندازه‌ی مربعی size با حفظ نسبت (مانند Image.thumbnail)"""
+        new_size = self.get_fit_size(image.size, size)
+        if new_size == image.size:
             return image
+        return image.resize(new_size, Image.Resampling.LANCZOS)
+    
+    def build_thumbnails(self, image: Image.Image, sizes: List[int] = None) -> List[Tuple[int, Image.Image]]:
+        """ساخت thumbnail ها از بزرگ به کوچک، هر کدام از بافر کوچک‌شده‌ی قبلی"""
+        thumbnails = []
+        current = image
+        for size in sorted(set(sizes or self.config['thumbnail_sizes']), reverse=True):
+            current = self.fit_within(current, size)
+            thumbnails.append((size, current))
+        return thumbnails
+    
+    def get_rendition_sizes(self, size: Tuple[int, int], widths: List[int]) -> List[Tuple[int, int]]:
+        """ابعاد پله‌های srcset از بزرگ به کوچک (فقط عرض‌های کوچک‌تر از تصویر؛ بدون بزرگ‌نمایی)"""
+        width, height = size
+        return [(target, max(1, round(height * target / width)))
+                for target in sorted(set(widths), reverse=True) if target < width]
+    
+    def build_renditions(self, image: Image.Image, widths: List[int]) -> List[Image.Image]:
+        """ساخت پله‌های srcset از بزرگ به کوچک، هر کدام از پله‌ی بزرگ‌تر قبلی"""
+        renditions = []
+        current = image
+        for size in self.get_rendition_sizes(image.size, widths):
+            current = current.resize(size, Image.Resampling.LANCZOS)
+            renditions.append(current)
+        return renditions
+    
+    def build_custom_metadata(self) -> Dict:
+        """
+        ساخت EXIF و XMP سفارشی از تنظیمات
         
-        try:
-            # دریافت EXIF موجود یا ایجاد جدید
-            exif_dict = image.getexif()
-            
-            # نقشه‌برداری فیلدهای EXIF
-            exif_mapping = {
-                'Artist': 315,  # 0x013B
-                'Copyright': 33432,  # 0x8298
-                'Software': 305,  # 0x0131
-                'Make': 271,  # 0x010F
-                'Model': 272,  # 0x0110
-                'ImageDescription': 270,  # 0x010E
-                'XPComment': 40092,  # 0x9C9C
-                'XPKeywords': 40094,  # 0x9C9E
-                'XPSubject': 40095,  # 0x9C9F
-            }
-            
-            # اضافه کردن اطلاعات سفارشی
-            for key, value in self.config['custom_exif'].items():
-                if value and key in exif_mapping:
-                    if key.startswith('XP'):
-                        # برای فیلدهای XP، باید به UTF-16 تبدیل شود
-                        exif_dict[exif_mapping[key]] = value.encode('utf-16le') + b'\x00\x00'
-                    else:
-                        exif_dict[exif_mapping[key]] = value
-            
-            # اضافه کردن تاریخ تبدیل
-            exif_dict[306] = datetime.now().strftime('%Y:%m:%d %H:%M:%S')  # DateTime
-            
-            # اضافه کردن آدرس وب‌سایت در بخش کامنت اگر مشخص شده
-            if self.config['custom_exif'].get('Website'):
-                comment = f"Website: {self.config['custom_exif']['Website']}"
-                if self.config['custom_exif'].get('XPComment'):
-                    comment = f"{self.config['custom_exif']['XPComment']} | {comment}"
-                exif_dict[40092] = comment.encode('utf-16le') + b'\x00\x00'
-            
-            # اعمال EXIF به تصویر
-            image.info['exif'] = exif_dict
-            
-        except Exception as e:
-            print(f"خطا در اضافه کردن EXIF: {str(e)}")
+        خروجی: {'tags': {شماره تگ: مقدار}, 'exif': بایت‌های EXIF یا None, 'xmp': بایت‌های XMP یا None}
+        """
+        custom = self.config['custom_exif']
+        if not any(custom.values()):
+            return {'tags': {}, 'exif': None, 'xmp': None}
+        
+        # نقشه‌برداری فیلدهای EXIF
+        exif_mapping = {
+            'Artist': 315,  # 0x013B
+            'Copyright': 33432,  # 0x8298
+            'Software': 305,  # 0x0131
+            'Make': 271,  # 0x010F
+            'Model': 272,  # 0x0110
+            'ImageDescription': 270,  # 0x010E
+            'XPComment': 40092,  # 0x9C9C
+            'XPKeywords': 40094,  # 0x9C9E
+            'XPSubject': 40095,  # 0x9C9F
+        }
+        
+        tags = {}
+        for key, value in custom.items():
+            if value and key in exif_mapping:
+                if key.startswith('XP'):
+                    # برای فیلدهای XP، باید به UTF-16 تبدیل شود
+                    tags[exif_mapping[key]] = value.encode('utf-16le') + b'\x00\x00'
+                elif not value.isascii():
+                    # Pillow متن غیر ASCII را با ? جایگزین می‌کند؛ مانند exiftool به صورت UTF-8 نوشته می‌شود
+                    tags[exif_mapping[key]] = value.encode('utf-8')
+                else:
+                    tags[exif_mapping[key]] = value
+        
+        # تاریخ تبدیل (زمان شروع اجرا برای همه‌ی خروجی‌ها)
+        now = datetime.now()
+        tags[306] = now.strftime('%Y:%m:%d %H:%M:%S')  # DateTime
+        
+        # اضافه کردن آدرس وب‌سایت در بخش کامنت اگر مشخص شده
+        comment = custom.get('XPComment') or ''
+        if custom.get('Website'):
+            comment = f"{comment} | Website: {custom['Website']}" if comment else f"Website: {custom['Website']}"
+            tags[40092] = comment.encode('utf-16le') + b'\x00\x00'
+        
+        exif = Image.Exif()
+        exif.update(tags)
+        xmp = self.build_xmp(custom, comment, now) if self.config['write_xmp'] else None
+        return {'tags': tags, 'exif': exif.tobytes(), 'xmp': xmp}
+    
+    def build_xmp(self, custom: Dict, comment: str, date: datetime) -> bytes:
+        """ساخت بسته‌ی XMP با همان اطلاعات EXIF سفارشی (Dublin Core و XMP Basic)"""
+        from xml.sax.saxutils import escape
+        
+        def alt(value: str) -> str:
+            return f'<rdf:Alt><rdf:li xml:lang="x-default">{escape(value)}</rdf:li></rdf:Alt>'
+        
+        properties = []
+        if custom.get('Artist'):
+            properties.append(f"<dc:creator><rdf:Seq><rdf:li>{escape(custom['Artist'])}</rdf:li></rdf:Seq></dc:creator>")
+        if custom.get('Copyright'):
+            properties.append(f"<dc:rights>{alt(custom['Copyright'])}</dc:rights>")
+        if custom.get('ImageDescription'):
+            properties.append(f"<dc:description>{alt(custom['ImageDescription'])}</dc:description>")
+        if custom.get('XPSubject'):
+            properties.append(f"<dc:title>{alt(custom['XPSubject'])}</dc:title>")
+        if custom.get('XPKeywords'):
+            # کلمات کلیدی با ویرگول فارسی یا انگلیسی جدا می‌شوند
+            keywords = [word.strip() for word in custom['XPKeywords'].replace('،', ',').split(',') if word.strip()]
+            items = ''.join(f'<rdf:li>{escape(word)}</rdf:li>' for word in keywords)
+            properties.append(f"<dc:subject><rdf:Bag>{items}</rdf:Bag></dc:subject>")
+        if custom.get('Software'):
+            properties.append(f"<xmp:CreatorTool>{escape(custom['Software'])}</xmp:CreatorTool>")
+        if comment:
+            properties.append(f"<exif:UserComment>{alt(comment)}</exif:UserComment>")
+        if custom.get('Website'):
+            properties.append(f"<xmpRights:WebStatement>{escape(custom['Website'])}</xmpRights:WebStatement>")
+        properties.append(f"<xmp:ModifyDate>{date.strftime('%Y-%m-%dT%H:%M:%S')}</xmp:ModifyDate>")
         
+        packet = (
+            '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            '<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/"'
+            ' xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmlns:xmpRights="http://ns.adobe.com/xap/1.0/rights/"'
+            ' xmlns:exif="http://ns.adobe.com/exif/1.0/">'
+            + ''.join(properties) +
+            '</rdf:Description></rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+        )
+        return packet.encode('utf-8')
+    
+    def get_custom_metadata(self) -> Dict:
+        """EXIF/XMP سفارشی؛ یک بار در هر اجرا ساخته و برای همه‌ی خروجی‌ها استفاده می‌شود"""
+        # در صورت تغییر تنظیمات پس از ساخت مبدل (مثلاً در بنچمارک) دوباره ساخته می‌شود
+        key = json.dumps([self.config['custom_exif'], self.config['write_xmp']], sort_keys=True)
+        if self.custom_metadata is None or self.custom_metadata[0] != key:
+            self.custom_metadata = (key, self.build_custom_metadata())
+        return self.custom_metadata[1]
+    
+    def get_metadata_params(self, image: Image.Image = None) -> Dict:
+        """
+        پارامترهای exif/xmp برای save
+        
+        با remove_exif همان بایت‌های از پیش ساخته برای همه‌ی تصاویر استفاده می‌شود؛
+        در غیر این صورت EXIF مبدا (از image) با تگ‌های سفارشی ادغام می‌شود.
+        """
+        metadata = self.get_custom_metadata()
+        params = {}
+        if self.config['remove_exif'] or image is None:
+            if metadata['exif']:
+                params['exif'] = metadata['exif']
+        else:
+            exif = image.getexif()
+            exif.update(metadata['tags'])
+            if exif:
+                params['exif'] = exif.tobytes()
+        if metadata['xmp']:
+            params['xmp'] = metadata['xmp']
+        return params
+    
+    def add_custom_exif(self, image: Image.Image) -> Image.Image:
+        """اضافه کردن EXIF سفارشی (سریالایز شده) به image.info"""
+        params = self.get_metadata_params(image)
+        if 'exif' in params:
+            image.info['exif'] = params['exif']
         return image
     
     def get_output_extension(self, format_name: str = None) -> str:
@@ -242,36 +967,868 @@ class ImageConverterWeb:
         }
         return extensions.get(format_name, '.jpg')
     
+    def apply_metadata(self, image: Image.Image) -> Image.Image:
+        """حذف اطلاعات EXIF مبدا در صورت remove_exif (EXIF خروجی با get_metadata_params به save داده می‌شود)"""
+        if self.config['remove_exif']:
+            image.info = {}
+        return image
+    
+    def record_failure(self, input_path: Path, target_format: str, error):
+        """ثبت خطای تبدیل یک فایل به یک فرمت"""
+        print(f"خطا در تبدیل {input_path} به {target_format}: {str(error)}")
+        self.stats['failed_list'].append(f"{input_path} ({target_format})")
+    
+    def open_source(self, source, need_hash: bool = False) -> Tuple[object, str]:
+        """
+        آماده‌سازی ورودی برای Image.open
+        
+        source: مسیر فایل، bytes/bytearray/memoryview یا شیء file-like (مثلاً بدنه‌ی پاسخ object store)
+        need_hash: در صورت نیاز به hash محتوا، ورودی فقط یک بار خوانده می‌شود و رمزگشایی از حافظه انجام می‌شود
+        خروجی: (ورودی قابل استفاده در Image.open، hash محتوا یا None)
+        """
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            data = source
+        elif isinstance(source, (str, os.PathLike)):
+            if not need_hash:
+                return source, None
+            with open(source, 'rb') as f:
+                data = f.read()
+        else:
+            # Image.open به seek نیاز دارد؛ جریان‌های بدون seek در حافظه خوانده می‌شوند
+            seekable = getattr(source, 'seekable', None)
+            if not need_hash and seekable is not None and seekable():
+                return source, None
+            data = source.read()
+        content_hash = hashlib.sha256(data).hexdigest() if need_hash else None
+        return io.BytesIO(data), content_hash
+    
+    def read_source(self, source, size: int = -1) -> bytes:
+        """خواندن بایت‌های خام ورودی آماده شده با open_source (بدون رمزگشایی و بدون تغییر موقعیت)"""
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, 'rb') as f:
+                return f.read(size)
+        position = source.tell()
+        try:
+            source.seek(0)
+            return source.read(size)
+        finally:
+            source.seek(position)
+    
+    def estimate_jpeg_quality(self, image: Image.Image) -> int:
+        """تخمین کیفیت JPEG از جدول کوانتیزاسیون روشنایی header (مقیاس libjpeg)"""
+        table = image.quantization[0]
+        scale = sum(table) * 100 / sum(JPEG_LUMINANCE_TABLE)
+        quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+        return max(1, min(100, round(quality)))
+    
+    def get_webp_compression(self, header: bytes) -> str:
+        """نوع فشرده‌سازی WebP از روی chunk های RIFF: 'lossy'، 'lossless' یا None (نامشخص)"""
+        offset = 12
+        while offset + 8 <= len(header):
+            fourcc = header[offset:offset + 4]
+            if fourcc == b'VP8 ':
+                return 'lossy'
+            if fourcc == b'VP8L':
+                return 'lossless'
+            if fourcc == b'ANMF':
+                # chunk های تصویر فریم اول پس از header شانزده بایتی فریم
+                offset += 8 + 16
+                continue
+            size = int.from_bytes(header[offset + 4:offset + 8], 'little')
+            offset += 8 + size + (size & 1)
+        return None
+    
+    def mux_jpeg_metadata(self, data: bytes, metadata: Dict) -> bytes:
+        """
+        جایگزینی segment های APP1 (EXIF و XMP) یک JPEG بدون رمزگشایی
+        
+        segment های جدید پس از APP0 (JFIF) قرار می‌گیرند؛ بقیه‌ی فایل دست نمی‌خورد.
+        """
+        payloads = []
+        if metadata.get('exif'):
+            exif = metadata['exif']
+            payloads.append(exif if exif.startswith(b'Exif\x00\x00') else b'Exif\x00\x00' + exif)
+        if metadata.get('xmp'):
+            payloads.append(JPEG_XMP_HEADER + metadata['xmp'])
+        
+        segments = []
+        offset = 2
+        # segment های header تا شروع داده‌ی تصویر (SOS)
+        while offset + 4 <= len(data) and data[offset] == 0xFF and data[offset + 1] != 0xDA:
+            end = offset + 2 + int.from_bytes(data[offset + 2:offset + 4], 'big')
+            segment = data[offset:end]
+            offset = end
+            if segment[1] == 0xE1 and ((metadata.get('exif') and segment[4:10] == b'Exif\x00\x00') or
+                                       (metadata.get('xmp') and segment[4:].startswith(JPEG_XMP_HEADER))):
+                continue
+            segments.append(segment)
+        
+        position = 0
+        while position < len(segments) and segments[position][1] == 0xE0:
+            position += 1
+        for payload in reversed(payloads):
+            if len(payload) > 65533:
+                raise ValueError("EXIF/XMP برای یک segment در JPEG بیش از حد بزرگ است")
+            segments.insert(position, b'\xff\xe1' + (len(payload) + 2).to_bytes(2, 'big') + payload)
+        return data[:2] + b''.join(segments) + data[offset:]
+    
+    def mux_webp_metadata(self, data: bytes, metadata: Dict) -> bytes:
+        """
+        جایگزینی chunk های EXIF و XMP یک WebP بدون رمزگشایی
+        
+        WebP ساده (فقط VP8 یا VP8L) با افزودن VP8X به قالب گسترش‌یافته تبدیل می‌شود.
+        """
+        chunks = []
+        offset = 12
+        while offset + 8 <= len(data):
+            fourcc = data[offset:offset + 4]
+            size = int.from_bytes(data[offset + 4:offset + 8], 'little')
+            chunks.append([fourcc, data[offset + 8:offset + 8 + size]])
+            offset += 8 + size + (size & 1)
+        if metadata.get('exif'):
+            chunks = [chunk for chunk in chunks if chunk[0] != b'EXIF']
+        if metadata.get('xmp'):
+            chunks = [chunk for chunk in chunks if chunk[0] != b'XMP ']
+        
+        if chunks[0][0] != b'VP8X':
+            fourcc, payload = chunks[0]
+            alpha = False
+            if fourcc == b'VP8L':
+                bits = int.from_bytes(payload[1:5], 'little')
+                width, height, alpha = (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1, bool(bits >> 28 & 1)
+            elif fourcc == b'VP8 ':
+                width = int.from_bytes(payload[6:8], 'little') & 0x3FFF
+                height = int.from_bytes(payload[8:10], 'little') & 0x3FFF
+            else:
+                raise ValueError(f"chunk تصویر WebP نامعتبر: {fourcc!r}")
+            header = bytes([0x10 if alpha else 0]) + bytes(3)
+            chunks.insert(0, [b'VP8X', header + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')])
+        
+        flags = chunks[0][1][0]
+        if metadata.get('exif'):
+            exif = metadata['exif']
+            chunks.append([b'EXIF', exif[6:] if exif.startswith(b'Exif\x00\x00') else exif])
+            flags |= 0x08
+        if metadata.get('xmp'):
+            chunks.append([b'XMP ', metadata['xmp']])
+            flags |= 0x04
+        chunks[0][1] = bytes([flags]) + chunks[0][1][1:]
+        
+        body = b''.join(fourcc + len(payload).to_bytes(4, 'little') + payload + bytes(len(payload) & 1)
+                        for fourcc, payload in chunks)
+        return b'RIFF' + (len(body) + 4).to_bytes(4, 'little') + b'WEBP' + body
+    
+    def can_keep_source(self, image: Image.Image, format_name: str) -> bool:
+        """
+        آیا خود فایل مبدا (فقط از روی header) می‌تواند خروجی این فرمت باشد
+        
+        فرمت یکسان، بدون نیاز به تغییر اندازه، حذف شفافیت یا حذف فریم‌ها، و بدون EXIF مبدا وقتی remove_exif فعال است.
+        پیش از رمزگشایی فراخوانی شود؛ apply_metadata اطلاعات header را از image.info پاک می‌کند.
+        """
+        if PASSTHROUGH_FORMATS.get(image.format) != format_name:
+            return False
+        if self.get_target_size(*image.size) is not None:
+            return False
+        if getattr(image, 'n_frames', 1) > 1 and not self.is_animated_output(image, format_name):
+            return False
+        if (format_name != 'WebP' and not self.config['preserve_transparency']
+                and image.has_transparency_data):
+            return False
+        if self.config['remove_exif'] and any(key in image.info for key in ('exif', 'xmp', 'XML:com.adobe.xmp')):
+            return False
+        if format_name == 'AVIF' and self.has_custom_metadata():
+            # EXIF/XMP سفارشی بدون انکود فقط به JPEG و WebP اضافه می‌شود
+            return False
+        return True
+    
+    def has_custom_metadata(self) -> bool:
+        """آیا EXIF یا XMP سفارشی روی خروجی‌ها نوشته می‌شود"""
+        metadata = self.get_custom_metadata()
+        return bool(metadata['exif'] or metadata['xmp'])
+    
+    def get_passthrough_metadata(self, image: Image.Image) -> Dict:
+        """
+        EXIF/XMP که باید به خروجی نگه داشته شده از مبدا اضافه شود ({} = بایت‌های مبدا بدون تغییر)
+        
+        مانند خروجی انکود شده؛ پیش از رمزگشایی فراخوانی شود.
+        """
+        if not self.config['size_guard'] or not self.has_custom_metadata():
+            return {}
+        return self.get_metadata_params(image)
+    
+    def read_passthrough(self, source, format_name: str, metadata: Dict) -> bytes:
+        """بایت‌های مبدا برای خروجی نگه داشته شده، با EXIF/XMP سفارشی (metadata از get_passthrough_metadata)"""
+        data = self.read_source(source)
+        if not metadata:
+            return data
+        if format_name == 'JPEG':
+            return self.mux_jpeg_metadata(data, metadata)
+        return self.mux_webp_metadata(data, metadata)
+    
+    def get_passthrough_reason(self, image: Image.Image, format_name: str, source) -> str:
+        """
+        دلیل کپی مستقیم مبدا به جای انکود در حالت size_guard (None = باید انکود شود)
+        
+        فقط header خوانده می‌شود: JPEG با کیفیت کمتر یا برابر quality و WebP با افتی که انکود دوباره‌ی آن
+        فقط افت کیفیت نسل دوم دارد. بقیه‌ی موارد انکود و سپس با مبدا مقایسه می‌شوند.
+        """
+        if not self.config['size_guard'] or not self.can_keep_source(image, format_name):
+            return None
+        if format_name == 'JPEG':
+            quality = self.estimate_jpeg_quality(image)
+            if quality <= self.config['quality']:
+                return f"JPEG با کیفیت {quality}"
+        elif format_name == 'WebP':
+            compression = self.get_webp_compression(self.read_source(source, 65536))
+            # WebP بدون افت مبدا فقط وقتی نگه داشته می‌شود که خروجی هم بدون افت باشد
+            if compression == 'lossy' or (compression == 'lossless' and self.config['webp_lossless']):
+                return f"WebP {'بدون افت' if compression == 'lossless' else 'با افت'}"
+        return None
+    
+    def guard_output_size(self, source, buffer: io.BytesIO, format_name: str,
+                          metadata: Dict = None) -> Tuple[io.BytesIO, str]:
+        """
+        نگه داشتن مبدا به جای خروجی انکود شده‌ای که از آن کوچک‌تر نیست
+        
+        فقط برای خروجی‌هایی که can_keep_source برای آن‌ها برقرار است.
+        metadata: EXIF/XMP سفارشی از get_passthrough_metadata
+        خروجی: (بافر نهایی، دلیل در صورت جایگزینی با مبدا یا None)
+        """
+        data = self.read_passthrough(source, format_name, metadata)
+        if buffer.getbuffer().nbytes < len(data):
+            return buffer, None
+        return io.BytesIO(data), f"خروجی انکود شده بزرگ‌تر بود: {buffer.getbuffer().nbytes:,} بایت"
+    
+    def encode_converted(self, source, format_name: str = None, width: int = None) -> io.BytesIO:
+        """
+        تبدیل یک ورودی (مسیر، bytes یا file-like) به فرمت مشخص در حافظه
+        
+        width: عرض خروجی کوچک‌تر از اندازه‌ی بهینه (مانند پله‌های srcset)؛ عرض بزرگ‌تر نادیده گرفته می‌شود
+        """
+        target_format = format_name or self.output_format
+        source, content_hash = self.open_source(source, need_hash=self.render_cache is not None)
+        
+        # باز کردن تصویر
+        with Image.open(source) as img:
+            output_size = self.get_target_size(*img.size) or img.size
+            rendition_sizes = self.get_rendition_sizes(output_size, [width]) if width else []
+            if rendition_sizes:
+                output_size = rendition_sizes[0]
+            
+            # مبدای بهینه فقط از روی header تشخیص داده و بدون رمزگشایی کپی می‌شود
+            metadata = self.get_passthrough_metadata(img)
+            if not rendition_sizes and self.get_passthrough_reason(img, target_format, source) is not None:
+                return io.BytesIO(self.read_passthrough(source, target_format, metadata))
+            keep_source = (not rendition_sizes and self.config['size_guard']
+                           and self.can_keep_source(img, target_format))
+            
+            key = None
+            if self.render_cache is not None:
+                key = self.get_render_key(content_hash, target_format, output_size, 'convert')
+            
+            def render() -> io.BytesIO:
+                # تنظیمات ذخیره بر اساس فرمت
+                save_params = {**self.get_save_params(target_format), **self.get_metadata_params(img)}
+                if self.is_animated_output(img, target_format):
+                    loop = img.info.get('loop', 0)
+                    return self.encode_animation(img, self.scan_animation(img), target_format,
+                                                 output_size, save_params, loop)
+                
+                # رمزگشایی (با draft در JPEG) و تغییر اندازه از روی اندازه‌ی اصلی، سپس بهینه‌سازی
+                is_webp = target_format == 'WebP'
+                image = self.resize_image(img, self.decode_image(img, output_size))
+                optimized_img = self.optimize_image(image, for_webp=is_webp)
+                optimized_img = self.apply_metadata(optimized_img)
+                return self.encode_image(optimized_img, target_format, save_params)
+            
+            buffer = self.fetch_or_render(key, render)
+            if keep_source:
+                buffer = self.guard_output_size(source, buffer, target_format, metadata)[0]
+            return buffer
+    
     def convert_image(self, input_path: Path, output_path: Path, format_name: str = None) -> bool:
         """تبدیل تصویر به فرمت مشخص"""
         target_format = format_name or self.output_format
         
         try:
-            # باز کردن تصویر
-            with Image.open(input_path) as img:
-                # بهینه‌سازی
+            # ذخیره تصویر
+            self.write_output(output_path, self.encode_converted(input_path, target_format))
+            return True
+        except Image.DecompressionBombError as e:
+            self.record_failure(input_path, target_format, self.describe_bomb_error(e))
+            return False
+        except Exception as e:
+            self.record_failure(input_path, target_format, e)
+            return False
+    
+    def describe_bomb_error(self, error: Exception) -> str:
+        """پیام خطای تصویری که از حد پیکسل‌های Pillow بزرگ‌تر است"""
+        return f"تصویر از حد مجاز پیکسل‌ها بزرگ‌تر است ({error})؛ برای پردازش، حد را با --max-pixels تغییر دهید"
+    
+    def encode_image(self, image: Image.Image, format_name: str, save_params: Dict) -> io.BytesIO:
+        """انکود تصویر در حافظه"""
+        buffer = io.BytesIO()
+        image.save(buffer, format_name, **save_params)
+        return buffer
+    
+    def is_animated_output(self, image: Image.Image, format_name: str) -> bool:
+        """آیا خروجی این فرمت باید متحرک باشد (JPEG فقط فریم اول را نگه می‌دارد)"""
+        return (self.config['animation'] and format_name in ('AVIF', 'WebP')
+                and getattr(image, 'n_frames', 1) > 1)
+    
+    def scan_animation(self, image: Image.Image) -> Dict:
+        """
+        بررسی فریم‌های تصویر متحرک در یک گذر (فقط فریم قبلی در حافظه نگه داشته می‌شود)
+        
+        فریم‌های یکسان با فریم قبل حذف و مدت نمایش آن‌ها به فریم قبلی اضافه می‌شود.
+        خروجی: {'frames': شماره‌ی فریم‌های نگه داشته، 'durations', 'has_alpha', 'total'}
+        """
+        frames, durations = [], []
+        has_alpha = False
+        previous = None
+        try:
+            for index in range(image.n_frames):
+                image.seek(index)
+                current = image.convert('RGBA')
+                # مدت فریم WebP پس از load در info قرار می‌گیرد؛ مرورگرها فریم GIF بدون مدت را 100ms نمایش می‌دهند
+                duration = image.info.get('duration') or 100
+                has_alpha = has_alpha or current.getchannel('A').getextrema()[0] < 255
+                if previous is not None and ImageChops.difference(current, previous).getbbox(alpha_only=False) is None:
+                    durations[-1] += duration
+                else:
+                    frames.append(index)
+                    durations.append(duration)
+                previous = current
+        finally:
+            image.seek(0)
+        return {'frames': frames, 'durations': durations, 'has_alpha': has_alpha, 'total': image.n_frames}
+    
+    def encode_animation(self, image: Image.Image, animation: Dict, format_name: str, size: Tuple[int, int],
+                         save_params: Dict, loop: int = 0) -> io.BytesIO:
+        """
+        انکود تصویر متحرک به WebP یا AVIF متحرک با تبدیل و انکود فریم به فریم
+        
+        animation: خروجی scan_animation
+        size: ابعاد فریم‌های خروجی
+        """
+        mode = 'RGBA' if animation['has_alpha'] else 'RGB'
+        
+        def convert_frame(frame: Image.Image) -> Image.Image:
+            frame = frame.convert(mode)
+            if frame.size != size:
+                frame = frame.resize(size, Image.Resampling.LANCZOS)
+            return self.flatten_transparency(frame, for_webp=format_name == 'WebP')
+        
+        frames = AnimationFrames(image, animation['frames'], convert_frame)
+        buffer = io.BytesIO()
+        try:
+            # WebP فقط نواحی تغییر کرده‌ی هر فریم را نسبت به فریم قبل انکود می‌کند
+            frames.save(buffer, format_name, save_all=True, duration=animation['durations'], loop=loop,
+                        **save_params)
+        finally:
+            image.seek(0)
+        return buffer
+    
+    def get_temp_path(self, output_path: Path) -> Path:
+        """مسیر فایل موقت مخفی در همان دایرکتوری (برای rename اتمیک)"""
+        return output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    
+    def write_output(self, output_path: Path, buffer: io.BytesIO) -> int:
+        """نوشتن اتمیک خروجی انکود شده روی دیسک و برگرداندن اندازه آن"""
+        data = buffer.getbuffer()
+        # نوشتن در فایل موقت و جایگزینی با os.replace؛ قطع برنامه فایل ناقص در مسیر نهایی باقی نمی‌گذارد
+        tmp_path = self.get_temp_path(output_path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+                if self.config['fsync'] == 'file':
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, output_path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self.config['fsync'] == 'file':
+            # ماندگاری خود rename
+            fsync_directory(output_path.parent)
+        return data.nbytes
+    
+    def sync_outputs(self, paths: set):
+        """fsync دسته‌ای فایل‌های نوشته شده و سپس دایرکتوری‌های آن‌ها (سیاست batch)"""
+        directories = set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path))
+        for directory in directories:
+            fsync_directory(directory)
+        print(f"fsync: {len(paths)} فایل در {len(directories)} دایرکتوری")
+    
+    def encode_outputs(self, source, formats: List[str], thumbnail_sizes: List[int] = None,
+                       timings: Dict[str, float] = None, choices: Dict[str, Dict] = None,
+                       content_hash: str = None, cache_counts: Dict[str, int] = None,
+                       rendition_widths: List[int] = None) -> List[Dict]:
+        """
+        رمزگشایی یک‌باره‌ی تصویر و انکود همه‌ی خروجی‌ها در حافظه از بافرهای مشترک
+        
+        source: مسیر فایل یا شیء file-like
+        formats: فرمت هر خروجی اصلی
+        thumbnail_sizes: اندازه‌ی thumbnail هایی که برای هر فرمت ساخته می‌شوند
+        timings: در صورت وجود، زمان هر مرحله (ثانیه) در آن جمع زده می‌شود
+        choices: در صورت وجود، تنظیمات انتخاب شده در حالت انکود تطبیقی برای هر فرمت
+        content_hash: hash محتوای مبدا (در صورت فعال بودن کش رندر الزامی است)
+        cache_counts: در صورت وجود، تعداد hit و miss کش رندر در آن جمع زده می‌شود
+        rendition_widths: عرض پله‌های srcset که برای هر فرمت ساخته می‌شوند
+        خروجی: برای هر فرمت به همان ترتیب
+        {'format', 'buffer', 'error', 'width', 'height', 'passthrough': دلیل نگه داشتن بایت‌های مبدا یا None,
+         'thumbnails': {اندازه: بافر}, 'thumbnail_error', 'renditions': [{'width', 'height', 'buffer'}],
+         'rendition_error'}
+        خطای باز کردن تصویر به فراخواننده منتقل می‌شود
+        """
+        outputs = []
+        thumbnail_sizes = sorted(set(thumbnail_sizes or []), reverse=True)
+        rendition_widths = sorted(set(rendition_widths or []), reverse=True)
+        
+        with Image.open(source) as img:
+            # ابعاد خروجی و کلیدهای کش از روی header و پیش از رمزگشایی محاسبه می‌شوند
+            output_size = self.get_target_size(*img.size) or img.size
+            rendition_sizes = self.get_rendition_sizes(output_size, rendition_widths)
+            animated = getattr(img, 'n_frames', 1) > 1
+            loop = img.info.get('loop', 0)
+            # نگه داشتن مبدا (--size-guard) پیش از رمزگشایی بررسی می‌شود؛ apply_metadata اطلاعات header را پاک می‌کند
+            passthrough = {name: self.get_passthrough_reason(img, name, source) for name in formats}
+            keep_source = {name: self.config['size_guard'] and self.can_keep_source(img, name) for name in formats}
+            passthrough_metadata = self.get_passthrough_metadata(img)
+            
+            # رمزگشایی فقط وقتی لازم است که خروجی در کش نباشد
+            decoded = {}
+            # نسخه‌ی بدون شفافیت یا با شفافیت، بسته به نوع خروجی
+            variants = {}
+            
+            def get_base() -> Image.Image:
+                if 'base' not in decoded:
+                    with measure(timings, 'decode'):
+                        target_size = self.decode_image(img)
+                        # فریم‌های تصویر متحرک بعداً با seek خوانده می‌شوند؛ فریم اول جدا نگه داشته می‌شود
+                        frame = img.copy() if animated else img
+                    # تغییر اندازه فقط یک بار برای همه‌ی فرمت‌ها
+                    with measure(timings, 'resize'):
+                        base = self.resize_image(frame, target_size)
+                    # بررسی آلفا یک بار برای همه‌ی فرمت‌ها، thumbnail ها و پله‌های srcset
+                    with measure(timings, 'flatten'):
+                        base = self.drop_opaque_alpha(base)
+                    with measure(timings, 'exif'):
+                        decoded['metadata'] = self.get_metadata_params(base)
+                        decoded['base'] = self.apply_metadata(base)
+                return decoded['base']
+            
+            def get_metadata() -> Dict:
+                # EXIF مبدا فقط بدون remove_exif لازم است؛ در غیر این صورت بدون رمزگشایی
+                if self.config['remove_exif']:
+                    return self.get_metadata_params()
+                get_base()
+                return decoded['metadata']
+            
+            def get_variant(is_webp: bool) -> Image.Image:
+                if is_webp not in variants:
+                    base = get_base()
+                    with measure(timings, 'flatten'):
+                        variants[is_webp] = self.flatten_transparency(base, for_webp=is_webp)
+                return variants[is_webp]
+            
+            def get_thumbnails() -> Dict[int, Image.Image]:
+                if 'thumbnails' not in decoded:
+                    base = get_base()
+                    with measure(timings, 'thumbnail_resize'):
+                        decoded['thumbnails'] = dict(self.build_thumbnails(base, thumbnail_sizes))
+                return decoded['thumbnails']
+            
+            def get_animation() -> Dict:
+                if 'animation' not in decoded:
+                    with measure(timings, 'decode'):
+                        decoded['animation'] = self.scan_animation(img)
+                return decoded['animation']
+            
+            def get_content() -> Dict:
+                if 'content' not in decoded:
+                    base = get_base()
+                    with measure(timings, 'classify'):
+                        decoded['content'] = self.classify_content(base)
+                return decoded['content']
+            
+            def get_renditions() -> List[Image.Image]:
+                if 'renditions' not in decoded:
+                    base = get_base()
+                    with measure(timings, 'srcset_resize'):
+                        decoded['renditions'] = self.build_renditions(base, rendition_widths)
+                return decoded['renditions']
+            
+            for target_format in formats:
                 is_webp = target_format == 'WebP'
-                optimized_img = self.optimize_image(img, for_webp=is_webp)
+                is_animated = self.is_animated_output(img, target_format)
+                animate_thumbnails = is_animated and self.config['animated_thumbnails']
+                output = {'format': target_format, 'buffer': None, 'error': None,
+                          'width': output_size[0], 'height': output_size[1], 'passthrough': None,
+                          'thumbnails': {}, 'thumbnail_error': None,
+                          'renditions': [], 'rendition_error': None}
+                outputs.append(output)
                 
-                # حذف اطلاعات EXIF موجود
-                if self.config['remove_exif']:
-                    optimized_img.info = {}
+                def get_params(save_params: Dict) -> Dict:
+                    # نوع محتوا یک بار برای همه‌ی فرمت‌ها و اندازه‌ها تشخیص داده می‌شود
+                    if self.config['content_aware']:
+                        save_params = self.get_content_params(target_format, save_params, get_content())[0]
+                    # EXIF/XMP یکسان روی همه‌ی خروجی‌ها (اصلی، thumbnail ها و پله‌های srcset)
+                    return {**save_params, **get_metadata()}
                 
-                # اضافه کردن EXIF سفارشی
-                if not self.config['remove_exif'] or any(self.config['custom_exif'].values()):
-                    optimized_img = self.add_custom_exif(optimized_img)
+                def render() -> io.BytesIO:
+                    save_params, choice = self.get_save_params(target_format), {}
+                    if self.config['content_aware']:
+                        save_params, choice = self.get_content_params(target_format, save_params, get_content())
+                    if self.is_adaptive_encoding():
+                        # در تصویر متحرک تنظیمات روی فریم اول انتخاب می‌شوند
+                        with measure(timings, f'adapt:{target_format}'):
+                            content = get_content() if self.config['content_aware'] else None
+                            save_params, adaptive_choice = self.choose_save_params(get_variant(is_webp), target_format,
+                                                                                   save_params, content)
+                        choice.update(adaptive_choice)
+                    if is_animated:
+                        animation = get_animation()
+                        choice['frames'] = f"{len(animation['frames'])}/{animation['total']}"
+                    if choices is not None and (self.config['content_aware'] or self.is_adaptive_encoding() or is_animated):
+                        choices[target_format] = choice
+                    save_params = {**save_params, **get_metadata()}
+                    with measure(timings, f'encode:{target_format}'):
+                        if is_animated:
+                            return self.encode_animation(img, get_animation(), target_format, output_size,
+                                                         save_params, loop)
+                        return self.encode_image(get_variant(is_webp), target_format, save_params)
                 
-                # تنظیمات ذخیره بر اساس فرمت
-                save_params = self.get_save_params(target_format)
+                try:
+                    # مبدای بهینه بدون رمزگشایی و انکود نگه داشته می‌شود
+                    output['passthrough'] = passthrough[target_format]
+                    if output['passthrough'] is not None:
+                        output['buffer'] = io.BytesIO(self.read_passthrough(source, target_format, passthrough_metadata))
+                    else:
+                        key = None
+                        if self.render_cache is not None:
+                            key = self.get_render_key(content_hash, target_format, output_size, 'main')
+                        output['buffer'] = self.fetch_or_render(key, render, cache_counts)
+                        if keep_source[target_format]:
+                            output['buffer'], output['passthrough'] = self.guard_output_size(
+                                source, output['buffer'], target_format, passthrough_metadata)
+                except Exception as e:
+                    output['error'] = e
+                    continue
                 
-                # ذخیره تصویر
-                optimized_img.save(output_path, target_format, **save_params)
+                # thumbnail ها از بافر کوچک‌شده ساخته و بین فرمت‌ها به اشتراک گذاشته می‌شوند
+                try:
+                    save_params = self.get_thumbnail_params(target_format)
+                    thumbnail_size = output_size
+                    for size in thumbnail_sizes:
+                        # ابعاد همان زنجیره‌ی build_thumbnails
+                        thumbnail_size = self.get_fit_size(thumbnail_size, size)
+                        
+                        def render_thumbnail() -> io.BytesIO:
+                            if animate_thumbnails:
+                                with measure(timings, f'encode:{target_format}'):
+                                    return self.encode_animation(img, get_animation(), target_format, thumbnail_size,
+                                                                 get_params(save_params), loop)
+                            with measure(timings, 'flatten'):
+                                thumb = self.flatten_transparency(get_thumbnails()[size], for_webp=is_webp)
+                            with measure(timings, f'encode:{target_format}'):
+                                return self.encode_image(thumb, target_format, get_params(save_params))
+                        
+                        key = None
+                        if self.render_cache is not None:
+                            key = self.get_render_key(content_hash, target_format, output_size,
+                                                      f'thumb:{size}', thumbnail_sizes)
+                        output['thumbnails'][size] = self.fetch_or_render(key, render_thumbnail, cache_counts)
+                except Exception as e:
+                    output['thumbnail_error'] = e
                 
-            return True
+                # پله‌های srcset با همان تنظیمات انکود خروجی اصلی
+                try:
+                    save_params = self.get_save_params(target_format)
+                    for index, (width, height) in enumerate(rendition_sizes):
+                        
+                        def render_rendition() -> io.BytesIO:
+                            if is_animated:
+                                with measure(timings, f'encode:{target_format}'):
+                                    return self.encode_animation(img, get_animation(), target_format, (width, height),
+                                                                 get_params(save_params), loop)
+                            with measure(timings, 'flatten'):
+                                image = self.flatten_transparency(get_renditions()[index], for_webp=is_webp)
+                            with measure(timings, f'encode:{target_format}'):
+                                return self.encode_image(image, target_format, get_params(save_params))
+                        
+                        key = None
+                        if self.render_cache is not None:
+                            key = self.get_render_key(content_hash, target_format, output_size,
+                                                      f'srcset:{width}', rendition_widths)
+                        output['renditions'].append({
+                            'width': width,
+                            'height': height,
+                            'buffer': self.fetch_or_render(key, render_rendition, cache_counts),
+                        })
+                except Exception as e:
+                    output['rendition_error'] = e
+        
+        return outputs
+    
+    def render_outputs(self, input_path: Path, targets: List[Tuple[str, Path, Path]],
+                       timings: Dict[str, float] = None, choices: Dict[str, Dict] = None,
+                       content_hash: str = None, cache_counts: Dict[str, int] = None,
+                       source=None, stem: str = None) -> List[Dict]:
+        """
+        ساخت همه‌ی خروجی‌های یک فایل مبدا با encode_outputs و نوشتن آن‌ها روی دیسک
+        
+        targets: فهرست (فرمت، مسیر خروجی، دایرکتوری thumbnail ها)
+        content_hash: hash محتوای مبدا در صورتی که از قبل محاسبه شده باشد (برای کش رندر)
+        source: محتوای مبدا در صورتی که از قبل خوانده شده باشد (پیش‌فرض: input_path)
+        stem: نام پایه‌ی thumbnail ها (پیش‌فرض: نام input_path)
+        بقیه‌ی پارامترها مانند encode_outputs
+        خروجی: برای هر target به همان ترتیب، None در صورت خطا و در غیر این صورت
+        {'size': حجم خروجی، 'passthrough': دلیل نگه داشتن مبدا یا None، 'thumbnails': {اندازه: حجم}،
+         'renditions': {عرض: حجم}، 'srcset': مسیر JSON یا None}
+        (بدون stat دوباره‌ی فایل‌ها)
+        """
+        results = [None] * len(targets)
+        stem = stem or input_path.stem
+        thumbnail_sizes = self.config['thumbnail_sizes'] if self.config['create_thumbnails'] else None
+        rendition_widths = self.config['srcset_widths']
+        
+        try:
+            if source is None:
+                with measure(timings, 'read'):
+                    source, source_hash = self.open_source(
+                        input_path, need_hash=self.render_cache is not None and content_hash is None)
+                content_hash = content_hash or source_hash
+            outputs = self.encode_outputs(source, [target[0] for target in targets], thumbnail_sizes,
+                                          timings, choices, content_hash, cache_counts, rendition_widths)
+        except Image.DecompressionBombError as e:
+            # رد صریح تصاویر بزرگ‌تر از حد Pillow (پیش از اشغال حافظه)
+            for target_format, _, _ in targets:
+                self.record_failure(input_path, target_format, self.describe_bomb_error(e))
+            return results
         except Exception as e:
-            print(f"خطا در تبدیل {input_path} به {target_format}: {str(e)}")
-            self.stats['failed_list'].append(f"{input_path} ({target_format})")
-            return False
+            # خطا در باز کردن تصویر: همه‌ی فرمت‌ها ناموفق هستند
+            for target_format, _, _ in targets:
+                self.record_failure(input_path, target_format, e)
+            return results
+        
+        for index, ((target_format, output_path, thumb_dir), output) in enumerate(zip(targets, outputs)):
+            try:
+                if output['error'] is not None:
+                    raise output['error']
+                with measure(timings, 'write'):
+                    if (output['passthrough'] is not None and self.config['passthrough_link'] == 'hardlink'
+                            and not self.has_custom_metadata()):
+                        # خروجی همان فایل مبداست؛ hardlink به جای نوشتن دوباره‌ی بایت‌ها
+                        self.link_or_copy(input_path, output_path, hardlink=True)
+                        size = output['buffer'].getbuffer().nbytes
+                    else:
+                        size = self.write_output(output_path, output['buffer'])
+            except Image.DecompressionBombError as e:
+                self.record_failure(input_path, target_format, self.describe_bomb_error(e))
+                continue
+            except Exception as e:
+                self.record_failure(input_path, target_format, e)
+                continue
+            results[index] = {'size': size, 'passthrough': output['passthrough'],
+                              'thumbnails': {}, 'renditions': {}, 'srcset': None}
+            
+            try:
+                for thumb_size, buffer in output['thumbnails'].items():
+                    with measure(timings, 'write'):
+                        results[index]['thumbnails'][thumb_size] = self.write_output(self.get_thumbnail_path(
+                            stem, thumb_dir, thumb_size, target_format), buffer)
+                if output['thumbnail_error'] is not None:
+                    raise output['thumbnail_error']
+            except Exception as e:
+                print(f"خطا در ایجاد thumbnail برای {input_path}: {str(e)}")
+            
+            if not rendition_widths:
+                continue
+            try:
+                # ابعاد و حجم هر پله از همان بافرها؛ سایت‌ساز لازم نیست فایل‌ها را دوباره باز کند
+                entries = []
+                for rendition in output['renditions']:
+                    path = self.get_rendition_path(output_path, rendition['width'])
+                    with measure(timings, 'write'):
+                        written = self.write_output(path, rendition['buffer'])
+                    results[index]['renditions'][rendition['width']] = written
+                    entries.append({'width': rendition['width'], 'height': rendition['height'],
+                                    'bytes': written, 'path': path.name})
+                if output['rendition_error'] is not None:
+                    raise output['rendition_error']
+                entries.append({'width': output['width'], 'height': output['height'],
+                                'bytes': size, 'path': output_path.name})
+                results[index]['srcset'] = self.write_srcset_manifest(
+                    self.get_srcset_manifest_path(output_path), target_format, entries)
+            except Exception as e:
+                print(f"خطا در ایجاد srcset برای {input_path}: {str(e)}")
+        
+        return results
+    
+    def get_rendition_path(self, output_path: Path, width: int) -> Path:
+        """مسیر یک پله‌ی srcset در کنار خروجی اصلی"""
+        return output_path.with_name(f"{output_path.stem}-{width}w{output_path.suffix}")
+    
+    def get_srcset_manifest_path(self, output_path: Path) -> Path:
+        """مسیر JSON پله‌های srcset یک خروجی"""
+        return output_path.with_name(f"{output_path.stem}.srcset.json")
+    
+    def copy_srcset_manifest(self, source: Path, destination: Path, renames: Dict[str, str]):
+        """کپی JSON پله‌های srcset یک فایل تکراری با نام فایل‌های خودش"""
+        with open(source, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        entries = [dict(entry, path=renames.get(entry['path'], entry['path'])) for entry in manifest['renditions']]
+        self.write_srcset_manifest(destination, manifest['format'], entries)
+    
+    def write_srcset_manifest(self, manifest_path: Path, format_name: str, entries: List[Dict]) -> Path:
+        """
+        نوشتن JSON پله‌های srcset یک تصویر (مسیرها نسبت به همان دایرکتوری)
+        
+        entries: [{'width', 'height', 'bytes', 'path'}] شامل خروجی اصلی
+        """
+        mime_types = {
+            'AVIF': 'image/avif',
+            'WebP': 'image/webp',
+            'JPEG': 'image/jpeg'
+        }
+        manifest = {
+            'format': format_name,
+            'mime_type': mime_types.get(format_name, 'image/jpeg'),
+            'renditions': sorted(entries, key=lambda entry: entry['width']),
+        }
+        # srcset آماده برای تگ img/source
+        manifest['srcset'] = ', '.join(f"{entry['path']} {entry['width']}w" for entry in manifest['renditions'])
+        data = json.dumps(manifest, indent=2, ensure_ascii=False).encode('utf-8')
+        self.write_output(manifest_path, io.BytesIO(data))
+        return manifest_path
+    
+    def get_output_formats(self) -> List[str]:
+        """فرمت‌های خروجی بر اساس تنظیمات (فرمت اصلی و در صورت فعال بودن WebP)"""
+        formats = [self.output_format]
+        if self.config['create_webp'] and 'WebP' not in formats:
+            formats.append('WebP')
+        return formats
+    
+    def convert_bytes(self, data, formats: List[str] = None, sizes: List[int] = None,
+                      widths: List[int] = None) -> Dict[str, Dict]:
+        """
+        تبدیل تصویر در حافظه، بدون فایل موقت
+        
+        data: محتوای فایل تصویر (bytes، bytearray، memoryview یا شیء file-like)
+        formats: فرمت‌های خروجی (پیش‌فرض: get_output_formats)
+        sizes: اندازه‌ی thumbnail ها (پیش‌فرض: thumbnail_sizes در صورت فعال بودن create_thumbnails)
+        widths: عرض پله‌های srcset (پیش‌فرض: srcset_widths)
+        خروجی: {فرمت: {'image': BytesIO، 'width'، 'height'، 'thumbnails': {اندازه: BytesIO}،
+                'renditions': [{'width'، 'height'، 'image': BytesIO}]}}
+        در صورت خطای رمزگشایی یا انکود، همان خطا raise می‌شود
+        """
+        formats = list(dict.fromkeys(formats or self.get_output_formats()))
+        for format_name in formats:
+            if format_name not in ('AVIF', 'WebP', 'JPEG'):
+                raise ValueError(f"فرمت خروجی پشتیبانی نمی‌شود: {format_name}")
+        if sizes is None and self.config['create_thumbnails']:
+            sizes = self.config['thumbnail_sizes']
+        
+        if widths is None:
+            widths = self.config['srcset_widths']
+        
+        source, content_hash = self.open_source(data, need_hash=self.render_cache is not None)
+        outputs = self.encode_outputs(source, formats, sizes, content_hash=content_hash, rendition_widths=widths)
+        
+        results = {}
+        for output in outputs:
+            error = output['error'] or output['thumbnail_error'] or output['rendition_error']
+            if error is not None:
+                raise error
+            results[output['format']] = {
+                'image': output['buffer'],
+                'width': output['width'],
+                'height': output['height'],
+                'thumbnails': output['thumbnails'],
+                'renditions': [{'width': rendition['width'], 'height': rendition['height'], 'image': rendition['buffer']}
+                               for rendition in output['renditions']],
+            }
+        return results
+    
+    def get_render_cache(self) -> RenderCache:
+        """کش رندر بر اساس تنظیمات فعلی (None در صورت غیرفعال بودن)"""
+        if not self.config['render_cache']:
+            return None
+        return RenderCache(self.config['render_cache'], self.config['render_cache_size'])
+    
+    def get_render_key(self, content_hash: str, format_name: str, output_size: Tuple[int, int], role: str,
+                       cascade_sizes: List[int] = None) -> str:
+        """
+        کلید کش یک خروجی
+        
+        role: 'main' (خروجی اصلی render_outputs)، 'thumb:<size>' (thumbnail های زنجیره‌ای)،
+        'srcset:<width>' (پله‌های srcset)، 'convert' و 'thumbnail:<size>' (متدهای تکی convert_image و create_thumbnail)
+        cascade_sizes: همه‌ی اندازه‌های زنجیره (هر پله از پله‌ی بزرگ‌تر قبلی ساخته می‌شود)
+        """
+        settings = {
+            # خروجی انکودرها ممکن است بین نسخه‌های Pillow تغییر کند
+            'pillow': Image.__version__,
+            'format': format_name,
+            'size': list(output_size),
+            'role': role,
+            # حذف شفافیت به فرمت اصلی هم بستگی دارد
+            'output_format': self.output_format,
+            'preserve_transparency': self.config['preserve_transparency'],
+            # آلفای کاملاً مات پیش از انکود حذف می‌شود
+            'drop_opaque_alpha': True,
+            'fast_decode': self.config['fast_decode'],
+        }
+        settings['remove_exif'] = self.config['remove_exif']
+        settings['custom_exif'] = self.config['custom_exif']
+        settings['write_xmp'] = self.config['write_xmp']
+        if role.startswith('thumbnail:'):
+            # create_thumbnail مستقیم از مبدا می‌سازد
+            settings['save_params'] = self.get_thumbnail_params(format_name)
+            return self.render_cache.make_key(content_hash, settings)
+        
+        settings['content_aware'] = self.config['content_aware']
+        settings['animation'] = self.config['animation']
+        if role.startswith('thumb:'):
+            settings['save_params'] = self.get_thumbnail_params(format_name)
+            settings['animated_thumbnails'] = self.config['animated_thumbnails']
+            # هر thumbnail از thumbnail بزرگ‌تر قبلی ساخته می‌شود
+            settings['thumbnail_sizes'] = sorted(set(cascade_sizes or self.config['thumbnail_sizes']))
+        elif role.startswith('srcset:'):
+            settings['save_params'] = self.get_save_params(format_name)
+            settings['srcset_widths'] = sorted(set(cascade_sizes or self.config['srcset_widths']))
+        else:
+            settings['save_params'] = self.get_save_params(format_name)
+            if role == 'main' and self.is_adaptive_encoding():
+                settings['adaptive'] = [self.config['target_ssim'], self.config['time_budget'],
+                                        self.config['min_quality'], self.config['adaptive_proxy_size']]
+        return self.render_cache.make_key(content_hash, settings)
+    
+    def fetch_or_render(self, key: str, render, cache_counts: Dict[str, int] = None) -> io.BytesIO:
+        """خروجی از کش رندر در صورت وجود؛ در غیر این صورت انکود با render و ذخیره در کش"""
+        if key is None:
+            return render()
+        buffer = self.render_cache.get(key)
+        hit = buffer is not None
+        if not hit:
+            buffer = render()
+            self.render_cache.put(key, buffer)
+        if cache_counts is not None:
+            cache_counts['hits' if hit else 'misses'] += 1
+        return buffer
     
     def get_save_params(self, format_name: str) -> Dict:
         """تنظیمات ذخیره بر اساس فرمت خروجی"""
@@ -286,46 +1843,229 @@ class ImageConverterWeb:
                 'speed': 8,  # سرعت انکود
             }
         
-        elif format_name == 'WebP':
-            return {
-                **base_params,
-                'quality': self.config['webp_quality'],
-                'method': self.config['webp_method'],
-                'lossless': self.config['webp_lossless'],
-            }
+        elif format_name == 'WebP':
+            return {
+                **base_params,
+                'quality': self.config['webp_quality'],
+                'method': self.config['webp_method'],
+                'lossless': self.config['webp_lossless'],
+            }
+        
+        elif format_name == 'JPEG':
+            return {
+                **base_params,
+                'quality': self.config['quality'],
+                'progressive': self.config['progressive'],
+            }
+        
+        return base_params
+    
+    def is_adaptive_encoding(self) -> bool:
+        """آیا انتخاب تنظیمات انکود برای هر تصویر فعال است"""
+        return bool(self.config['target_ssim'] or self.config['time_budget'])
+    
+    def get_effort_levels(self, format_name: str, content: Dict = None) -> List[Dict]:
+        """
+        سطوح effort انکودر از کندترین (بهترین فشرده‌سازی) به سریع‌ترین
+        
+        content: نتیجه‌ی classify_content؛ سطوح از سقف محتوامحور get_content_params فراتر نمی‌روند
+        """
+        if format_name == 'AVIF':
+            fastest = GRAPHIC_AVIF_MAX_SPEED if content and content['content'] == 'graphic' else 10
+            return [{'speed': speed} for speed in range(4, fastest + 1)]
+        if format_name == 'WebP':
+            return [{'method': method} for method in range(self.config['webp_method'], -1, -1)]
+        # JPEG سطح effort ندارد
+        return [{}]
+    
+    def compute_ssim(self, reference: Image.Image, candidate: Image.Image) -> float:
+        """SSIM روی بلوک‌های 8x8 تصویر خاکستری (فقط با Pillow)"""
+        x = reference.convert('L').convert('F')
+        y = candidate.convert('L').convert('F')
+        width, height = (x.width // 8) * 8, (x.height // 8) * 8
+        if width == 0 or height == 0:
+            return 1.0
+        x = x.crop((0, 0, width, height))
+        y = y.crop((0, 0, width, height))
+        
+        # میانگین، واریانس و کوواریانس هر بلوک با reduce (میانگین جعبه‌ای)
+        mu_x = x.reduce(8)
+        mu_y = y.reduce(8)
+        xx = ImageMath.lambda_eval(lambda a: a['x'] * a['x'], x=x).reduce(8)
+        yy = ImageMath.lambda_eval(lambda a: a['y'] * a['y'], y=y).reduce(8)
+        xy = ImageMath.lambda_eval(lambda a: a['x'] * a['y'], x=x, y=y).reduce(8)
+        
+        c1 = (0.01 * 255) ** 2
+        c2 = (0.03 * 255) ** 2
+        ssim_map = ImageMath.lambda_eval(
+            lambda a: ((a['mx'] * a['my'] * 2 + c1) * ((a['xy'] - a['mx'] * a['my']) * 2 + c2)) /
+                      ((a['mx'] * a['mx'] + a['my'] * a['my'] + c1) *
+                       (a['xx'] - a['mx'] * a['mx'] + a['yy'] - a['my'] * a['my'] + c2)),
+            mx=mu_x, my=mu_y, xx=xx, yy=yy, xy=xy)
+        # میانگین کل نقشه با کاهش به یک پیکسل
+        return ssim_map.reduce(ssim_map.size).getpixel((0, 0))
+    
+    def choose_save_params(self, image: Image.Image, format_name: str, save_params: Dict = None,
+                           content: Dict = None) -> Tuple[Dict, Dict]:
+        """
+        انتخاب effort و کیفیت انکود برای یک تصویر با آزمایش روی نسخه‌ی کوچک‌شده (proxy)
+        
+        - time_budget: کندترین effort که زمان تخمینی آن در بودجه (ثانیه) جا شود
+        - target_ssim: کمترین کیفیتی که SSIM آن روی proxy به هدف برسد (جستجوی دودویی)
+        
+        save_params: تنظیمات پایه (پیش‌فرض: get_save_params)
+        content: نتیجه‌ی classify_content برای محدود کردن سطوح effort
+        خروجی: (تنظیمات ذخیره، گزارش انتخاب)
+        """
+        save_params = dict(save_params or self.get_save_params(format_name))
+        choice = {}
+        proxy = self.fit_within(image, self.config['adaptive_proxy_size'])
+        pixel_ratio = (image.width * image.height) / (proxy.width * proxy.height)
+        
+        levels = self.get_effort_levels(format_name, content)
+        
+        # انتخاب effort بر اساس زمان انکود proxy و تعمیم خطی به اندازه کامل؛
+        # از سریع‌ترین سطح شروع می‌شود تا آزمایش‌ها خودشان از بودجه بیشتر نشوند
+        if self.config['time_budget'] and format_name != 'JPEG':
+            chosen, chosen_estimate = levels[-1], None
+            probe_time = 0.0
+            for level in reversed(levels):
+                start = time.perf_counter()
+                self.encode_image(proxy, format_name, {**save_params, **level})
+                elapsed = time.perf_counter() - start
+                estimate = elapsed * pixel_ratio
+                if estimate > self.config['time_budget'] and chosen_estimate is not None:
+                    break
+                chosen, chosen_estimate = level, estimate
+                # خود آزمایش‌ها نباید بیش از یک چهارم بودجه مصرف کنند
+                probe_time += elapsed
+                if probe_time > self.config['time_budget'] / 4:
+                    break
+            save_params.update(chosen)
+            choice.update(chosen)
+            choice['estimated_seconds'] = round(chosen_estimate, 3)
+        
+        # جستجوی دودویی کیفیت روی proxy (با سریع‌ترین effort؛ رابطه کیفیت و SSIM تقریباً مستقل از آن است)
+        if self.config['target_ssim'] and not save_params.get('lossless'):
+            probe_params = {**save_params, **levels[-1]}
+            scores = {}
+            
+            def score(quality: int) -> float:
+                if quality not in scores:
+                    buffer = self.encode_image(proxy, format_name, {**probe_params, 'quality': quality})
+                    with Image.open(buffer) as decoded:
+                        scores[quality] = self.compute_ssim(proxy, decoded)
+                return scores[quality]
+            
+            low = min(self.config['min_quality'], save_params['quality'])
+            high = save_params['quality']
+            # اگر حتی با بیشترین کیفیت مجاز به هدف نرسیم، همان کیفیت استفاده می‌شود
+            if score(high) >= self.config['target_ssim']:
+                while low < high:
+                    middle = (low + high) // 2
+                    if score(middle) >= self.config['target_ssim']:
+                        high = middle
+                    else:
+                        low = middle + 1
+            save_params['quality'] = high
+            choice['quality'] = high
+            choice['ssim'] = round(scores[high], 4)
+        
+        return save_params, choice
+    
+    def classify_content(self, image: Image.Image) -> Dict:
+        """
+        تشخیص نوع محتوا (گرافیک مانند لوگو، نمودار و اسکرین‌شات یا عکس) روی نسخه‌ی کوچک‌شده
+        
+        proxy با NEAREST ساخته می‌شود تا رنگ میانی جدیدی ایجاد نشود.
+        خروجی: {'content': 'graphic' یا 'photo', 'reason', 'colors', 'entropy', 'edges'}
+        """
+        proxy = image
+        ratio = max(image.size) / self.config['adaptive_proxy_size']
+        if ratio > 1:
+            proxy = image.resize((max(1, round(image.width / ratio)), max(1, round(image.height / ratio))),
+                                 Image.Resampling.NEAREST)
+        
+        # getcolors بعد از 4096 رنگ متوقف می‌شود (None)
+        colors = proxy.convert('RGBA').getcolors(maxcolors=4096)
+        colors = len(colors) if colors is not None else None
+        gray = proxy.convert('L')
+        entropy = gray.entropy()
+        histogram = gray.filter(ImageFilter.FIND_EDGES).histogram()
+        edges = sum(histogram[32:]) / sum(histogram)
+        
+        if colors is not None and colors <= 256:
+            content, reason = 'graphic', f"{colors} رنگ"
+        elif colors is not None and entropy < 4:
+            content, reason = 'graphic', f"آنتروپی کم ({entropy:.1f})"
+        elif colors is not None and edges >= 0.2:
+            # متن و اسکرین‌شات: رنگ‌های لبه‌ی نرم زیاد ولی لبه‌های تیز فراوان
+            content, reason = 'graphic', f"لبه‌های تیز ({edges:.0%})"
+        else:
+            content, reason = 'photo', f"رنگ پیوسته ({colors or '4096+'} رنگ، آنتروپی {entropy:.1f})"
+        return {'content': content, 'reason': reason, 'colors': colors,
+                'entropy': round(entropy, 2), 'edges': round(edges, 3)}
+    
+    def get_content_params(self, format_name: str, save_params: Dict, content: Dict) -> Tuple[Dict, Dict]:
+        """
+        تنظیمات انکود بر اساس نوع محتوا
         
-        elif format_name == 'JPEG':
-            return {
-                **base_params,
-                'quality': self.config['quality'],
-                'progressive': self.config['progressive'],
-            }
+        گرافیک در WebP بدون افت ذخیره می‌شود (libwebp تصاویر کم‌رنگ را خودش palette می‌کند)
+        و در AVIF با speed حداکثر GRAPHIC_AVIF_MAX_SPEED.
+        خروجی: (تنظیمات ذخیره، گزارش انتخاب)
+        """
+        save_params = dict(save_params)
+        choice = {'content': content['content'], 'reason': content['reason']}
+        if content['content'] == 'graphic':
+            if format_name == 'WebP':
+                save_params['lossless'] = True
+                choice['lossless'] = True
+            elif format_name == 'AVIF':
+                save_params['speed'] = min(save_params['speed'], GRAPHIC_AVIF_MAX_SPEED)
+                choice['speed'] = save_params['speed']
+        return save_params, choice
+    
+    def get_thumbnail_params(self, format_name: str) -> Dict:
+        """تنظیمات ذخیره thumbnail (کیفیت حداکثر 80)"""
+        save_params = self.get_save_params(format_name)
+        if format_name == 'WebP':
+            save_params['quality'] = min(self.config['webp_quality'], 80)
+        else:
+            save_params['quality'] = min(self.config['quality'], 80)
+        return save_params
+    
+    def get_thumbnail_path(self, stem: str, output_dir: Path, size: int, format_name: str) -> Path:
+        """مسیر فایل thumbnail"""
+        ext = self.get_output_extension(format_name)
+        return output_dir / f"{stem}_thumb_{size}x{size}{ext}"
+    
+    def encode_thumbnail(self, source, size: int, format_name: str = None) -> io.BytesIO:
+        """ساخت thumbnail یک ورودی (مسیر، bytes یا file-like) در حافظه"""
+        target_format = format_name or self.output_format
+        source, content_hash = self.open_source(source, need_hash=self.render_cache is not None)
         
-        return base_params
+        with Image.open(source) as img:
+            key = None
+            if self.render_cache is not None:
+                key = self.get_render_key(content_hash, target_format, img.size, f'thumbnail:{size}')
+            
+            def render() -> io.BytesIO:
+                save_params = {**self.get_thumbnail_params(target_format), **self.get_metadata_params(img)}
+                # محاسبه اندازه جدید با حفظ نسبت
+                img.thumbnail((size, size), Image.Resampling.LANCZOS)
+                return self.encode_image(img, target_format, save_params)
+            
+            return self.fetch_or_render(key, render)
     
     def create_thumbnail(self, image_path: Path, output_dir: Path, size: int, format_name: str = None):
         """ایجاد thumbnail با اندازه مشخص"""
         target_format = format_name or self.output_format
         
         try:
-            with Image.open(image_path) as img:
-                # محاسبه اندازه جدید با حفظ نسبت
-                img.thumbnail((size, size), Image.Resampling.LANCZOS)
-                
-                # نام فایل thumbnail
-                stem = image_path.stem
-                ext = self.get_output_extension(target_format)
-                thumb_name = f"{stem}_thumb_{size}x{size}{ext}"
-                thumb_path = output_dir / thumb_name
-                
-                # ذخیره thumbnail
-                save_params = self.get_save_params(target_format)
-                if target_format == 'WebP':
-                    save_params['quality'] = min(self.config['webp_quality'], 80)
-                else:
-                    save_params['quality'] = min(self.config['quality'], 80)
-                
-                img.save(thumb_path, target_format, **save_params)
+            buffer = self.encode_thumbnail(image_path, size, target_format)
+            
+            # ذخیره thumbnail
+            self.write_output(self.get_thumbnail_path(image_path.stem, output_dir, size, target_format), buffer)
                 
         except Exception as e:
             print(f"خطا در ایجاد thumbnail برای {image_path}: {str(e)}")
@@ -357,102 +2097,1010 @@ class ImageConverterWeb:
         print(f"حداکثر اندازه={self.config['max_width']}x{self.config['max_height']}")
         print("-" * 60)
         
-        # پیدا کردن همه فایل‌های تصویری
-        image_files = []
-        for root, dirs, files in os.walk(self.source_dir):
-            for file in files:
-                if Path(file).suffix.lower() in self.supported_formats:
-                    image_files.append(Path(root) / file)
-        
-        self.stats['total_files'] = len(image_files)
-        print(f"تعداد فایل‌های یافت شده: {self.stats['total_files']}")
-        
-        # پردازش هر فایل
-        for i, image_path in enumerate(image_files, 1):
-            # محاسبه مسیر نسبی
-            relative_path = image_path.relative_to(self.source_dir)
-            
-            # ایجاد ساختار دایرکتوری در مقاصد
-            output_subdir = self.output_dir / relative_path.parent
-            output_subdir.mkdir(parents=True, exist_ok=True)
-            
-            webp_subdir = None
-            if self.webp_dir and self.config['create_webp']:
-                webp_subdir = self.webp_dir / relative_path.parent
-                webp_subdir.mkdir(parents=True, exist_ok=True)
-            
-            # تعیین نام فایل‌های خروجی
-            base_name = self.sanitize_filename(relative_path.stem)
-            
-            # مسیر فایل اصلی
-            output_filename = base_name + self.get_output_extension()
-            output_path = output_subdir / output_filename
-            
-            # مسیر فایل WebP
-            webp_path = None
-            if webp_subdir:
-                webp_filename = base_name + '.webp'
-                webp_path = webp_subdir / webp_filename
-            
-            # اندازه فایل قبل از تبدیل
-            original_size = image_path.stat().st_size
-            self.stats['total_size_before'] += original_size
-            
-            print(f"\n[{i}/{self.stats['total_files']}] {relative_path}")
-            
-            # تبدیل به فرمت اصلی
-            success_main = self.convert_image(image_path, output_path)
-            if success_main:
-                self.stats['converted_files'] += 1
-                
-                # اندازه فایل بعد از تبدیل
-                if output_path.exists():
-                    new_size = output_path.stat().st_size
-                    self.stats['total_size_after'] += new_size
-                    
-                    # نمایش درصد کاهش حجم
-                    reduction = ((original_size - new_size) / original_size) * 100
-                    print(f"  ✓ {self.output_format}: {reduction:.1f}% کاهش ({original_size:,} -> {new_size:,} بایت)")
-                    
-                    # ایجاد thumbnail برای فرمت اصلی
-                    if self.config['create_thumbnails']:
-                        for size in self.config['thumbnail_sizes']:
-                            self.create_thumbnail(image_path, output_subdir, size)
-            
-            # تبدیل به WebP
-            if webp_path and self.config['create_webp']:
-                success_webp = self.convert_image(image_path, webp_path, 'WebP')
-                if success_webp:
-                    self.stats['webp_converted'] += 1
-                    
-                    if webp_path.exists():
-                        webp_size = webp_path.stat().st_size
-                        self.stats['webp_size_after'] += webp_size
-                        
-                        webp_reduction = ((original_size - webp_size) / original_size) * 100
-                        print(f"  ✓ WebP: {webp_reduction:.1f}% کاهش ({original_size:,} -> {webp_size:,} بایت)")
-                        
-                        # ایجاد thumbnail برای WebP
-                        if self.config['create_thumbnails']:
-                            for size in self.config['thumbnail_sizes']:
-                                self.create_thumbnail(image_path, webp_subdir, size, 'WebP')
+        self.apply_pixel_limit()
+        # تنظیمات ممکن است پس از ساخت مبدل (مثلاً با load_config) تغییر کرده باشد
+        self.render_cache = self.get_render_cache()
+        
+        # manifest باید پیش از ساخت worker ها بارگذاری شود تا به آن‌ها منتقل شود
+        self.config_fingerprint = self.get_config_fingerprint()
+        # EXIF/XMP سفارشی هم پیش از ساخت worker ها ساخته می‌شود تا همه‌ی خروجی‌ها یک تاریخ تبدیل داشته باشند
+        self.get_custom_metadata()
+        if self.config['size_guard'] and self.output_format == 'AVIF' and self.has_custom_metadata():
+            print("⚠ مبدای AVIF نگه داشته نمی‌شود: EXIF/XMP سفارشی بدون انکود به AVIF اضافه نمی‌شود")
+        if self.config['incremental']:
+            self.load_manifest()
+        
+        # فایل‌های تکمیل‌شده در اجرای قطع‌شده‌ی قبلی
+        completed = self.load_checkpoint() if self.config['resume'] else set()
+        
+        if self.config['shard']:
+            print(f"شارد {self.config['shard'][0]} از {self.config['shard'][1]}")
+        work_queue = None
+        if self.config['queue_dir']:
+            work_queue = WorkQueue(self.config['queue_dir'], self.config['lease_ttl'], self.get_node_id())
+            work_queue.open(self.config_fingerprint)
+            print(f"صف کار مشترک: {work_queue.queue_dir} (نود {work_queue.node_id})")
+        
+        seen_files = set(completed)
+        # خروجی‌های نوشته شده برای fsync دسته‌ای در پایان اجرا
+        written_files = set()
+        workers = self.get_worker_count()
+        self.stop_requested = False
+        with ExitStack() as stack:
+            # سیگنال‌ها پیش از ساخت worker ها گرفته می‌شوند
+            self.install_signal_handlers(stack)
+            if work_queue is not None:
+                # lease هایی که تمام نشده‌اند در پایان (یا توقف) آزاد می‌شوند
+                stack.callback(work_queue.release_all)
+                stack.callback(work_queue.stop_heartbeat)
             
-            if not success_main and (not webp_path or not success_webp):
-                self.stats['failed_files'] += 1
-                print(f"  ✗ تبدیل ناموفق")
+            if workers > 1:
+                print(f"پردازش موازی با {workers} پروسه")
+                executor = stack.enter_context(ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_worker, initargs=(self,)))
+                # worker ها پیش از شروع thread جستجو ساخته می‌شوند (fork در حضور thread امن نیست)
+                executor.submit(int).result()
+            
+            # جستجوی فایل‌ها هم‌زمان با تبدیل؛ اولین فایل بلافاصله پردازش می‌شود
+            scanner_stop = threading.Event()
+            stack.callback(scanner_stop.set)
+            image_files = self.filter_pending(self.stream_image_files(scanner_stop), completed, work_queue)
+            if work_queue is not None:
+                work_queue.start_heartbeat()
+            
+            if workers > 1:
+                results = self.map_in_pool(executor, image_files, max_pending=workers * 4)
+            else:
+                # پردازش هر فایل
+                results = self.map_serial(image_files)
+            
+            # رکوردهای جدید بلافاصله به manifest اضافه می‌شوند تا اجرای نیمه‌کاره هم ثبت شود
+            journal = None
+            if self.config['incremental']:
+                journal = stack.enter_context(open(self.get_manifest_path(), 'a', encoding='utf-8'))
+            # هر فایل تکمیل‌شده بلافاصله در checkpoint ثبت می‌شود
+            checkpoint = stack.enter_context(self.open_checkpoint(append=bool(completed)))
+            
+            for i, result in enumerate(results, 1):
+                self.report_result(i, result)
+                seen_files.add(result['relative_path'])
+                if result['failed_list']:
+                    self.dedup_failed.add(result['relative_path'])
+                if self.config['fsync'] == 'batch':
+                    written_files.update(result['outputs'].values())
+                entry = result['manifest_entry']
+                if journal and entry:
+                    journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                    journal.flush()
+                    self.manifest[entry['source']] = entry
+                if work_queue is not None:
+                    work_queue.complete(work_queue.get_key(result['relative_path']), bool(result['failed_list']))
+                # فایل‌های ناموفق ثبت نمی‌شوند تا در ادامه‌ی اجرا دوباره امتحان شوند
+                if not result['failed_list']:
+                    checkpoint.write(json.dumps({'source': result['relative_path']}, ensure_ascii=False) + '\n')
+                    checkpoint.flush()
+        
+        if self.stop_requested:
+            print(f"\n⚠️  اجرا متوقف شد؛ برای ادامه از --resume استفاده کنید ({self.get_checkpoint_path()})")
+        else:
+            # اجرای کامل؛ checkpoint دیگر لازم نیست
+            self.get_checkpoint_path().unlink(missing_ok=True)
+        
+        if self.config['incremental']:
+            if self.config['prune_deleted']:
+                self.prune_manifest(seen_files)
+            self.save_manifest()
+            written_files.add(str(self.get_manifest_path()))
+        
+        if self.config['fsync'] == 'batch' and written_files:
+            self.sync_outputs(written_files)
+        
+        # اعمال حد حجم کش پس از اضافه شدن خروجی‌های جدید
+        if self.render_cache is not None:
+            removed, freed = self.render_cache.prune()
+            if removed:
+                print(f"کش رندر: {removed} فایل قدیمی ({freed / (1024 * 1024):.1f} MB) حذف شد")
         
         # نمایش آمار نهایی
         self.show_final_stats()
+        self.export_metrics()
+    
+    def install_signal_handlers(self, stack: ExitStack):
+        """گرفتن SIGINT و SIGTERM برای توقف تدریجی (فقط در thread اصلی ممکن است)"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            previous = signal.signal(signum, self.request_stop)
+            stack.callback(signal.signal, signum, previous)
+    
+    def request_stop(self, signum, frame):
+        """handler سیگنال: اولین سیگنال توقف تدریجی، سیگنال دوم توقف فوری"""
+        if self.stop_requested:
+            raise KeyboardInterrupt
+        self.stop_requested = True
+        print(f"\n⚠️  سیگنال {signal.Signals(signum).name} دریافت شد؛ منتظر اتمام تبدیل‌های در حال اجرا "
+              f"(برای توقف فوری دوباره Ctrl+C بزنید)", flush=True)
+    
+    def filter_pending(self, image_files: Iterator[Path], completed: set,
+                       work_queue: WorkQueue = None) -> Iterator[Optional[Path]]:
+        """
+        فایل‌هایی که این اجرا باید پردازش کند
+        
+        فایل‌های تکمیل‌شده در checkpoint و فایل‌های شاردهای دیگر رد می‌شوند؛ با صف کار فقط فایل‌هایی
+        که lease آن‌ها گرفته شود برگردانده می‌شوند. پس از درخواست توقف فایل جدیدی برگردانده نمی‌شود.
+        پیش از هر انتظار برای فایل‌های نودهای دیگر None برگردانده می‌شود تا کارهای در جریان همین
+        پروسه تحویل و lease آن‌ها آزاد شود (وگرنه دو نود منتظر یکدیگر می‌مانند).
+        """
+        # فایل‌هایی که در اختیار نود دیگری هستند؛ پس از پیمایش تا تمام شدن یا منقضی شدن lease بررسی می‌شوند
+        deferred = []
+        for image_path in image_files:
+            if self.stop_requested:
+                return
+            relative_path = image_path.relative_to(self.source_dir).as_posix()
+            if completed and relative_path in completed:
+                self.stats['resumed_files'] += 1
+                self.output_planner.pop(Path(relative_path))
+                continue
+            if self.config['shard'] and not self.in_shard(relative_path):
+                self.output_planner.pop(Path(relative_path))
+                continue
+            if work_queue is not None:
+                key = work_queue.get_key(relative_path)
+                if work_queue.is_done(key):
+                    self.stats['other_node_files'] += 1
+                    self.output_planner.pop(Path(relative_path))
+                    continue
+                if not work_queue.try_claim(key, relative_path):
+                    deferred.append((image_path, relative_path, key))
+                    continue
+            yield image_path
+        
+        while deferred:
+            yield None
+            # فاصله‌ی بررسی کوتاه‌تر از مدت lease تا فایل نود از کار افتاده زود گرفته شود
+            time.sleep(min(5.0, work_queue.lease_ttl / 4))
+            waiting = []
+            for image_path, relative_path, key in deferred:
+                if self.stop_requested:
+                    return
+                if work_queue.is_done(key):
+                    self.stats['other_node_files'] += 1
+                    self.output_planner.pop(Path(relative_path))
+                elif work_queue.try_claim(key, relative_path):
+                    yield image_path
+                else:
+                    waiting.append((image_path, relative_path, key))
+            deferred = waiting
+    
+    def in_shard(self, relative_path: str) -> bool:
+        """آیا فایل به شارد این اجرا تعلق دارد (قطعی و مستقل از ترتیب پیمایش)"""
+        index, count = self.config['shard']
+        digest = hashlib.sha256(relative_path.encode('utf-8')).digest()
+        return int.from_bytes(digest[:8], 'big') % count == index
+    
+    def iter_image_files(self) -> Iterator[Path]:
+        """
+        پیمایش بازگشتی دایرکتوری مبدا با os.scandir و تولید تدریجی مسیر تصاویر
+        
+        نام خروجی همه‌ی تصاویر هر دایرکتوری پیش از تحویل اولین فایل آن برنامه‌ریزی می‌شود
+        (فقط فهرست نام‌های همان دایرکتوری در حافظه نگه داشته می‌شود).
+        """
+        pending_dirs = [self.source_dir]
+        while pending_dirs:
+            current = pending_dirs.pop()
+            subdirs = []
+            filenames = []
+            try:
+                with os.scandir(current) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(Path(entry.path))
+                            elif os.path.splitext(entry.name)[1].lower() in self.supported_formats:
+                                filenames.append(entry.name)
+                        except OSError:
+                            continue
+            except OSError as e:
+                print(f"خطا در خواندن دایرکتوری {current}: {str(e)}")
+                continue
+            
+            relative_dir = current.relative_to(self.source_dir)
+            # نام خروجی فایل‌های تبدیل‌شده در اجرای قبل تغییر نمی‌کند
+            previous = {}
+            if self.manifest:
+                for filename in filenames:
+                    entry = self.manifest.get((relative_dir / filename).as_posix())
+                    if entry and entry.get('names'):
+                        previous[filename] = tuple(entry['names'])
+            for filename, name in self.output_planner.plan_directory(relative_dir, filenames, previous):
+                self.stats['renamed_outputs'] += 1
+                print(f"⚠ نام خروجی {(relative_dir / filename).as_posix()} با فایل دیگری یکسان بود؛ "
+                      f"خروجی با نام {name} ساخته می‌شود")
+            for filename in filenames:
+                yield current / filename
+            # حفظ ترتیب پیمایش مانند os.walk
+            pending_dirs.extend(reversed(subdirs))
+    
+    def stream_image_files(self, stop_event: threading.Event) -> Iterator[Path]:
+        """
+        اجرای جستجو در یک thread جداگانه و تحویل فایل‌ها از طریق صف محدود
+        
+        self.stats['total_files'] تعداد فایل‌های یافت شده تا این لحظه است.
+        """
+        file_queue = queue.Queue(maxsize=self.config['scan_queue_size'])
+        self.stats['total_files'] = 0
+        self.scan_complete = False
+        
+        def put(item) -> bool:
+            while not stop_event.is_set():
+                try:
+                    file_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def scan():
+            try:
+                for path in self.iter_image_files():
+                    self.stats['total_files'] += 1
+                    if not put(path):
+                        return
+            finally:
+                self.scan_complete = True
+                put(_SCAN_DONE)
+        
+        threading.Thread(target=scan, name='image-scanner', daemon=True).start()
+        while True:
+            item = file_queue.get()
+            if item is _SCAN_DONE:
+                return
+            yield item
+    
+    def map_in_pool(self, executor: ProcessPoolExecutor, image_files: Iterator[Optional[Path]],
+                    max_pending: int) -> Iterator[Dict]:
+        """
+        ارسال فایل‌ها به pool با تعداد محدود کار در جریان و برگرداندن نتایج به ترتیب ورودی
+        
+        با max_memory، مجموع حافظه‌ی تخمینی کارهای در جریان از بودجه بیشتر نمی‌شود و
+        تصاویری که به‌تنهایی از بودجه بزرگ‌ترند بدون هیچ کار هم‌زمانی اجرا می‌شوند.
+        """
+        budget = self.config['max_memory']
+        # (future یا فایل تکراری، حافظه‌ی تخمینی)
+        pending = deque()
+        in_flight = 0
+        
+        def finish_oldest() -> Dict:
+            nonlocal in_flight
+            task, estimate = pending.popleft()
+            in_flight -= estimate
+            if isinstance(task, dict):
+                # فایل بدون تغییر که در همین پروسه رد شده است
+                return task
+            if isinstance(task, tuple):
+                # فایل تکراری؛ فایل اصلی پیش از این گزارش شده است
+                return self.link_duplicate(*task)
+            return task.result()
+        
+        def cancel_queued():
+            # پس از درخواست توقف، کارهایی که هنوز شروع نشده‌اند لغو و فقط تبدیل‌های در حال اجرا تمام می‌شوند
+            running = [item for item in pending if not isinstance(item[0], (tuple, dict)) and not item[0].cancel()]
+            pending.clear()
+            pending.extend(running)
+        
+        for image_path in image_files:
+            if image_path is None:
+                # انتظار برای فایل‌های نود دیگر: تحویل همه‌ی نتایج در جریان
+                while pending:
+                    yield finish_oldest()
+                continue
+            output_names = self.take_output_names(image_path.relative_to(self.source_dir))
+            if self.config['deduplicate']:
+                skipped, canonical, content_hash = self.check_duplicate(image_path, output_names)
+                if skipped is not None or canonical is not None:
+                    task = skipped if skipped is not None else (image_path, canonical, content_hash, output_names)
+                    pending.append((task, 0))
+                    if len(pending) >= max_pending:
+                        yield finish_oldest()
+                    continue
+            
+            estimate = self.estimate_memory(image_path) if budget else 0
+            
+            if budget and estimate >= budget:
+                # اجرای جداگانه: صبر برای پایان همه‌ی کارهای در جریان
+                while pending:
+                    yield finish_oldest()
+                result = executor.submit(_process_in_worker, image_path, output_names).result()
+                result['log'].insert(0, f"  ⚠ حافظه تخمینی {estimate / (1024 * 1024):.0f} MB بیش از بودجه است؛ به‌تنهایی اجرا شد")
+                yield result
+                continue
+            
+            while pending and (len(pending) >= max_pending or (budget and in_flight + estimate > budget)):
+                yield finish_oldest()
+            if self.stop_requested:
+                break
+            pending.append((executor.submit(_process_in_worker, image_path, output_names), estimate))
+            in_flight += estimate
+        while pending:
+            if self.stop_requested:
+                cancel_queued()
+                if not pending:
+                    break
+            yield finish_oldest()
+    
+    def map_serial(self, image_files: Iterator[Optional[Path]]) -> Iterator[Dict]:
+        """پردازش فایل‌ها در همین پروسه"""
+        for image_path in image_files:
+            if image_path is None:
+                continue
+            output_names = self.take_output_names(image_path.relative_to(self.source_dir))
+            if self.config['deduplicate']:
+                skipped, canonical, content_hash = self.check_duplicate(image_path, output_names)
+                if skipped is not None:
+                    yield skipped
+                    continue
+                if canonical is not None:
+                    yield self.link_duplicate(image_path, canonical, content_hash, output_names)
+                    continue
+            yield self.process_file(image_path, output_names)
+    
+    def check_duplicate(self, image_path: Path, output_names: Tuple[str, str]) -> Tuple[Dict, Path, str]:
+        """
+        بررسی یک فایل در پروسه‌ی اصلی پیش از ارسال برای تبدیل (با dedup)
+        
+        با incremental ابتدا manifest بررسی می‌شود: فایل بدون تغییر (از جمله تکراری‌ای که قبلاً لینک شده)
+        دوباره hash یا لینک نمی‌شود و فقط hash ثبت‌شده‌ی آن برای تکراری‌های بعدی ثبت می‌شود.
+        خروجی: (نتیجه‌ی رد شده یا None، فایل اصلی یا None، hash محتوا یا None)
+        """
+        content_hash = None
+        if self.config['incremental']:
+            try:
+                skipped, content_hash = self.check_unchanged(image_path, output_names)
+            except OSError:
+                # خطای خواندن توسط تبدیل عادی گزارش می‌شود
+                return None, None, None
+            if skipped is not None:
+                self.find_duplicate(image_path, content_hash)
+                return skipped, None, None
+        canonical, content_hash = self.find_duplicate(image_path, content_hash)
+        return None, canonical, content_hash
+    
+    def find_duplicate(self, image_path: Path, content_hash: str = None) -> Tuple[Path, str]:
+        """
+        یافتن فایل قبلی با محتوای یکسان در همین اجرا
+        
+        فقط فایل‌هایی hash می‌شوند که اندازه‌ی آن‌ها با فایل دیگری برابر است.
+        content_hash: hash از پیش معلوم (مثلاً از manifest) که بدون خواندن دوباره‌ی فایل ثبت می‌شود
+        خروجی: (فایل اصلی یا None، hash محتوا یا None)
+        """
+        try:
+            size = image_path.stat().st_size
+            if content_hash is None and size not in self.dedup_sizes:
+                self.dedup_sizes[size] = image_path
+                return None, None
+            
+            first = self.dedup_sizes.get(size)
+            if first is not None:
+                # اولین فایل با این اندازه تا الان hash نشده بود
+                self.dedup_hashes.setdefault(self.hash_file(first), first)
+            self.dedup_sizes[size] = None
+            if content_hash is None:
+                content_hash = self.hash_file(image_path)
+        except OSError:
+            # خطای خواندن توسط تبدیل عادی گزارش می‌شود
+            return None, None
+        
+        canonical = self.dedup_hashes.setdefault(content_hash, image_path)
+        return (canonical if canonical != image_path else None), content_hash
+    
+    def link_or_copy(self, source: Path, destination: Path, hardlink: bool = None):
+        """
+        ساخت خروجی از یک فایل موجود با hardlink (یا کپی در صورت عدم امکان)
+        
+        hardlink: None یعنی بر اساس تنظیم dedup_link
+        """
+        if destination.exists() and os.path.samefile(source, destination):
+            return
+        if hardlink is None:
+            hardlink = self.config['dedup_link'] == 'hardlink'
+        # مانند write_output، خروجی در مسیر موقت ساخته و به‌صورت اتمیک جایگزین می‌شود
+        tmp_path = self.get_temp_path(destination)
+        try:
+            linked = False
+            if hardlink:
+                try:
+                    os.link(source, tmp_path)
+                    linked = True
+                except OSError:
+                    # فایل‌سیستم متفاوت یا بدون پشتیبانی hardlink
+                    pass
+            if not linked:
+                # ابتدا کپی copy-on-write (بدون کپی داده)، در غیر این صورت کپی عادی
+                if not reflink_file(source, tmp_path):
+                    shutil.copyfile(source, tmp_path)
+                if self.config['fsync'] == 'file':
+                    fd = os.open(tmp_path, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        if self.config['fsync'] == 'file':
+            fsync_directory(destination.parent)
+    
+    def link_duplicate(self, image_path: Path, canonical: Path, content_hash: str,
+                       output_names: Tuple[str, str] = None) -> Dict:
+        """ساخت خروجی‌های یک فایل تکراری از خروجی‌های فایل اصلی بدون انکود دوباره"""
+        relative_path = image_path.relative_to(self.source_dir)
+        output_names = output_names or self.get_output_names(relative_path)
+        canonical_relative = canonical.relative_to(self.source_dir)
+        if canonical_relative.as_posix() in self.dedup_failed:
+            return self.process_file(image_path, output_names)
+        
+        canonical_names = (self.dedup_names.get(canonical_relative.as_posix()) or
+                           self.get_output_names(canonical_relative))
+        canonical_files = self.get_output_files(self.plan_outputs(canonical_relative, canonical_names),
+                                                canonical_names[1])
+        existing = {role: path for role, path in canonical_files.items() if path.exists()}
+        if '0' not in existing and '1' not in existing:
+            # فایل اصلی خروجی ندارد؛ تبدیل عادی
+            return self.process_file(image_path, output_names)
+        
+        result = self.new_result(relative_path)
+        source_stat = image_path.stat()
+        result['size_before'] = source_stat.st_size
+        files = self.get_output_files(self.plan_outputs(relative_path, output_names), output_names[1])
+        
+        try:
+            for role, source in existing.items():
+                destination = files[role]
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                if role.endswith(':srcset-json'):
+                    # مسیرهای داخل JSON به نام فایل‌های همین تکراری اشاره می‌کنند
+                    renames = {existing[other].name: files[other].name for other in existing}
+                    self.copy_srcset_manifest(source, destination, renames)
+                else:
+                    self.link_or_copy(source, destination)
+                result['outputs'][role] = os.path.abspath(destination)
+        except (OSError, ValueError) as e:
+            print(f"خطا در ساخت خروجی‌های تکراری {image_path}: {str(e)}")
+            return self.process_file(image_path, output_names)
+        
+        if '0' in result['outputs']:
+            result['converted'] = True
+            result['size_after'] = existing['0'].stat().st_size
+        if '1' in result['outputs']:
+            result['webp_converted'] = True
+            result['webp_size_after'] = existing['1'].stat().st_size
+        result['deduplicated'] = True
+        result['encodes_saved'] = len(result['outputs'])
+        result['log'].append(f"  ⇆ تکراری از {canonical_relative.as_posix()}: "
+                             f"{result['encodes_saved']} خروجی بدون انکود ساخته شد")
+        
+        if self.config['incremental']:
+            result['manifest_entry'] = self.build_manifest_entry(
+                result['relative_path'], source_stat, content_hash, list(result['outputs'].values()), output_names)
+        return result
+    
+    def estimate_memory(self, image_path: Path) -> int:
+        """
+        تخمین حافظه‌ی لازم برای تبدیل یک تصویر فقط از روی header (بدون رمزگشایی)
+        
+        شامل تصویر رمزگشایی‌شده (با در نظر گرفتن draft در JPEG)، نسخه‌ی تغییر اندازه‌یافته و
+        نسخه‌ی بدون شفافیت آن. در صورت خطا صفر برمی‌گردد تا worker خطا را گزارش کند.
+        """
+        try:
+            with Image.open(image_path) as img:
+                width, height = img.size
+                mode = img.mode
+                is_jpeg = img.format == 'JPEG'
+        except Exception:
+            return 0
+        
+        bytes_per_pixel = MODE_BYTES_PER_PIXEL.get(mode, 4)
+        target_size = self.get_target_size(width, height)
+        decoded_width, decoded_height = width, height
+        if target_size is not None and is_jpeg and self.can_reduce((width, height), target_size):
+            # draft با مقیاس 1/2، 1/4 یا 1/8 تا وقتی از اندازه مقصد کوچک‌تر نشود
+            scale = 1
+            while (scale < 8 and width // (scale * 2) >= target_size[0] and
+                   height // (scale * 2) >= target_size[1]):
+                scale *= 2
+            decoded_width, decoded_height = -(-width // scale), -(-height // scale)
+        
+        decoded = decoded_width * decoded_height * bytes_per_pixel
+        output_width, output_height = target_size or (width, height)
+        output = output_width * output_height * 4
+        # تصویر اصلی + نسخه‌ی تغییر اندازه‌یافته + نسخه‌ی بدون شفافیت + بافرهای انکودر
+        return int(decoded + output * 2 + output * 0.5)
+    
+    def apply_pixel_limit(self):
+        """اعمال حد پیکسل‌های Pillow (محافظت در برابر decompression bomb)"""
+        max_pixels = self.config['max_image_pixels']
+        if max_pixels is None:
+            return
+        # صفر یعنی غیرفعال کردن کامل بررسی
+        Image.MAX_IMAGE_PIXELS = max_pixels or None
+    
+    def get_worker_count(self) -> int:
+        """تعیین تعداد پروسه‌های پردازش (پیش‌فرض: تعداد هسته‌های CPU)"""
+        workers = self.config['workers']
+        if not workers or workers < 1:
+            workers = os.cpu_count() or 1
+        return workers
+    
+    def new_result(self, relative_path: Path) -> Dict:
+        """ساختار خالی نتیجه‌ی پردازش یک فایل"""
+        return {
+            'relative_path': relative_path.as_posix(),
+            'size_before': 0,
+            'converted': False,
+            'size_after': 0,
+            'webp_converted': False,
+            'webp_size_after': 0,
+            'failed': False,
+            'skipped': False,
+            'failed_list': [],
+            'manifest_entry': None,
+            'timings': {},
+            'encode_choices': {},
+            # نوع محتوای تشخیص داده شده (با --content-aware)
+            'content': None,
+            # نقش خروجی (مانند '0' یا '1:thumb:150') -> مسیر فایل ساخته شده
+            'outputs': {},
+            'deduplicated': False,
+            'encodes_saved': 0,
+            # تعداد خروجی‌هایی که همان بایت‌های مبدا هستند (با --size-guard)
+            'passthrough': 0,
+            'render_cache': {'hits': 0, 'misses': 0},
+            'log': [],
+        }
+    
+    def get_output_names(self, relative_path: Path) -> Tuple[str, str]:
+        """
+        نام فایل خروجی و نام پایه‌ی thumbnail های یک فایل مبدا
+        
+        از برنامه‌ی OutputPlanner (بدون برخورد با فایل‌های دیگر همان دایرکتوری)؛ برای فایل‌هایی که
+        دایرکتوری آن‌ها برنامه‌ریزی نشده، مستقیماً از نام مبدا.
+        """
+        return (self.output_planner.get(relative_path) or
+                (self.sanitize_filename(relative_path.stem), relative_path.stem))
+    
+    def take_output_names(self, relative_path: Path) -> Tuple[str, str]:
+        """
+        نام‌های خروجی یک فایل هنگام ارسال آن برای تبدیل (برنامه‌ی آن از OutputPlanner برداشته می‌شود)
+        
+        با deduplicate نام‌ها برای ساخت خروجی تکراری‌های بعدی همین فایل نگه داشته می‌شوند.
+        """
+        output_names = (self.output_planner.pop(relative_path) or
+                        (self.sanitize_filename(relative_path.stem), relative_path.stem))
+        if self.config['deduplicate']:
+            self.dedup_names[relative_path.as_posix()] = output_names
+        return output_names
+    
+    def get_output_filenames(self, output_names: Tuple[str, str]) -> List[str]:
+        """نام همه‌ی فایل‌های خروجی (بدون دایرکتوری) برای نام‌های داده شده؛ برای بررسی برخورد در OutputPlanner"""
+        targets = self.plan_outputs(Path(output_names[1]), output_names)
+        return [path.name for path in self.get_output_files(targets, output_names[1]).values()]
+    
+    def plan_outputs(self, relative_path: Path, output_names: Tuple[str, str] = None) -> List[Tuple[str, Path, Path]]:
+        """
+        مسیرهای خروجی یک فایل مبدا: فهرست (فرمت، مسیر خروجی، دایرکتوری thumbnail ها)
+        
+        output_names: خروجی get_output_names در صورتی که از قبل محاسبه شده باشد (مثلاً در worker)
+        """
+        # تعیین نام فایل‌های خروجی
+        base_name = (output_names or self.get_output_names(relative_path))[0]
+        
+        # مسیر فایل اصلی
+        output_subdir = self.output_dir / relative_path.parent
+        targets = [(self.output_format, output_subdir / (base_name + self.get_output_extension()), output_subdir)]
+        
+        # مسیر فایل WebP
+        if self.webp_dir and self.config['create_webp']:
+            webp_subdir = self.webp_dir / relative_path.parent
+            targets.append(('WebP', webp_subdir / (base_name + '.webp'), webp_subdir))
+        return targets
+    
+    def get_output_files(self, targets: List[Tuple[str, Path, Path]], stem: str) -> Dict[str, Path]:
+        """همه‌ی فایل‌های خروجی مورد انتظار با کلید نقش (برای نگاشت خروجی‌ها بین فایل‌ها)"""
+        files = {}
+        for index, (target_format, path, thumb_dir) in enumerate(targets):
+            files[str(index)] = path
+            if self.config['create_thumbnails']:
+                for size in self.config['thumbnail_sizes']:
+                    files[f"{index}:thumb:{size}"] = self.get_thumbnail_path(stem, thumb_dir, size, target_format)
+            if self.config['srcset_widths']:
+                for width in self.config['srcset_widths']:
+                    files[f"{index}:srcset:{width}"] = self.get_rendition_path(path, width)
+                files[f"{index}:srcset-json"] = self.get_srcset_manifest_path(path)
+        return files
+    
+    def check_unchanged(self, image_path: Path, output_names: Tuple[str, str],
+                        targets: List[Tuple[str, Path, Path]] = None,
+                        source_stat: os.stat_result = None) -> Tuple[Dict, str]:
+        """
+        بررسی manifest برای فایلی که مبدا، تنظیمات و نام خروجی‌های آن از اجرای قبل تغییر نکرده است
+        
+        خروجی: (نتیجه‌ی رد شده یا None، hash محتوا در صورتی که محاسبه شده باشد)
+        """
+        relative_path = image_path.relative_to(self.source_dir)
+        source_stat = source_stat or image_path.stat()
+        targets = targets or self.plan_outputs(relative_path, output_names)
+        result = self.new_result(relative_path)
+        entry = self.manifest.get(result['relative_path'])
+        planned = {os.path.abspath(path) for path in self.get_output_files(targets, output_names[1]).values()}
+        up_to_date, content_hash = self.check_manifest(entry, image_path, source_stat, planned)
+        if not up_to_date:
+            return None, content_hash
+        
+        result['skipped'] = True
+        result['log'].append("  ↷ بدون تغییر (رد شد)")
+        if (entry['size'] != source_stat.st_size or entry['mtime_ns'] != source_stat.st_mtime_ns or
+                entry.get('names') != list(output_names)):
+            # فقط زمان تغییر فایل عوض شده (یا رکورد قدیمی بدون نام‌ها)؛ رکورد به‌روز می‌شود تا دوباره hash نشود
+            result['manifest_entry'] = self.build_manifest_entry(
+                result['relative_path'], source_stat, content_hash, entry['outputs'], output_names)
+        return result, content_hash
+    
+    def process_file(self, image_path: Path, output_names: Tuple[str, str] = None) -> Dict:
+        """
+        تبدیل یک فایل به همه‌ی خروجی‌ها و برگرداندن نتیجه برای ادغام در آمار
+        
+        output_names: نام‌های برنامه‌ریزی شده در پروسه‌ی اصلی (worker ها برنامه‌ی دایرکتوری‌ها را ندارند)
+        """
+        # محاسبه مسیر نسبی
+        relative_path = image_path.relative_to(self.source_dir)
+        output_names = output_names or self.get_output_names(relative_path)
+        result = self.new_result(relative_path)
+        start_time = time.perf_counter()
+        # خطاهای تبدیل در failed_list ثبت می‌شوند؛ فقط موارد این فایل برگردانده می‌شود
+        failed_mark = len(self.stats['failed_list'])
+        
+        # رد کردن فایل‌هایی که مبدا و تنظیمات آن‌ها از اجرای قبل تغییر نکرده است
+        source_stat = image_path.stat()
+        content_hash = None
+        targets = self.plan_outputs(relative_path, output_names)
+        if self.config['incremental']:
+            skipped, content_hash = self.check_unchanged(image_path, output_names, targets, source_stat)
+            if skipped is not None:
+                return skipped
+        
+        # ایجاد ساختار دایرکتوری در مقاصد (هر دایرکتوری یک بار در هر پروسه)
+        self.output_planner.make_dirs(target_dir for _, _, target_dir in targets)
+        
+        # اندازه فایل قبل از تبدیل
+        original_size = source_stat.st_size
+        result['size_before'] = original_size
+        
+        # وقتی hash لازم است، فایل یک بار خوانده و hash و رمزگشایی هر دو از حافظه انجام می‌شوند
+        source = None
+        if content_hash is None and (self.config['incremental'] or self.render_cache is not None):
+            try:
+                with measure(result['timings'], 'read'):
+                    source, content_hash = self.open_source(image_path, need_hash=True)
+            except OSError:
+                # خطای خواندن در render_outputs ثبت می‌شود
+                pass
+        
+        # یک بار رمزگشایی و ساخت همه‌ی خروجی‌ها
+        outputs = self.render_outputs(image_path, targets, result['timings'], result['encode_choices'],
+                                      content_hash, result['render_cache'], source, output_names[1])
+        for target_format, choice in result['encode_choices'].items():
+            details = '، '.join(f"{key}={value}" for key, value in choice.items())
+            result['log'].append(f"  ⚙ {target_format}: {details}")
+            result['content'] = choice.get('content', result['content'])
+        
+        # فرمت اصلی
+        success_main = outputs[0] is not None
+        if success_main:
+            result['converted'] = True
+            
+            # اندازه فایل بعد از تبدیل (از بافر نوشته شده)
+            new_size = outputs[0]['size']
+            result['size_after'] = new_size
+            
+            # نمایش درصد کاهش حجم
+            reduction = ((original_size - new_size) / original_size) * 100
+            result['log'].append(f"  ✓ {self.output_format}: {reduction:.1f}% کاهش ({original_size:,} -> {new_size:,} بایت)")
+            if outputs[0]['passthrough'] is not None:
+                result['passthrough'] += 1
+                result['log'].append(f"  ⇢ {self.output_format}: مبدا بدون انکود نگه داشته شد ({outputs[0]['passthrough']})")
+        
+        # WebP
+        success_webp = len(outputs) > 1 and outputs[1] is not None
+        if success_webp:
+            result['webp_converted'] = True
+            
+            webp_size = outputs[1]['size']
+            result['webp_size_after'] = webp_size
+            
+            webp_reduction = ((original_size - webp_size) / original_size) * 100
+            result['log'].append(f"  ✓ WebP: {webp_reduction:.1f}% کاهش ({original_size:,} -> {webp_size:,} بایت)")
+            if outputs[1]['passthrough'] is not None:
+                result['passthrough'] += 1
+                result['log'].append(f"  ⇢ WebP: مبدا بدون انکود نگه داشته شد ({outputs[1]['passthrough']})")
+        
+        if not success_main and not success_webp:
+            result['failed'] = True
+            result['log'].append(f"  ✗ تبدیل ناموفق")
+        
+        result['failed_list'] = self.stats['failed_list'][failed_mark:]
+        del self.stats['failed_list'][failed_mark:]
+        
+        # خروجی‌های ساخته شده (فقط target ها و thumbnail های نوشته شده)
+        written = set()
+        for index, output in enumerate(outputs):
+            if output is not None:
+                written.add(str(index))
+                written.update(f"{index}:thumb:{size}" for size in output['thumbnails'])
+                written.update(f"{index}:srcset:{width}" for width in output['renditions'])
+                if output['srcset'] is not None:
+                    written.add(f"{index}:srcset-json")
+        for role, path in self.get_output_files(targets, output_names[1]).items():
+            if role in written:
+                result['outputs'][role] = os.path.abspath(path)
+        
+        # فقط تبدیل‌های کاملاً موفق ثبت می‌شوند تا بقیه در اجرای بعد تکرار شوند
+        if self.config['incremental'] and not result['failed_list']:
+            result['manifest_entry'] = self.build_manifest_entry(
+                result['relative_path'], source_stat, content_hash or self.hash_file(image_path),
+                list(result['outputs'].values()), output_names)
+        
+        result['timings']['total'] = time.perf_counter() - start_time
+        return result
+    
+    def report_result(self, index: int, result: Dict):
+        """ادغام نتیجه‌ی یک فایل در self.stats و نمایش گزارش آن"""
+        # تا پایان جستجو تعداد کل هنوز مشخص نیست
+        total = f"{self.stats['total_files']}" if self.scan_complete else f"{self.stats['total_files']}+"
+        print(f"\n[{index}/{total}] {result['relative_path']}")
+        self.stats['processed_files'] += 1
+        for line in result['log']:
+            print(line)
+        
+        self.stats['total_size_before'] += result['size_before']
+        if result['converted']:
+            self.stats['converted_files'] += 1
+            self.stats['total_size_after'] += result['size_after']
+        if result['webp_converted']:
+            self.stats['webp_converted'] += 1
+            self.stats['webp_size_after'] += result['webp_size_after']
+        if result['failed']:
+            self.stats['failed_files'] += 1
+        self.stats['render_cache_hits'] += result['render_cache']['hits']
+        self.stats['render_cache_misses'] += result['render_cache']['misses']
+        self.stats['passthrough_outputs'] += result['passthrough']
+        if result['content']:
+            classes = self.stats['content_classes']
+            classes[result['content']] = classes.get(result['content'], 0) + 1
+        if result['skipped']:
+            self.stats['skipped_files'] += 1
+        elif result['deduplicated']:
+            self.stats['deduplicated_files'] += 1
+            self.stats['encodes_saved'] += result['encodes_saved']
+        else:
+            self.metrics.add_file(result['relative_path'], result['timings'])
+        self.stats['failed_list'].extend(result['failed_list'])
+    
+    def get_config_fingerprint(self) -> str:
+        """اثر انگشت تنظیماتی که روی خروجی تأثیر دارند"""
+        formats = [self.output_format]
+        if self.webp_dir and self.config['create_webp']:
+            formats.append('WebP')
+        settings = {
+            'formats': formats,
+            'save_params': {name: self.get_save_params(name) for name in formats},
+            'resize': [self.config['optimize_for_web'], self.config['max_width'], self.config['max_height'],
+                       self.config['fast_decode']],
+            'thumbnails': self.config['thumbnail_sizes'] if self.config['create_thumbnails'] else [],
+            'srcset_widths': sorted(set(self.config['srcset_widths'])),
+            'preserve_transparency': self.config['preserve_transparency'],
+            'adaptive': [self.config['target_ssim'], self.config['time_budget'], self.config['min_quality'],
+                         self.config['adaptive_proxy_size']],
+            'content_aware': self.config['content_aware'],
+            'animation': [self.config['animation'], self.config['animated_thumbnails']],
+            'seo_friendly_names': self.config['seo_friendly_names'],
+            'remove_exif': self.config['remove_exif'],
+            'custom_exif': self.config['custom_exif'],
+            'write_xmp': self.config['write_xmp'],
+            'size_guard': self.config['size_guard'],
+        }
+        data = json.dumps(settings, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()[:16]
+    
+    def hash_file(self, path: Path) -> str:
+        """محاسبه hash محتوای فایل به‌صورت جریانی"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    def get_state_suffix(self) -> str:
+        """پسوند فایل‌های وضعیت (manifest و checkpoint) تا نودهای هم‌زمان روی یک خروجی تداخل نداشته باشند"""
+        suffix = ''
+        if self.config['shard']:
+            suffix += f".shard-{self.config['shard'][0]}-of-{self.config['shard'][1]}"
+        if self.config['queue_dir']:
+            suffix += f".node-{UNSAFE_NAME_CHARS.sub('-', self.get_node_id())}"
+        return suffix
+    
+    def get_node_id(self) -> str:
+        """شناسه‌ی این پروسه در صف کار (پیش‌فرض با PID تا دو پروسه روی یک ماشین هم وضعیت جدا داشته باشند)"""
+        return self.config['node_id'] or f"{socket.gethostname()}:{os.getpid()}"
+    
+    def get_manifest_path(self) -> Path:
+        """مسیر فایل manifest در کنار خروجی"""
+        return self.output_dir / f'.image_converter_manifest{self.get_state_suffix()}.jsonl'
+    
+    def build_manifest_entry(self, relative_path: str, source_stat: os.stat_result,
+                             content_hash: str, outputs: List[str], output_names: Tuple[str, str] = None) -> Dict:
+        """
+        ساخت رکورد manifest برای یک فایل مبدا
+        
+        output_names: نام‌های خروجی برنامه‌ریزی شده تا در اجرای بعد بدون تغییر حفظ شوند
+        """
+        return {
+            'source': relative_path,
+            'size': source_stat.st_size,
+            'mtime_ns': source_stat.st_mtime_ns,
+            'hash': content_hash,
+            'config': self.config_fingerprint,
+            'outputs': outputs,
+            'names': list(output_names) if output_names else None,
+        }
+    
+    def check_manifest(self, entry: Dict, image_path: Path, source_stat: os.stat_result,
+                       planned_outputs: set = None) -> Tuple[bool, str]:
+        """
+        بررسی به‌روز بودن خروجی‌های یک فایل
+        
+        planned_outputs: مسیر مطلق خروجی‌های برنامه‌ریزی شده در این اجرا؛ رکوردی که خروجی دیگری
+                         (مثلاً نام قبل از تغییر نام) دارد قدیمی است
+        خروجی: (به‌روز بودن، hash محتوا در صورتی که محاسبه شده باشد)
+        """
+        if not entry or entry['config'] != self.config_fingerprint:
+            return False, None
+        if planned_outputs is not None and not planned_outputs.issuperset(entry['outputs']):
+            return False, None
+        if not all(os.path.exists(path) for path in entry['outputs']):
+            return False, None
+        if entry['size'] == source_stat.st_size and entry['mtime_ns'] == source_stat.st_mtime_ns:
+            return True, entry['hash']
+        if entry['size'] != source_stat.st_size:
+            return False, None
+        
+        # زمان تغییر عوض شده؛ مقایسه محتوا
+        content_hash = self.hash_file(image_path)
+        return content_hash == entry['hash'], content_hash
+    
+    def get_checkpoint_path(self) -> Path:
+        """مسیر checkpoint اجرای جاری در کنار خروجی"""
+        return self.output_dir / f'.image_converter_checkpoint{self.get_state_suffix()}.jsonl'
+    
+    def load_checkpoint(self) -> set:
+        """بارگذاری فایل‌های تکمیل‌شده‌ی اجرای قبلی (فقط اگر تنظیمات تغییر نکرده باشد)"""
+        checkpoint_path = self.get_checkpoint_path()
+        if not checkpoint_path.exists():
+            print("checkpoint یافت نشد؛ اجرای کامل")
+            return set()
+        
+        completed = set()
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            for index, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # خط ناقص از اجرای قطع‌شده
+                    continue
+                if index == 0:
+                    if record.get('config') != self.config_fingerprint:
+                        print("تنظیمات از اجرای قبل تغییر کرده؛ checkpoint نادیده گرفته شد")
+                        return set()
+                    continue
+                if 'source' in record:
+                    completed.add(record['source'])
+        print(f"ادامه‌ی اجرای قبلی: {len(completed)} فایل تکمیل‌شده رد می‌شوند")
+        return completed
+    
+    def open_checkpoint(self, append: bool):
+        """باز کردن checkpoint برای ثبت فایل‌های تکمیل‌شده (در اجرای جدید با سطر تنظیمات شروع می‌شود)"""
+        checkpoint_path = self.get_checkpoint_path()
+        if append:
+            return open(checkpoint_path, 'a', encoding='utf-8')
+        f = open(checkpoint_path, 'w', encoding='utf-8')
+        f.write(json.dumps({'config': self.config_fingerprint,
+                            'started': datetime.now().isoformat(timespec='seconds')}) + '\n')
+        f.flush()
+        return f
+    
+    def load_manifest(self):
+        """بارگذاری manifest (در صورت تکرار، آخرین رکورد هر فایل معتبر است)"""
+        self.manifest = {}
+        manifest_path = self.get_manifest_path()
+        if not manifest_path.exists():
+            return
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.manifest[entry['source']] = entry
+                except (ValueError, KeyError):
+                    # خط ناقص از اجرای قطع‌شده
+                    continue
+        print(f"manifest: {len(self.manifest)} رکورد بارگذاری شد")
+    
+    def save_manifest(self):
+        """بازنویسی فشرده‌ی manifest با آخرین رکورد هر فایل"""
+        manifest_path = self.get_manifest_path()
+        tmp_path = manifest_path.with_name(manifest_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.manifest.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        os.replace(tmp_path, manifest_path)
+    
+    def prune_manifest(self, seen_files: set):
+        """حذف خروجی‌های فایل‌هایی که مبدا آن‌ها حذف شده است"""
+        deleted = {relative_path for relative_path in self.manifest
+                   if relative_path not in seen_files and not (self.source_dir / relative_path).exists()}
+        # خروجی‌هایی که (مثلاً پس از تغییر نام) به فایل موجود دیگری تعلق دارند حذف نمی‌شوند
+        in_use = set()
+        for relative_path, entry in self.manifest.items():
+            if relative_path not in deleted:
+                in_use.update(entry['outputs'])
+        
+        pruned = 0
+        for relative_path in deleted:
+            for path in self.manifest[relative_path]['outputs']:
+                if path in in_use:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            del self.manifest[relative_path]
+            pruned += 1
+        if pruned:
+            print(f"خروجی‌های {pruned} فایل حذف‌شده پاک شد")
     
     def show_final_stats(self):
         """نمایش آمار نهایی"""
         print("\n" + "=" * 60)
         print("آمار نهایی:")
-        print(f"کل فایل‌ها: {self.stats['total_files']}")
+        print(f"کل فایل‌ها (یافت شده): {self.stats['total_files']}")
+        print(f"پردازش شده: {self.stats['processed_files']}")
         print(f"تبدیل موفق ({self.output_format}): {self.stats['converted_files']}")
         if self.config['create_webp']:
             print(f"تبدیل موفق (WebP): {self.stats['webp_converted']}")
         print(f"تبدیل ناموفق: {self.stats['failed_files']}")
+        if self.stats['skipped_files']:
+            print(f"بدون تغییر (رد شده): {self.stats['skipped_files']}")
+        if self.stats['resumed_files']:
+            print(f"تکمیل‌شده در اجرای قبل (رد شده): {self.stats['resumed_files']}")
+        if self.stats['other_node_files']:
+            print(f"پردازش شده توسط نودهای دیگر: {self.stats['other_node_files']}")
+        if self.stats['deduplicated_files']:
+            print(f"فایل‌های تکراری: {self.stats['deduplicated_files']} "
+                  f"({self.stats['encodes_saved']} انکود ذخیره شد)")
+        if self.stats['content_classes']:
+            labels = {'graphic': 'گرافیک', 'photo': 'عکس'}
+            print("نوع محتوا: " + '، '.join(f"{labels.get(name, name)} {count}"
+                                            for name, count in sorted(self.stats['content_classes'].items())))
+        if self.stats['renamed_outputs']:
+            print(f"تغییر نام خروجی برای جلوگیری از بازنویسی: {self.stats['renamed_outputs']}")
+        if self.stats['passthrough_outputs']:
+            print(f"خروجی‌های نگه داشته شده از مبدا (بدون انکود یا کوچک‌تر از انکود): "
+                  f"{self.stats['passthrough_outputs']}")
+        if self.render_cache is not None:
+            print(f"کش رندر: {self.stats['render_cache_hits']} از کش، "
+                  f"{self.stats['render_cache_misses']} انکود جدید")
         
         if self.stats['total_size_before'] > 0:
             # آمار فرمت اصلی
@@ -471,11 +3119,35 @@ class ImageConverterWeb:
                 print(f"  حجم قبل: {self.stats['total_size_before'] / (1024*1024):.2f} MB")
                 print(f"  حجم بعد: {self.stats['webp_size_after'] / (1024*1024):.2f} MB")
         
+        if self.metrics.file_count:
+            self.metrics.print_summary()
+        
         if self.stats['failed_list']:
             print(f"\nفایل‌های ناموفق:")
             for failed_file in self.stats['failed_list']:
                 print(f"  - {failed_file}")
     
+    def export_metrics(self):
+        """ذخیره گزارش زمان‌سنجی به‌صورت JSON و/یا فایل متنی Prometheus"""
+        if self.config['metrics_json']:
+            report = {
+                'stats': {key: value for key, value in self.stats.items() if key != 'failed_list'},
+                'failed': self.stats['failed_list'],
+                **self.metrics.to_dict(),
+            }
+            with open(self.config['metrics_json'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            print(f"گزارش زمان‌سنجی در {self.config['metrics_json']} ذخیره شد")
+        
+        if self.config['metrics_prometheus']:
+            # نوشتن اتمیک تا node exporter فایل نیمه‌کاره نخواند
+            prom_path = Path(self.config['metrics_prometheus'])
+            tmp_path = prom_path.with_name(prom_path.name + '.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(self.metrics.to_prometheus(self.stats))
+            os.replace(tmp_path, prom_path)
+            print(f"متریک‌های Prometheus در {prom_path} ذخیره شد")
+    
     def save_config(self, config_path: str):
         """ذخیره تنظیمات در فایل JSON"""
         with open(config_path, 'w', encoding='utf-8') as f:
@@ -491,7 +3163,239 @@ class ImageConverterWeb:
         else:
             print(f"فایل تنظیمات یافت نشد: {config_path}")
 
+
+# فایل cache نتیجه‌ی تشخیص encoder ها (به ازای نسخه‌ی Pillow و pillow-heif)
+CODEC_CACHE_PATH = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'image_converter_web' / 'codecs.json'
+
+# مسیر پیش‌فرض کش رندر (خروجی‌های انکود شده)
+RENDER_CACHE_DIR = CODEC_CACHE_PATH.parent / 'renders'
+
+# نتیجه‌ی تشخیص در همین پروسه، تا هر مبدل یا worker دوباره تست نکند
+_codec_capabilities = None
+
+
+def _get_codec_cache_key() -> str:
+    """کلید cache بر اساس نسخه‌ی کتابخانه‌های تصویر"""
+    import PIL
+    try:
+        import pillow_heif
+        heif_version = getattr(pillow_heif, '__version__', 'unknown')
+    except ImportError:
+        heif_version = None
+    return f"Pillow={PIL.__version__};pillow-heif={heif_version}"
+
+
+def _probe_codec_capabilities() -> Dict:
+    """تست encoder ها با ذخیره در حافظه (بدون نوشتن فایل)"""
+    try:
+        # ثبت pillow-heif در صورت وجود
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+        has_heif = True
+    except Exception:
+        has_heif = False
+    
+    test_img = Image.new('RGB', (10, 10), color='red')
+    for format_name in ('AVIF', 'WebP'):
+        try:
+            test_img.save(io.BytesIO(), format_name)
+            return {'format': format_name, 'pillow_heif': has_heif and format_name == 'AVIF'}
+        except Exception:
+            pass
+    return {'format': 'JPEG', 'pillow_heif': False}
+
+
+def detect_codec_capabilities() -> Dict:
+    """تشخیص فرمت قابل استفاده با cache در حافظه و روی دیسک"""
+    global _codec_capabilities
+    if _codec_capabilities is not None:
+        return _codec_capabilities
+    
+    key = _get_codec_cache_key()
+    cache = {}
+    try:
+        with open(CODEC_CACHE_PATH, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        pass
+    
+    capabilities = cache.get(key)
+    if capabilities is None:
+        capabilities = _probe_codec_capabilities()
+        cache[key] = capabilities
+        # نوشتن اتمیک تا چند مبدل هم‌زمان فایل ناقص نبینند؛ خطای دسترسی نادیده گرفته می‌شود
+        try:
+            CODEC_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = CODEC_CACHE_PATH.with_name(f"{CODEC_CACHE_PATH.name}.{os.getpid()}.tmp")
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, indent=2)
+            os.replace(tmp_path, CODEC_CACHE_PATH)
+        except OSError:
+            pass
+    elif capabilities['pillow_heif']:
+        # فقط ثبت opener، بدون تست encoder
+        import pillow_heif
+        pillow_heif.register_heif_opener()
+    
+    _codec_capabilities = capabilities
+    return capabilities
+
+
+# بایت به ازای هر پیکسل در حافظه‌ی Pillow (RGB و LA هم 4 بایت ذخیره می‌شوند)
+MODE_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2, 'I;16L': 2, 'I;16B': 2, 'I;16N': 2}
+
+# جدول کوانتیزاسیون روشنایی استاندارد JPEG (کیفیت 50 در libjpeg) برای تخمین کیفیت فایل مبدا
+JPEG_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61, 12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56, 14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77, 24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101, 72, 92, 95, 98, 112, 100, 103, 99,
+)
+
+# نگاشت کاراکترهای فارسی و عربی برای نام‌های SEO-friendly
+PERSIAN_TRANSLATION = str.maketrans({
+    'ا': 'a', 'ب': 'b', 'پ': 'p', 'ت': 't', 'ث': 's', 'ج': 'j',
+    'چ': 'ch', 'ح': 'h', 'خ': 'kh', 'د': 'd', 'ذ': 'z', 'ر': 'r',
+    'ز': 'z', 'ژ': 'zh', 'س': 's', 'ش': 'sh', 'ص': 's', 'ض': 'z',
+    'ط': 't', 'ظ': 'z', 'ع': 'a', 'غ': 'gh', 'ف': 'f', 'ق': 'gh',
+    'ک': 'k', 'گ': 'g', 'ل': 'l', 'م': 'm', 'ن': 'n', 'و': 'v',
+    'ه': 'h', 'ی': 'i', 'ئ': 'i', 'ء': 'a', 'آ': 'a', 'ة': 'h',
+    'ى': 'i', 'ي': 'i', 'ك': 'k', 'ؤ': 'o', 'إ': 'a', 'أ': 'a',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5',
+    '٦': '6', '٧': '7', '٨': '8', '٩': '9'
+})
+
+# دنباله‌ی کاراکترهای غیرمجاز در نام فایل (شامل خط تیره‌ها) که با یک خط تیره جایگزین می‌شود
+UNSAFE_NAME_CHARS = re.compile(r'[^\w.]+')
+
+# بیشترین speed انکود AVIF برای گرافیک (ابزارهای palette و محتوای صفحه‌ی libaom در speed بالاتر غیرفعال‌اند)
+GRAPHIC_AVIF_MAX_SPEED = 6
+
+# شناسه‌ی segment XMP در APP1 فایل JPEG
+JPEG_XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+
+# فرمت مبدا (Image.format) -> فرمت خروجی که فایل مبدا می‌تواند بدون انکود جای آن بنشیند
+PASSTHROUGH_FORMATS = {'JPEG': 'JPEG', 'WEBP': 'WebP', 'AVIF': 'AVIF'}
+
+# ioctl کپی copy-on-write کل فایل در لینوکس (btrfs، xfs، bcachefs و ...)
+FICLONE = 0x40049409
+
+
+def parse_size(value: str) -> int:
+    """تبدیل اندازه‌هایی مانند 512M یا 4G به بایت"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def reflink_file(source: Path, destination: Path) -> bool:
+    """
+    کپی copy-on-write با ioctl FICLONE (فایل جدید داده‌ها را با مبدا به اشتراک می‌گذارد)
+    
+    در صورت عدم پشتیبانی (سیستم‌عامل، فایل‌سیستم یا فایل‌سیستم‌های متفاوت) False برمی‌گرداند؛
+    destination ممکن است خالی ساخته شده باشد و کپی عادی آن را بازنویسی می‌کند.
+    """
+    if fcntl is None or not sys.platform.startswith('linux'):
+        return False
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def fsync_directory(path):
+    """fsync یک دایرکتوری تا rename های داخل آن ماندگار شوند (در ویندوز لازم و ممکن نیست)"""
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# نشانه‌ی پایان جستجوی فایل‌ها در صف
+_SCAN_DONE = object()
+
+# مبدل هر پروسه‌ی worker که یک بار در initializer مقداردهی می‌شود
+_worker_converter = None
+
+
+def _init_worker(converter: ImageConverterWeb):
+    """مقداردهی اولیه‌ی پروسه‌ی worker با نسخه‌ای از مبدل"""
+    global _worker_converter
+    _worker_converter = converter
+    converter.apply_pixel_limit()
+    # سیگنال‌های توقف فقط در پروسه‌ی اصلی مدیریت می‌شوند تا تبدیل‌های در حال اجرا تمام شوند
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # در حالت spawn ثبت pillow-heif در پروسه‌ی جدید لازم است
+    detect_codec_capabilities()
+
+
+def _convert_bytes_in_worker(data: bytes, formats: List[str], sizes: List[int],
+                             widths: List[int] = None) -> Dict[str, Dict]:
+    """تبدیل تصویر در حافظه در پروسه‌ی worker"""
+    return _worker_converter.convert_bytes(data, formats, sizes, widths)
+
+
+def _encode_converted_in_worker(path: str, format_name: str, width: int = None) -> bytes:
+    """تبدیل یک فایل به یک خروجی در پروسه‌ی worker (سرور HTTP)"""
+    return _worker_converter.encode_converted(path, format_name, width).getvalue()
+
+
+def _process_in_worker(image_path: Path, output_names: Tuple[str, str] = None) -> Dict:
+    """پردازش یک فایل در پروسه‌ی worker با نام‌های خروجی برنامه‌ریزی شده در پروسه‌ی اصلی"""
+    return _worker_converter.process_file(image_path, output_names)
+
+
+def cache_main(argv: List[str]):
+    """زیرفرمان cache: نمایش آمار یا پاک‌سازی کش رندر"""
+    parser = argparse.ArgumentParser(prog='image_converter_v2.py cache', description='مدیریت کش رندر')
+    parser.add_argument('action', choices=['stats', 'prune'], help='stats: نمایش آمار، prune: حذف LRU تا حد حجم')
+    parser.add_argument('--cache-dir', default=str(RENDER_CACHE_DIR), help='مسیر کش رندر')
+    parser.add_argument('--max-size', default='1G', help='حد حجم برای prune (0 = حذف همه)')
+    parser.add_argument('--json', action='store_true', help='نمایش آمار به‌صورت JSON')
+    args = parser.parse_args(argv)
+    
+    try:
+        max_size = parse_size(args.max_size)
+    except ValueError:
+        print("خطا: حد حجم نامعتبر است (مثال: 500M یا 10G)")
+        return
+    cache = RenderCache(args.cache_dir, max_size)
+    
+    if args.action == 'prune':
+        removed, freed = cache.prune()
+        print(f"{removed} فایل ({freed / (1024 * 1024):.1f} MB) از کش حذف شد")
+    
+    stats = cache.get_stats()
+    if args.json:
+        print(json.dumps(stats, indent=2, ensure_ascii=False))
+        return
+    print(f"مسیر کش: {stats['path']}")
+    print(f"تعداد فایل‌ها: {stats['entries']}")
+    print(f"حجم: {stats['bytes'] / (1024 * 1024):.1f} MB (حد: {stats['max_bytes'] / (1024 * 1024):.1f} MB)")
+    if stats['entries']:
+        print(f"قدیمی‌ترین استفاده: {stats['oldest']}")
+        print(f"آخرین استفاده: {stats['newest']}")
+
+
 def main():
+    # زیرفرمان مدیریت کش رندر
+    if sys.argv[1:2] == ['cache']:
+        cache_main(sys.argv[2:])
+        return
+    # زیرفرمان سرور HTTP تبدیل در لحظه‌ی درخواست
+    if sys.argv[1:2] == ['serve']:
+        from image_converter_server import serve_main
+        serve_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(description='تبدیل تصاویر به فرمت‌های بهینه برای وب')
     parser.add_argument('source', help='مسیر فولدر مبدا')
     parser.add_argument('output', help='مسیر فولدر مقصد اصلی')
@@ -515,6 +3419,7 @@ def main():
     parser.add_argument('--subject', help='موضوع تصویر')
     parser.add_argument('--make', help='شرکت سازنده دوربین')
     parser.add_argument('--model', help='مدل دوربین')
+    parser.add_argument('--xmp', action='store_true', help='نوشتن همان اطلاعات به صورت XMP در کنار EXIF')
     
     # تنظیمات اضافی
     parser.add_argument('--no-exif', action='store_true', help='حذف کامل اطلاعات EXIF')
@@ -526,6 +3431,34 @@ def main():
     parser.add_argument('--method', type=int, default=6, choices=range(7), help='روش فشرده‌سازی (0-6)')
     parser.add_argument('--webp-method', type=int, default=6, choices=range(7), help='روش فشرده‌سازی WebP (0-6)')
     parser.add_argument('--thumb-sizes', nargs='+', type=int, default=[150, 300, 600], help='اندازه‌های thumbnail')
+    parser.add_argument('--srcset', nargs='+', type=int, help='عرض پله‌های srcset (مثلاً 320 640 960 1280 1920) با JSON ابعاد هر تصویر')
+    parser.add_argument('--workers', type=int, default=None, help='تعداد پروسه‌های موازی (پیش‌فرض: تعداد هسته‌های CPU)')
+    parser.add_argument('--exact-decode', action='store_true', help='رمزگشایی کامل تصویر پیش از تغییر اندازه (خروجی دقیق پیکسلی)')
+    parser.add_argument('--metrics-json', help='ذخیره گزارش زمان‌سنجی مراحل در فایل JSON')
+    parser.add_argument('--metrics-prom', help='ذخیره متریک‌ها در فایل متنی Prometheus (برای node exporter)')
+    parser.add_argument('--target-ssim', type=float, help='انتخاب کمترین کیفیتی که به این SSIM برسد (مثلاً 0.95)')
+    parser.add_argument('--time-budget', type=float, help='بودجه زمان انکود هر تصویر (ثانیه) برای انتخاب speed/method')
+    parser.add_argument('--min-quality', type=int, default=30, help='کمترین کیفیت مجاز در حالت --target-ssim')
+    parser.add_argument('--content-aware', action='store_true', help='تشخیص گرافیک (لوگو، نمودار، اسکرین‌شات) و انکود آن با WebP بدون افت یا ابزارهای محتوای صفحه‌ی AVIF')
+    parser.add_argument('--no-animation', action='store_true', help='تبدیل فقط فریم اول تصاویر متحرک')
+    parser.add_argument('--static-thumbnails', action='store_true', help='thumbnail تصاویر متحرک فقط از فریم اول')
+    parser.add_argument('--max-memory', help='بودجه حافظه برای تبدیل‌های هم‌زمان (مثلاً 4G)؛ تصاویر بزرگ‌تر به‌تنهایی اجرا می‌شوند')
+    parser.add_argument('--max-pixels', type=int, help='حد تعداد پیکسل‌های تصویر (پیش‌فرض Pillow؛ 0 = بدون محدودیت)')
+    parser.add_argument('--render-cache', nargs='?', const=str(RENDER_CACHE_DIR), help=f'استفاده از کش دائمی خروجی‌ها (پیش‌فرض مسیر: {RENDER_CACHE_DIR})')
+    parser.add_argument('--render-cache-size', default='1G', help='حداکثر حجم کش رندر (مثلاً 500M یا 10G)')
+    parser.add_argument('--dedup', action='store_true', help='یک بار انکود برای تصاویر با محتوای یکسان و لینک خروجی‌ها برای بقیه')
+    parser.add_argument('--dedup-link', choices=['hardlink', 'copy'], default='hardlink', help='روش ساخت خروجی فایل‌های تکراری')
+    parser.add_argument('--size-guard', action='store_true', help='خروجی هرگز از مبدا هم‌فرمت بزرگ‌تر نمی‌شود؛ مبدای بهینه (از روی header) بدون انکود کپی می‌شود')
+    parser.add_argument('--passthrough-link', choices=['copy', 'hardlink'], default='copy', help='روش ساخت خروجی‌هایی که همان فایل مبدا هستند')
+    parser.add_argument('--incremental', action='store_true', help='رد کردن فایل‌های بدون تغییر با manifest')
+    parser.add_argument('--fsync', choices=['none', 'file', 'batch'], default='none',
+                        help='سیاست fsync خروجی‌ها: none، file (بعد از هر فایل) یا batch (یک بار در پایان اجرا)')
+    parser.add_argument('--resume', action='store_true', help='ادامه‌ی اجرای قطع‌شده‌ی قبلی (رد کردن فایل‌های تکمیل‌شده در checkpoint)')
+    parser.add_argument('--shard', help='پردازش فقط بخش i از N (مثلاً 0/4) بر اساس hash مسیر نسبی')
+    parser.add_argument('--queue-dir', help='دایرکتوری مشترک صف کار (lease) برای اجرای توزیع‌شده روی چند نود')
+    parser.add_argument('--lease-ttl', type=float, default=300, help='مدت اعتبار lease هر فایل بدون تمدید (ثانیه)')
+    parser.add_argument('--node-id', help='شناسه‌ی ثابت این نود در صف کار برای --resume و --incremental (پیش‌فرض: نام میزبان و PID)')
+    parser.add_argument('--prune', action='store_true', help='حذف خروجی‌های فایل‌های مبدا حذف‌شده (با --incremental)')
     
     args = parser.parse_args()
     
@@ -542,6 +3475,56 @@ def main():
         print("خطا: حداکثر عرض و ارتفاع باید مثبت باشد")
         return
     
+    if args.target_ssim is not None and not (0 < args.target_ssim < 1):
+        print("خطا: هدف SSIM باید بین 0 و 1 باشد")
+        return
+    
+    if args.time_budget is not None and args.time_budget <= 0:
+        print("خطا: بودجه زمان باید مثبت باشد")
+        return
+    
+    if args.max_memory:
+        try:
+            if parse_size(args.max_memory) <= 0:
+                raise ValueError
+        except ValueError:
+            print("خطا: بودجه حافظه نامعتبر است (مثال: 512M یا 4G)")
+            return
+    
+    try:
+        if parse_size(args.render_cache_size) <= 0:
+            raise ValueError
+    except ValueError:
+        print("خطا: حجم کش رندر نامعتبر است (مثال: 500M یا 10G)")
+        return
+    
+    if args.max_pixels is not None and args.max_pixels < 0:
+        print("خطا: حد پیکسل‌ها نمی‌تواند منفی باشد")
+        return
+    
+    shard = None
+    if args.shard:
+        try:
+            index, count = (int(part) for part in args.shard.split('/'))
+            if count < 1 or not (0 <= index < count):
+                raise ValueError
+        except ValueError:
+            print("خطا: شارد باید به شکل i/N با 0 <= i < N باشد (مثلاً 0/4)")
+            return
+        shard = [index, count]
+    
+    if args.lease_ttl <= 0:
+        print("خطا: مدت اعتبار lease باید مثبت باشد")
+        return
+    
+    if args.srcset and min(args.srcset) <= 0:
+        print("خطا: عرض‌های srcset باید مثبت باشند")
+        return
+    
+    if args.workers is not None and args.workers < 1:
+        print("خطا: تعداد پروسه‌ها باید حداقل 1 باشد")
+        return
+    
     # ایجاد تنظیمات
     config = {
         'quality': args.quality,
@@ -560,6 +3543,36 @@ def main():
         'create_webp': bool(args.webp_dir),
         'webp_lossless': args.webp_lossless,
         'webp_method': args.webp_method,
+        'workers': args.workers,
+        'incremental': args.incremental,
+        'fast_decode': not args.exact_decode,
+        'scan_queue_size': 1000,
+        'metrics_json': args.metrics_json,
+        'metrics_prometheus': args.metrics_prom,
+        'target_ssim': args.target_ssim,
+        'time_budget': args.time_budget,
+        'min_quality': args.min_quality,
+        'content_aware': args.content_aware,
+        'animation': not args.no_animation,
+        'animated_thumbnails': not args.static_thumbnails,
+        'adaptive_proxy_size': 256,
+        'max_memory': parse_size(args.max_memory) if args.max_memory else None,
+        'max_image_pixels': args.max_pixels,
+        'render_cache': args.render_cache,
+        'render_cache_size': parse_size(args.render_cache_size),
+        'srcset_widths': args.srcset or [],
+        'deduplicate': args.dedup,
+        'dedup_link': args.dedup_link,
+        'size_guard': args.size_guard,
+        'passthrough_link': args.passthrough_link,
+        'prune_deleted': args.prune,
+        'fsync': args.fsync,
+        'resume': args.resume,
+        'shard': shard,
+        'queue_dir': args.queue_dir,
+        'lease_ttl': args.lease_ttl,
+        'node_id': args.node_id,
+        'write_xmp': args.xmp,
         'custom_exif': {
             'Artist': args.artist or '',
             'Copyright': args.copyright or '',
@@ -604,7 +3617,10 @@ def main():
         if args.save_config:
             converter.save_config(args.save_config)
         
-        print("\n✅ پردازش با موفقیت تکمیل شد!")
+        if converter.stop_requested:
+            print("\n⚠️  پردازش متوقف شد؛ برای ادامه همان دستور را با --resume اجرا کنید")
+        else:
+            print("\n✅ پردازش با موفقیت تکمیل شد!")
         
     except KeyboardInterrupt:
         print("\n\n⚠️  پردازش توسط کاربر متوقف شد")
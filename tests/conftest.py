@@ -0,0 +1,19 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# ماژول‌های مبدل در ریشه‌ی مخزن هستند (بدون بسته‌بندی)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from image_converter_v2 import ImageConverterWeb
+
+
+@pytest.fixture
+def converter(tmp_path):
+    """مبدل با مبدا و خروجی موقت و فرمت JPEG (مستقل از encoder های موجود)"""
+    (tmp_path / 'src').mkdir()
+    converter = ImageConverterWeb(source_dir=str(tmp_path / 'src'), output_dir=str(tmp_path / 'out'))
+    converter.output_format = 'JPEG'
+    converter.config['workers'] = 1
+    return converter
@@ -0,0 +1,33 @@
+from PIL import Image, ImageDraw
+
+
+def make_graphic():
+    """لوگوی کم‌رنگ با لبه‌های تیز"""
+    image = Image.new('RGB', (256, 128), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle((16, 16, 112, 112), fill=(220, 30, 30))
+    draw.ellipse((144, 16, 240, 112), fill=(30, 30, 220))
+    return image
+
+
+def test_time_budget_keeps_graphic_avif_speed_bound(converter):
+    # بودجه‌ای که فقط سریع‌ترین سطح effort در آن جا می‌شود
+    converter.config['time_budget'] = 1e-9
+    image = make_graphic()
+    content = converter.classify_content(image)
+    assert content['content'] == 'graphic'
+
+    save_params = converter.get_content_params('AVIF', converter.get_save_params('AVIF'), content)[0]
+    save_params, choice = converter.choose_save_params(image, 'AVIF', save_params, content)
+    assert save_params['speed'] == choice['speed'] == 6
+
+
+def test_time_budget_photo_avif_uses_all_speeds(converter):
+    converter.config['time_budget'] = 1e-9
+    gradient = Image.linear_gradient('L')
+    image = Image.merge('RGB', (gradient, gradient.transpose(Image.Transpose.ROTATE_90), Image.radial_gradient('L')))
+    content = converter.classify_content(image)
+    assert content['content'] == 'photo'
+
+    save_params = converter.choose_save_params(image, 'AVIF', converter.get_save_params('AVIF'), content)[0]
+    assert save_params['speed'] == 10
@@ -0,0 +1,38 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from image_converter_async import AsyncImageConverter
+
+
+def test_cancelled_requests_keep_their_slot_until_done():
+    counts = {'running': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def slow_convert(*args):
+        with lock:
+            counts['running'] += 1
+            counts['peak'] = max(counts['peak'], counts['running'])
+        time.sleep(0.2)
+        with lock:
+            counts['running'] -= 1
+        return {}
+
+    async def run():
+        with ThreadPoolExecutor(4) as executor:
+            converter = AsyncImageConverter(executor=executor, max_concurrency=2)
+            converter.converter.convert_bytes = slow_convert
+            cancelled = [asyncio.create_task(converter.convert_bytes(b'')) for _ in range(2)]
+            await asyncio.sleep(0.05)
+            for task in cancelled:
+                task.cancel()
+            # تبدیل‌های لغو شده هنوز در executor اجرا می‌شوند
+            results = await asyncio.gather(*[converter.convert_bytes(b'') for _ in range(4)])
+            await asyncio.gather(*cancelled, return_exceptions=True)
+            return results, converter.semaphore
+
+    results, semaphore = asyncio.run(run())
+    assert results == [{}] * 4
+    assert counts['peak'] == 2
+    assert not semaphore.locked()
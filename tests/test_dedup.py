@@ -0,0 +1,36 @@
+import pytest
+from PIL import Image
+
+
+def run(converter, capsys):
+    converter.stats['skipped_files'] = 0
+    converter.process_directory()
+    capsys.readouterr()
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_incremental_skips_duplicates_without_rehashing(converter, capsys, monkeypatch, workers):
+    converter.config.update(incremental=True, deduplicate=True, workers=workers)
+    Image.new('RGB', (64, 48), (200, 10, 10)).save(converter.source_dir / 'a.png')
+    (converter.source_dir / 'b.png').write_bytes((converter.source_dir / 'a.png').read_bytes())
+    run(converter, capsys)
+    assert converter.stats['deduplicated_files'] == 1
+
+    hashed = []
+    hash_file = converter.hash_file
+    monkeypatch.setattr(converter, 'hash_file', lambda path: hashed.append(path.name) or hash_file(path))
+    monkeypatch.setattr(converter, 'link_duplicate', lambda *args: pytest.fail('duplicate linked again'))
+    run(converter, capsys)
+    assert converter.stats['skipped_files'] == 2
+    assert hashed == []
+
+    # تکراری جدید از خروجی‌های فایل بدون تغییر ساخته می‌شود؛ فقط خود آن hash می‌شود
+    monkeypatch.undo()
+    monkeypatch.setattr(converter, 'hash_file', lambda path: hashed.append(path.name) or hash_file(path))
+    (converter.source_dir / 'c.png').write_bytes((converter.source_dir / 'a.png').read_bytes())
+    converter.stats['deduplicated_files'] = 0
+    run(converter, capsys)
+    assert converter.stats['skipped_files'] == 2
+    assert converter.stats['deduplicated_files'] == 1
+    assert hashed == ['c.png']
+    assert (converter.output_dir / 'img-c.jpg').read_bytes() == (converter.output_dir / 'img-a.jpg').read_bytes()
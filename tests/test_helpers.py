@@ -0,0 +1,22 @@
+import pytest
+
+from image_converter_v2 import parse_size
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('100', 100),
+    ('512M', 512 * 1024 ** 2),
+    ('4G', 4 * 1024 ** 3),
+    ('10GB', 10 * 1024 ** 3),
+    (' 2m ', 2 * 1024 ** 2),
+    ('1.5K', 1536),
+    ('1T', 1024 ** 4),
+])
+def test_parse_size(value, expected):
+    assert parse_size(value) == expected
+
+
+@pytest.mark.parametrize('value', ['', 'abc', '5X', 'M'])
+def test_parse_size_rejects_invalid(value):
+    with pytest.raises(ValueError):
+        parse_size(value)
@@ -0,0 +1,80 @@
+import os
+
+from PIL import Image
+
+
+def make_image(path, color=(200, 10, 10), size=(64, 48)):
+    Image.new('RGB', size, color).save(path)
+    return path
+
+
+def make_entry(converter, image_path, outputs):
+    relative_path = image_path.relative_to(converter.source_dir).as_posix()
+    return converter.build_manifest_entry(relative_path, image_path.stat(), converter.hash_file(image_path),
+                                          [str(path) for path in outputs])
+
+
+def run(converter, capsys):
+    converter.process_directory()
+    capsys.readouterr()
+
+
+def test_check_manifest(converter, tmp_path):
+    converter.config_fingerprint = 'current'
+    image_path = make_image(converter.source_dir / 'a.png')
+    output = tmp_path / 'a.jpg'
+    output.write_bytes(b'output')
+    entry = make_entry(converter, image_path, [output])
+    stat = image_path.stat()
+
+    assert converter.check_manifest(entry, image_path, stat) == (True, entry['hash'])
+    assert converter.check_manifest(None, image_path, stat) == (False, None)
+    # خروجی برنامه‌ریزی شده‌ی دیگر (مثلاً پس از تغییر نام)
+    assert converter.check_manifest(entry, image_path, stat, {str(tmp_path / 'other.jpg')}) == (False, None)
+    assert converter.check_manifest(entry, image_path, stat, {str(output)})[0]
+
+    converter.config_fingerprint = 'changed'
+    assert converter.check_manifest(entry, image_path, stat) == (False, None)
+    converter.config_fingerprint = 'current'
+
+    # فقط زمان تغییر عوض شده: مقایسه‌ی محتوا
+    os.utime(image_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert converter.check_manifest(entry, image_path, image_path.stat()) == (True, entry['hash'])
+
+    make_image(image_path, color=(0, 0, 0), size=(65, 48))
+    assert not converter.check_manifest(entry, image_path, image_path.stat())[0]
+
+    output.unlink()
+    assert converter.check_manifest(entry, image_path, image_path.stat()) == (False, None)
+
+
+def test_prune_keeps_outputs_of_live_entries(converter, tmp_path):
+    live = make_image(converter.source_dir / 'live.png')
+    shared = tmp_path / 'shared.jpg'
+    orphan = tmp_path / 'orphan.jpg'
+    shared.write_bytes(b'shared')
+    orphan.write_bytes(b'orphan')
+    deleted = converter.source_dir / 'deleted.png'
+    converter.manifest = {
+        'live.png': make_entry(converter, live, [shared]),
+        'deleted.png': dict(make_entry(converter, live, [shared, orphan]), source='deleted.png'),
+    }
+
+    converter.prune_manifest(seen_files={'live.png'})
+    assert not deleted.exists()
+    assert list(converter.manifest) == ['live.png']
+    assert shared.exists()
+    assert not orphan.exists()
+
+
+def test_incremental_run_skips_unchanged_files(converter, capsys):
+    converter.config['incremental'] = True
+    make_image(converter.source_dir / 'a.png')
+    run(converter, capsys)
+    output = converter.output_dir / 'img-a.jpg'
+    mtime = output.stat().st_mtime_ns
+
+    converter.stats['skipped_files'] = 0
+    run(converter, capsys)
+    assert converter.stats['skipped_files'] == 1
+    assert output.stat().st_mtime_ns == mtime
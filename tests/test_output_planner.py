@@ -0,0 +1,160 @@
+import json
+import random
+from pathlib import Path
+
+from PIL import Image
+
+ROOT = Path('.')
+
+
+def plan(converter, filenames, previous=None):
+    """برنامه‌ی یک دایرکتوری: (تغییر نام‌ها، نام فایل -> (نام خروجی، نام پایه‌ی thumbnail ها))"""
+    planner = converter.output_planner
+    renamed = planner.plan_directory(ROOT, filenames, previous)
+    return renamed, dict(planner.plans.get('.', {}))
+
+
+def assert_disjoint(converter, names):
+    """هیچ دو مبدایی فایل خروجی مشترک (بدون حساسیت به حروف) ندارند"""
+    seen = set()
+    for output_names in names.values():
+        files = {name.casefold() for name in converter.get_output_filenames(output_names)}
+        assert not files & seen
+        seen |= files
+
+
+def make_image(path, color):
+    Image.new('RGB', (64, 48), color).save(path)
+
+
+def run(converter, capsys):
+    converter.process_directory()
+    capsys.readouterr()
+
+
+def read_manifest(converter):
+    with open(converter.get_manifest_path(), 'r', encoding='utf-8') as f:
+        return {entry['source']: entry for entry in map(json.loads, f)}
+
+
+def test_distinct_names_are_kept(converter):
+    renamed, names = plan(converter, ['a.png', 'b.jpg'])
+    assert renamed == []
+    assert names == {'a.png': ('img-a', 'a'), 'b.jpg': ('img-b', 'b')}
+
+
+def test_case_insensitive_collision_gets_suffix(converter):
+    renamed, names = plan(converter, ['cat-1.png', 'Cat 1.JPG'])
+    # به ترتیب نام مبدا: «Cat 1.JPG» پیش از «cat-1.png»
+    assert names['Cat 1.JPG'] == ('img-cat-1', 'Cat 1')
+    assert names['cat-1.png'] == ('img-cat-1-2', 'cat-1')
+    assert renamed == [('cat-1.png', 'img-cat-1-2')]
+
+
+def test_thumbnail_stem_renamed_only_when_thumbnails_collide(converter):
+    converter.config['create_thumbnails'] = False
+    _, names = plan(converter, ['a.png', 'a.jpg'])
+    assert names['a.png'] == ('img-a-2', 'a')
+
+    converter.config['create_thumbnails'] = True
+    converter.output_planner.plans.clear()
+    _, names = plan(converter, ['a.png', 'a.jpg'])
+    assert names['a.jpg'] == ('img-a', 'a')
+    assert names['a.png'] == ('img-a-2', 'a-2')
+    assert_disjoint(converter, names)
+
+
+def test_suffix_does_not_take_another_natural_name(converter):
+    _, names = plan(converter, ['a.png', 'a.jpg', 'a-2.png'])
+    assert names['a-2.png'] == ('img-a-2', 'a-2')
+    assert names['a.png'][0] == 'img-a-3'
+
+
+def test_srcset_rendition_collision(converter):
+    converter.config['srcset_widths'] = [640]
+    renamed, names = plan(converter, ['hero.jpg', 'hero-640w.jpg'])
+    # پله‌ی 640w از hero.jpg همان نام خروجی اصلی hero-640w.jpg است
+    assert names['hero-640w.jpg'] == ('img-hero-640w', 'hero-640w')
+    assert renamed == [('hero.jpg', 'img-hero-2')]
+    assert_disjoint(converter, names)
+
+
+def test_thumbnail_collides_with_main_output(converter):
+    converter.config['seo_friendly_names'] = False
+    converter.config['create_thumbnails'] = True
+    converter.config['thumbnail_sizes'] = [150]
+    renamed, names = plan(converter, ['a.png', 'a_thumb_150x150.png'])
+    assert names['a.png'] == ('a', 'a')
+    assert renamed == [('a_thumb_150x150.png', 'a_thumb_150x150-2')]
+    assert_disjoint(converter, names)
+
+
+def test_plan_is_independent_of_listing_order(converter):
+    converter.config['create_thumbnails'] = True
+    converter.config['srcset_widths'] = [320, 640]
+    filenames = ['a.png', 'A.jpg', 'a-2.gif', 'a-320w.png', 'b.png', 'B 1.png', 'b-1.tiff']
+    _, expected = plan(converter, filenames)
+    assert_disjoint(converter, expected)
+    for seed in range(5):
+        shuffled = filenames[:]
+        random.Random(seed).shuffle(shuffled)
+        converter.output_planner.plans.clear()
+        assert plan(converter, shuffled)[1] == expected
+
+
+def test_previous_names_are_kept(converter):
+    previous = {'cat-1.png': ('img-cat-1', 'cat-1')}
+    renamed, names = plan(converter, ['cat-1.png', 'Cat 1.JPG'], previous)
+    # فایل جدید نام خروجی موجود را نمی‌گیرد
+    assert names['cat-1.png'] == ('img-cat-1', 'cat-1')
+    assert names['Cat 1.JPG'] == ('img-cat-1-2', 'Cat 1')
+    assert renamed == [('Cat 1.JPG', 'img-cat-1-2')]
+
+
+def test_previous_names_from_other_settings_are_ignored(converter):
+    # نام بدون پیشوند SEO (اجرای قبل با --no-seo) با تنظیمات فعلی سازگار نیست
+    _, names = plan(converter, ['cat-1.png'], {'cat-1.png': ('cat-1', 'cat-1')})
+    assert names['cat-1.png'] == ('img-cat-1', 'cat-1')
+
+
+def test_pop_drops_directory_plan_after_last_file(converter):
+    planner = converter.output_planner
+    planner.plan_directory(Path('sub'), ['a.png', 'b.png'])
+    assert planner.pop(Path('sub/a.png')) == ('img-a', 'a')
+    assert planner.get(Path('sub/a.png')) is None
+    assert 'sub' in planner.plans
+    assert planner.pop(Path('sub/b.png')) == ('img-b', 'b')
+    assert planner.plans == {}
+    assert planner.pop(Path('sub/b.png')) is None
+
+
+def test_new_colliding_file_does_not_take_existing_output(converter, capsys):
+    converter.config['incremental'] = True
+    make_image(converter.source_dir / 'cat-1.png', color=(200, 10, 10))
+    run(converter, capsys)
+    existing = converter.output_dir / 'img-cat-1.jpg'
+    data = existing.read_bytes()
+
+    # فایل جدید با نام خروجی یکسان که به ترتیب نام پیش از فایل قبلی است
+    make_image(converter.source_dir / 'Cat 1.JPG', color=(10, 10, 200))
+    converter.stats['skipped_files'] = 0
+    run(converter, capsys)
+
+    assert converter.stats['skipped_files'] == 1
+    assert existing.read_bytes() == data
+    manifest = read_manifest(converter)
+    assert manifest['cat-1.png']['outputs'] == [str(existing)]
+    assert manifest['Cat 1.JPG']['outputs'] == [str(converter.output_dir / 'img-cat-1-2.jpg')]
+
+
+def test_srcset_rendition_does_not_overwrite_other_output(converter, capsys):
+    converter.config['srcset_widths'] = [32]
+    make_image(converter.source_dir / 'hero.jpg', color=(200, 10, 10))
+    make_image(converter.source_dir / 'hero-32w.jpg', color=(10, 10, 200))
+    run(converter, capsys)
+
+    with Image.open(converter.output_dir / 'img-hero-32w.jpg') as image:
+        # خروجی اصلی hero-32w.jpg (آبی)، نه پله‌ی 32w از hero.jpg
+        assert image.size == (64, 48)
+        assert image.getpixel((0, 0))[2] > 150
+    assert (converter.output_dir / 'img-hero-2-32w.jpg').exists()
@@ -0,0 +1,48 @@
+import io
+
+import pytest
+from PIL import Image
+
+
+@pytest.mark.parametrize('quality', [30, 50, 75, 85, 95])
+def test_estimate_jpeg_quality(converter, tmp_path, quality):
+    path = tmp_path / 'q.jpg'
+    Image.linear_gradient('L').convert('RGB').save(path, 'JPEG', quality=quality)
+    with Image.open(path) as image:
+        # جدول‌های ذخیره شده گرد و به 1..255 محدود می‌شوند
+        assert abs(converter.estimate_jpeg_quality(image) - quality) <= 1
+
+
+def with_metadata(converter):
+    converter.config.update(size_guard=True, write_xmp=True)
+    converter.config['custom_exif']['Artist'] = 'Tester'
+    return converter
+
+
+@pytest.mark.parametrize('format_name, source_format, params', [
+    ('JPEG', 'JPEG', {'quality': 60}),
+    ('WebP', 'WEBP', {'quality': 60}),
+    ('WebP', 'WEBP', {'lossless': True}),
+])
+def test_kept_source_gets_custom_metadata(converter, format_name, source_format, params):
+    with_metadata(converter).config['webp_lossless'] = params.get('lossless', False)
+    image = Image.linear_gradient('L').convert('RGBA')
+    image.putalpha(Image.linear_gradient('L').transpose(Image.Transpose.ROTATE_90))
+    source = io.BytesIO()
+    (image if source_format == 'WEBP' else image.convert('RGB')).save(source, source_format, **params)
+
+    output = converter.encode_converted(source.getvalue(), format_name)
+    with Image.open(io.BytesIO(source.getvalue())) as expected, Image.open(output) as kept:
+        # همان داده‌ی تصویر مبدا (بدون انکود) به همراه EXIF/XMP سفارشی
+        assert kept.getexif()[315] == 'Tester'
+        assert b'Tester' in (kept.info.get('xmp') or kept.info.get('XML:com.adobe.xmp').encode())
+        assert kept.mode == expected.mode
+        assert kept.tobytes() == expected.tobytes()
+
+
+def test_avif_source_is_not_kept_with_custom_metadata(converter):
+    source = io.BytesIO()
+    Image.linear_gradient('L').convert('RGB').save(source, 'AVIF', quality=40)
+    with Image.open(source) as image:
+        assert converter.can_keep_source(image, 'AVIF')
+        assert not with_metadata(converter).can_keep_source(image, 'AVIF')
@@ -0,0 +1,23 @@
+import io
+
+from PIL import Image
+
+
+def make_jpeg(size):
+    source = io.BytesIO()
+    Image.linear_gradient('L').resize(size).convert('RGB').save(source, 'JPEG', quality=90)
+    return source.getvalue()
+
+
+def test_decode_drafts_jpeg_before_load(converter):
+    with Image.open(io.BytesIO(make_jpeg((4000, 3000)))) as image:
+        target_size = converter.decode_image(image)
+        # DCT scaling با مقیاس 1/2؛ اندازه‌ی مقصد از اندازه‌ی اصلی محاسبه شده است
+        assert image.size == (2000, 1500)
+        assert target_size == (1440, 1080)
+        assert converter.resize_image(image, target_size).size == target_size
+
+
+def test_converted_rendition_is_drafted_to_exact_size(converter):
+    with Image.open(converter.encode_converted(make_jpeg((4000, 3000)), 'JPEG', width=640)) as output:
+        assert output.size == (640, 480)
@@ -0,0 +1,105 @@
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from image_converter_v2 import WorkQueue
+
+SCRIPT = Path(__file__).resolve().parent.parent / 'image_converter_v2.py'
+
+
+@pytest.fixture
+def queues(tmp_path):
+    """دو نود روی یک دایرکتوری صف"""
+    first = WorkQueue(tmp_path / 'queue', lease_ttl=60, node_id='node-a')
+    second = WorkQueue(tmp_path / 'queue', lease_ttl=60, node_id='node-b')
+    first.open('config')
+    second.open('config')
+    return first, second
+
+
+def expire(path):
+    past = time.time() - 3600
+    os.utime(path, (past, past))
+
+
+def test_open_rejects_other_config(queues, tmp_path):
+    with pytest.raises(ValueError):
+        WorkQueue(tmp_path / 'queue').open('other-config')
+
+
+def test_claim_is_exclusive_until_complete(queues):
+    first, second = queues
+    key = first.get_key('a.png')
+    assert first.try_claim(key, 'a.png')
+    assert not second.try_claim(key, 'a.png')
+
+    first.complete(key)
+    assert second.is_done(key)
+    assert not second.try_claim(key, 'a.png')
+    assert not (first.leases_dir / key).exists()
+
+
+def test_expired_lease_is_stolen(queues):
+    first, second = queues
+    key = first.get_key('a.png')
+    assert first.try_claim(key, 'a.png')
+    expire(first.leases_dir / key)
+
+    assert second.try_claim(key, 'a.png')
+    assert key in second.held
+    assert '"node-b"' in (first.leases_dir / key).read_text(encoding='utf-8')
+    assert not (first.leases_dir / f"{key}.steal").exists()
+
+
+def test_stale_steal_lock_is_cleared(queues):
+    first, second = queues
+    key = first.get_key('a.png')
+    assert first.try_claim(key, 'a.png')
+    expire(first.leases_dir / key)
+    # قفل نودی که حین گرفتن lease از کار افتاده
+    steal_path = first.leases_dir / f"{key}.steal"
+    steal_path.write_text('{}', encoding='utf-8')
+    expire(steal_path)
+
+    assert not second.try_claim(key, 'a.png')
+    assert not steal_path.exists()
+    assert second.try_claim(key, 'a.png')
+
+
+def test_release_all_frees_held_leases(queues):
+    first, second = queues
+    keys = [first.get_key(name) for name in ('a.png', 'b.png')]
+    for key in keys:
+        assert first.try_claim(key, key)
+    first.release_all()
+    assert first.held == set()
+    for key in keys:
+        assert second.try_claim(key, key)
+
+
+def test_two_pool_nodes_share_a_queue(tmp_path):
+    source = tmp_path / 'src'
+    source.mkdir()
+    for index in range(40):
+        Image.new('RGB', (64, 48), (index * 6, 10, 10)).save(source / f"p{index:02d}.png")
+
+    # دو نود هم‌زمان با pool؛ هر نود باید پیش از انتظار برای lease های نود دیگر کارهای خود را تحویل دهد
+    nodes = [subprocess.Popen([sys.executable, str(SCRIPT), str(source), str(tmp_path / 'out'),
+                               '--workers', '2', '--queue-dir', str(tmp_path / 'queue'),
+                               '--node-id', node_id, '--lease-ttl', '8'],
+                              cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             for node_id in ('node-a', 'node-b')]
+    try:
+        for node in nodes:
+            assert node.wait(timeout=60) == 0
+    finally:
+        for node in nodes:
+            node.kill()
+
+    assert len(list((tmp_path / 'queue' / 'done').iterdir())) == 40
+    assert len(list((tmp_path / 'out').iterdir())) == 40